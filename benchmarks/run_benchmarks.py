@@ -0,0 +1,259 @@
+"""
+Benchmarks of the pyDMS pipeline stages on synthetic rasters.
+
+Synthetic high-resolution, low-resolution and quality rasters are generated as
+GeoTIFFs in a temporary directory for each requested scale, and the wall time and
+memory use of trainSharpener, applySharpener, residualAnalysis,
+resampleHighResToLowRes, binomialSmoother and saveImg are measured. The results
+are written as JSON, and results of two runs (e.g. of two commits) can be
+compared with --compare.
+
+Examples:
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --preset full --output results.json
+    python benchmarks/run_benchmarks.py --compare before.json after.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import numpy as np
+from osgeo import gdal
+
+import pyDMS.pyDMSUtils as utils
+from pyDMS.pyDMS import DecisionTreeSharpener
+
+PRESETS = {"small": {"sizes": [1000, 2000], "bands": [2, 6]},
+           "full": {"sizes": [1000, 5000, 10000], "bands": [2, 6, 10]}}
+
+# Ratio of low to high resolution pixel size (e.g. 20 m Sentinel-2 and 1 km
+# Sentinel-3)
+RESOLUTION_RATIO = 50
+PROJECTION = "EPSG:32633"
+
+
+def makeScene(outDir, size, bands, seed=0):
+    ''' Write synthetic high resolution, low resolution and quality GeoTIFFs and
+    return their paths. The low resolution image is an aggregated non-linear
+    function of the high resolution bands plus noise, and both images contain
+    some nodata pixels.
+    '''
+    rng = np.random.default_rng(seed)
+    gt_HR = (500000.0, 20.0, 0, 4000000.0, 0, -20.0)
+    gt_LR = (gt_HR[0], gt_HR[1]*RESOLUTION_RATIO, 0, gt_HR[3], 0, gt_HR[5]*RESOLUTION_RATIO)
+    size_LR = int(np.ceil(size / RESOLUTION_RATIO))
+
+    highResFilename = os.path.join(outDir, f"hr_{size}_{bands}.tif")
+    scene_HR = gdal.GetDriverByName("GTiff").Create(highResFilename, size, size, bands,
+                                                    gdal.GDT_Float32, ["TILED=YES"])
+    scene_HR.SetGeoTransform(gt_HR)
+    scene_HR.SetProjection(PROJECTION)
+    target = np.zeros((size, size))
+    xx = np.arange(size)[np.newaxis, :] / size
+    yy = np.arange(size)[:, np.newaxis] / size
+    for band in range(bands):
+        frequency = rng.uniform(2, 20, 2)
+        data = (0.3 + 0.2*np.sin(2*np.pi*frequency[0]*xx + band) *
+                np.cos(2*np.pi*frequency[1]*yy) +
+                rng.normal(0, 0.02, (size, size))).astype(np.float32)
+        target += rng.uniform(-10, 10) * data**(1 + band % 2)
+        if band == 0:
+            # Square nodata patches, e.g. clouds
+            for _ in range(5):
+                y0, x0 = rng.integers(0, size, 2)
+                data[y0:y0+size//20, x0:x0+size//20] = -9999
+        scene_HR.GetRasterBand(band+1).WriteArray(data)
+        scene_HR.GetRasterBand(band+1).SetNoDataValue(-9999)
+    scene_HR = None
+
+    target = np.pad(target, ((0, size_LR*RESOLUTION_RATIO - size),) * 2, "edge")
+    data_LR = 300 + target.reshape(size_LR, RESOLUTION_RATIO,
+                                   size_LR, RESOLUTION_RATIO).mean((1, 3))
+    data_LR += rng.normal(0, 0.1, data_LR.shape)
+    quality_LR = (rng.random(data_LR.shape) > 0.05).astype(np.uint8)
+
+    lowResFilename = os.path.join(outDir, f"lr_{size}_{bands}.tif")
+    qualityFilename = os.path.join(outDir, f"quality_{size}_{bands}.tif")
+    for filename, data, dataType in [(lowResFilename, data_LR, gdal.GDT_Float32),
+                                     (qualityFilename, quality_LR, gdal.GDT_Byte)]:
+        scene_LR = gdal.GetDriverByName("GTiff").Create(filename, size_LR, size_LR, 1, dataType)
+        scene_LR.SetGeoTransform(gt_LR)
+        scene_LR.SetProjection(PROJECTION)
+        scene_LR.GetRasterBand(1).WriteArray(data)
+        scene_LR = None
+
+    return highResFilename, lowResFilename, qualityFilename
+
+
+def measure(func, *args, **kwargs):
+    ''' Call func and return its result, wall time (s), peak memory traced by
+    tracemalloc during the call (MB, this includes numpy arrays) and maximum
+    resident set size of the process after the call (MB, None if not available).
+    '''
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    wallTime = time.perf_counter() - start
+    peakTraced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    maxRSS = None
+    if resource is not None:
+        # Linux reports kilobytes and macOS bytes
+        maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            maxRSS = maxRSS * 1024
+        maxRSS = maxRSS / 2**20
+    return result, wallTime, peakTraced / 2**20, maxRSS
+
+
+def benchmarkScene(highResFilename, lowResFilename, qualityFilename, outDir, repeat):
+    ''' Run all the benchmarked stages on one scene and return the measurements of
+    each stage, keeping the fastest of the repeated runs.
+    '''
+    stages = {}
+
+    def record(stage, func, *args, **kwargs):
+        runs = [measure(func, *args, **kwargs) for _ in range(repeat)]
+        best = min(runs, key=lambda run: run[1])
+        stages[stage] = {"wall_time_s": best[1],
+                         "wall_times_s": [run[1] for run in runs],
+                         "peak_traced_mb": max(run[2] for run in runs),
+                         "max_rss_mb": runs[-1][3]}
+        return best[0]
+
+    sharpener = DecisionTreeSharpener([highResFilename], [lowResFilename],
+                                      lowResQualityFiles=[qualityFilename],
+                                      lowResGoodQualityFlags=[1],
+                                      cvHomogeneityThreshold=0,
+                                      movingWindowSize=10,
+                                      disaggregatingTemperature=True,
+                                      baggingRegressorOpt={"n_estimators": 10,
+                                                           "random_state": 0})
+    record("trainSharpener", sharpener.trainSharpener)
+    downscaled = record("applySharpener", sharpener.applySharpener, highResFilename,
+                        lowResFilename)
+    _, correctedImage = record("residualAnalysis", sharpener.residualAnalysis,
+                               downscaled, lowResFilename, qualityFilename)
+
+    scene_HR = gdal.Open(highResFilename)
+    subsetScene_LR = utils.reprojectSubsetLowResScene(scene_HR, gdal.Open(lowResFilename))
+    record("resampleHighResToLowRes", utils.resampleHighResToLowRes, scene_HR, subsetScene_LR)
+
+    data = correctedImage.GetRasterBand(1).ReadAsArray()
+    record("binomialSmoother", utils.binomialSmoother, data)
+    record("saveImg", utils.saveImg, data, correctedImage.GetGeoTransform(),
+           correctedImage.GetProjection(), os.path.join(outDir, "corrected.tif"))
+
+    return stages
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(sizes, bandsList, repeat):
+    results = []
+    tempDir = tempfile.mkdtemp()
+    try:
+        # Compile the numba kernels on a small scene so that compilation time is
+        # not included in the measurements
+        print("Warming up...")
+        benchmarkScene(*makeScene(tempDir, 200, 2), tempDir, 1)
+
+        for size in sizes:
+            for bands in bandsList:
+                print(f"Benchmarking {size} x {size} pixels, {bands} bands...")
+                files = makeScene(tempDir, size, bands)
+                stages = benchmarkScene(*files, tempDir, repeat)
+                for stage, measurements in stages.items():
+                    result = {"stage": stage, "size": size, "bands": bands}
+                    result.update(measurements)
+                    results.append(result)
+                    print(f"  {stage:<24} {measurements['wall_time_s']:8.2f} s "
+                          f"{measurements['peak_traced_mb']:10.1f} MB")
+                for filename in files:
+                    gdal.GetDriverByName("GTiff").Delete(filename)
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
+
+    return {"metadata": {"date": datetime.datetime.now().isoformat(),
+                         "commit": gitCommit(),
+                         "python": platform.python_version(),
+                         "numpy": np.__version__,
+                         "gdal": gdal.__version__,
+                         "platform": platform.platform(),
+                         "cpu_count": os.cpu_count(),
+                         "repeat": repeat},
+            "results": results}
+
+
+def compareResults(beforeFilename, afterFilename):
+    ''' Print the ratio of wall time and traced memory of matching results of two
+    benchmark runs.
+    '''
+    with open(beforeFilename) as fp:
+        before = json.load(fp)
+    with open(afterFilename) as fp:
+        after = json.load(fp)
+    beforeResults = {(r["stage"], r["size"], r["bands"]): r for r in before["results"]}
+    print(f"{'stage':<24} {'size':>6} {'bands':>5} {'before s':>10} {'after s':>10} "
+          f"{'time x':>7} {'mem x':>7}")
+    for r in after["results"]:
+        key = (r["stage"], r["size"], r["bands"])
+        if key not in beforeResults:
+            continue
+        b = beforeResults[key]
+        timeRatio = r["wall_time_s"] / max(b["wall_time_s"], 1e-9)
+        memoryRatio = r["peak_traced_mb"] / max(b["peak_traced_mb"], 1e-9)
+        print(f"{r['stage']:<24} {r['size']:6d} {r['bands']:5d} {b['wall_time_s']:10.2f} "
+              f"{r['wall_time_s']:10.2f} {timeRatio:7.2f} {memoryRatio:7.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pyDMS on synthetic rasters.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small",
+                        help="Scales to benchmark if --sizes and --bands are not given.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        help="Sizes (width and height) of the high resolution scenes in pixels.")
+    parser.add_argument("--bands", type=int, nargs="+",
+                        help="Numbers of high resolution bands.")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of times each stage is run. The fastest run is reported.")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="Path of the JSON results file.")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Compare two JSON results files instead of running benchmarks.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compareResults(*args.compare)
+        sys.exit(0)
+
+    sizes = args.sizes or PRESETS[args.preset]["sizes"]
+    bandsList = args.bands or PRESETS[args.preset]["bands"]
+    results = runBenchmarks(sizes, bandsList, args.repeat)
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("Results saved to " + args.output)
@@ -0,0 +1,300 @@
+"""
+Command line interface for running batches of pyDMS sharpening jobs described in a
+JSON or YAML job file.
+
+Each job trains one sharpener on its high- and low-resolution file pairs and then
+sharpens, performs the residual analysis and saves the outputs of its scenes. For
+example:
+
+    {"workers": 2,
+     "tileSize": 2000,
+     "jobs": [{"name": "33UUB_20230601",
+               "sharpener": "DecisionTreeSharpener",
+               "highResFiles": ["S2_20230601.tif"],
+               "lowResFiles": ["S3_20230601.tif"],
+               "lowResQualityFiles": ["S3_20230601_mask.tif"],
+               "lowResGoodQualityFlags": [255],
+               "options": {"movingWindowSize": 15,
+                           "disaggregatingTemperature": true},
+               "outputs": ["LST_20230601.tif"]}]}
+
+Unless "scenes" are given, each training pair is sharpened into the corresponding
+"outputs" file. "scenes" is a list of {"highResFile", "lowResFile",
+"lowResQualityFile" (optional), "output"} objects of other scenes to sharpen with the
+trained sharpener. "workers", "tileSize" and "memoryBudget" can also be given on the
+command line, which takes precedence over the job file.
+
+The memory budget is shared equally by the parallel jobs. Unless a tile size or
+"aggregationStripRows" option is given, each job reads and aggregates its high
+resolution images in strips, and sharpens them in tiles, sized to keep the high
+resolution arrays within its share. The trained regressions and the low resolution
+images are not counted.
+
+Run as:
+
+    pydms jobs.yaml --workers 4 --memory-budget 16GB
+"""
+
+import argparse
+import functools
+import json
+import logging
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from osgeo import gdal
+
+import pyDMS.pyDMSUtils as utils
+from pyDMS.pyDMS import CubistSharpener, DecisionTreeSharpener, NeuralNetworkSharpener
+
+log = logging.getLogger(__name__)
+
+SHARPENERS = {"DecisionTreeSharpener": DecisionTreeSharpener,
+              "CubistSharpener": CubistSharpener,
+              "NeuralNetworkSharpener": NeuralNetworkSharpener}
+
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+
+# Approximate number of values, in addition to the high resolution bands, held in
+# memory per high resolution pixel while sharpening (local and global predictions,
+# weights, output and masks)
+ARRAYS_PER_PIXEL = 8
+
+
+# Read a JSON or (if PyYAML is installed) YAML job file
+def readJobFile(filename):
+    with open(filename, "r") as fp:
+        if os.path.splitext(filename)[1].lower() in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ImportError("PyYAML is required to read YAML job files. Install it "
+                                  "or use a JSON job file.") from e
+            try:
+                config = yaml.safe_load(fp)
+            except yaml.YAMLError as e:
+                raise ValueError(f"Invalid YAML: {e}") from e
+        else:
+            config = json.load(fp)
+    if not isinstance(config, dict) or not isinstance(config.get("jobs"), list):
+        raise TypeError("The job file must contain a list of jobs under the \"jobs\" key")
+    return config
+
+
+# Parse a memory size given as number of bytes or a string such as "512MB" or "16 GB"
+def parseMemorySize(size):
+    if size is None or isinstance(size, (int, float)):
+        return size
+    size = size.strip().upper().replace(" ", "")
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(size)
+
+
+# Number of high resolution pixels of the scene whose arrays fit in the memory budget
+def maxPixelsForMemoryBudget(scene, memoryBudget, dtype="float64"):
+    bytesPerPixel = (scene.RasterCount + ARRAYS_PER_PIXEL) * np.dtype(dtype).itemsize
+    maxPixels = int(memoryBudget // bytesPerPixel)
+    if maxPixels < 1:
+        raise ValueError(f"The memory budget of {memoryBudget} bytes is too small to hold "
+                         "a pixel")
+    return maxPixels
+
+
+# Largest square tile size (in high resolution pixels) which keeps the arrays of
+# applySharpener and residualAnalysis within the memory budget, or None if the whole
+# image fits
+def tileSizeForMemoryBudget(highResFilename, memoryBudget, dtype="float64"):
+    scene = gdal.Open(highResFilename)
+    pixels = scene.RasterXSize * scene.RasterYSize
+    maxPixels = maxPixelsForMemoryBudget(scene, memoryBudget, dtype)
+    scene = None
+    if pixels <= maxPixels:
+        return None
+    return int(math.sqrt(maxPixels))
+
+
+# Largest number of low resolution rows whose high resolution strip, read while
+# aggregating the high resolution image, fits in the memory budget, or None if the
+# whole image fits
+def stripRowsForMemoryBudget(highResFilename, lowResFilename, memoryBudget, dtype="float64"):
+    scene = gdal.Open(highResFilename)
+    xSize = scene.RasterXSize
+    ySize = scene.RasterYSize
+    maxPixels = maxPixelsForMemoryBudget(scene, memoryBudget, dtype)
+    scene = None
+    if xSize * ySize <= maxPixels:
+        return None
+    gt_HR = utils.getRasterInfo(highResFilename)[1]
+    gt_LR = utils.getGridAlignment(highResFilename, lowResFilename).gt_LR
+    rowsPerPixel_LR = max(1.0, abs(gt_LR[5] / gt_HR[5]))
+    stripRows = int(maxPixels / xSize / rowsPerPixel_LR)
+    if stripRows < 1:
+        raise ValueError(f"The memory budget of {memoryBudget} bytes is too small to hold "
+                         f"one low resolution row of {highResFilename}")
+    return stripRows
+
+
+def jobName(job):
+    return job.get("name", (job.get("highResFiles") or ["unnamed job"])[0])
+
+
+# List the (highResFilename, lowResFilename, lowResQualityFilename) tuples and the
+# output filenames of the scenes of a job
+def jobScenes(job):
+    if "scenes" in job:
+        pairs = [(scene["highResFile"], scene["lowResFile"], scene.get("lowResQualityFile"))
+                 for scene in job["scenes"]]
+        outputs = [scene["output"] for scene in job["scenes"]]
+    else:
+        outputs = job.get("outputs", [])
+        if len(outputs) != len(job["highResFiles"]):
+            raise ValueError("Each training pair must have an output file if no scenes are given")
+        qualityFiles = job.get("lowResQualityFiles") or [None] * len(outputs)
+        pairs = list(zip(job["highResFiles"], job["lowResFiles"], qualityFiles))
+    return pairs, outputs
+
+
+# Train the sharpener of one job and sharpen its scenes. Returns the job timing.
+def runJob(job, tileSize=None, memoryBudget=None):
+    name = jobName(job)
+    timing = {"name": name}
+    start = time.time()
+    try:
+        sharpenerClass = SHARPENERS[job.get("sharpener", "DecisionTreeSharpener")]
+    except KeyError:
+        raise ValueError(f"Unknown sharpener {job['sharpener']}. Must be one of "
+                         f"{', '.join(SHARPENERS)}") from None
+    opts = dict(job.get("options", {}))
+    for key in ("lowResQualityFiles", "lowResGoodQualityFlags"):
+        if key in job:
+            opts[key] = job[key]
+    pairs, outputs = jobScenes(job)
+    doCorrection = job.get("doCorrection", True)
+    tileSize = job.get("tileSize", tileSize)
+    if memoryBudget is not None:
+        dtype = opts.get("dtype", "float64")
+        # The smallest tile size and strip height needed by any of the scenes
+        if tileSize is None:
+            tileSizes = [tileSizeForMemoryBudget(pair[0], memoryBudget, dtype) for pair in pairs]
+            tileSizes = [size for size in tileSizes if size is not None]
+            if tileSizes:
+                tileSize = min(tileSizes)
+        if opts.get("aggregationStripRows") is None:
+            scenes = list(zip(job["highResFiles"], job["lowResFiles"])) + \
+                [pair[:2] for pair in pairs]
+            stripRows = [stripRowsForMemoryBudget(highRes, lowRes, memoryBudget, dtype)
+                         for highRes, lowRes in scenes]
+            stripRows = [rows for rows in stripRows if rows is not None]
+            if stripRows:
+                opts["aggregationStripRows"] = min(stripRows)
+
+    for output in outputs:
+        outDir = os.path.dirname(os.path.abspath(output))
+        os.makedirs(outDir, exist_ok=True)
+
+    sharpener = sharpenerClass(job["highResFiles"], job["lowResFiles"], **opts)
+    log.info("%s: training %s", name, sharpenerClass.__name__)
+    sharpener.trainSharpener()
+    timing["training"] = time.time() - start
+
+    step = time.time()
+    summary = sharpener.sharpenSeries(pairs, outputs, doCorrection=doCorrection,
+                                      tileSize=tileSize)
+    timing["sharpening"] = time.time() - step
+    timing["scenes"] = summary
+    timing["total"] = time.time() - start
+    return timing
+
+
+# Run the jobs, in parallel if workers is larger than 1. Returns the timing of
+# the finished jobs and the names and error messages of the failed jobs.
+def runJobs(jobs, workers=1, tileSize=None, memoryBudget=None):
+    finished = []
+    failed = []
+    # Each of the parallel jobs gets an equal share of the memory budget
+    if memoryBudget is not None:
+        memoryBudget = memoryBudget // max(workers, 1)
+
+    def collect(job, getTiming):
+        name = jobName(job)
+        try:
+            timing = getTiming()
+        except Exception as e:
+            # Any error only fails its own job
+            log.exception("%s: failed", name)
+            failed.append({"name": name, "error": f"{type(e).__name__}: {e}"})
+            return
+        log.info("%s: training %.1f s, sharpening %.1f s, total %.1f s",
+                 name, timing["training"], timing["sharpening"], timing["total"])
+        finished.append(timing)
+
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=utils.processContext) as executor:
+            futures = {executor.submit(runJob, job, tileSize, memoryBudget): job
+                       for job in jobs}
+            for future in as_completed(futures):
+                collect(futures[future], future.result)
+    else:
+        for job in jobs:
+            collect(job, functools.partial(runJob, job, tileSize, memoryBudget))
+
+    return finished, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="pydms",
+        description="Run pyDMS sharpening jobs described in a JSON or YAML job file.")
+    parser.add_argument("jobFile", help="Path of the JSON or YAML job file.")
+    parser.add_argument("--workers", type=int,
+                        help="Number of jobs run in parallel processes (default: 1).")
+    parser.add_argument("--tile-size", type=int,
+                        help="Sharpen the high resolution images in tiles of this size "
+                             "(in pixels) to bound the memory use.")
+    parser.add_argument("--memory-budget",
+                        help="Total memory available to the jobs (e.g. 16GB). Used to "
+                             "choose the tile size and aggregation strip height if they "
+                             "are not given.")
+    parser.add_argument("--summary",
+                        help="Path of a JSON file to which the timing of the jobs is saved.")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging level (default: INFO).")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+    try:
+        config = readJobFile(args.jobFile)
+        workers = args.workers or config.get("workers", 1)
+        tileSize = args.tile_size or config.get("tileSize")
+        memoryBudget = parseMemorySize(args.memory_budget or config.get("memoryBudget"))
+    except (OSError, ValueError, TypeError, ImportError) as e:
+        log.error("Could not read the job file %s: %s", args.jobFile, e)
+        return 2
+
+    start = time.time()
+    finished, failed = runJobs(config["jobs"], workers, tileSize, memoryBudget)
+    log.info("%d of %d jobs finished in %.1f s", len(finished), len(config["jobs"]),
+             time.time() - start)
+
+    if args.summary:
+        with open(args.summary, "w") as fp:
+            json.dump({"finished": finished, "failed": failed}, fp, indent=2)
+
+    if failed:
+        log.error("Failed jobs: %s", ", ".join(job["name"] for job in failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Lazy, chunk-wise application of trained sharpeners to xarray rasters backed by dask.
+
+The high-resolution raster is a (band, y, x) DataArray with pixel centre coordinates
+(e.g. as opened by rioxarray) chunked along y and x. The sharpener is applied to each
+chunk with dask map_blocks: the local (moving window) regressions overlapping a chunk
+and the global regression are predicted within it and, if low-resolution data is
+given, combined with weights derived from the residuals of both regressions to the
+low-resolution data. The residuals are aggregated to low-resolution pixels from
+partial sums of each chunk, so that no more than a few chunks need to be held in
+memory at once, at the cost of predicting the chunks twice. The computation is
+scheduled by dask, e.g.:
+
+    with dask.config.set(scheduler="processes"):
+        sharpened = sharpenDataArray(sharpener, highRes, lowRes).compute()
+"""
+
+import numpy as np
+
+try:
+    import dask
+    import dask.array as da
+    import xarray as xr
+except ImportError as e:
+    raise ImportError("xarray and dask are required for sharpening xarray rasters. Install "
+                      "them with: pip install python-dms[xarray]") from e
+
+import pyDMS.pyDMSUtils as utils
+
+
+# GDAL geotransform of a DataArray from its rioxarray transform or else from its
+# regularly spaced x and y pixel centre coordinates, which then need at least two
+# pixels along each axis
+def geotransformFromCoords(dataArray):
+    try:
+        return tuple(float(value) for value in dataArray.rio.transform().to_gdal())
+    except (AttributeError, RuntimeError):
+        pass
+    x = dataArray["x"].values
+    y = dataArray["y"].values
+    if x.size < 2 or y.size < 2:
+        raise ValueError("The resolution of a raster with a single pixel row or column can "
+                         "not be derived from its coordinates. Set its transform with "
+                         "rioxarray (rio.write_transform).")
+    xRes = (x[-1] - x[0]) / (x.size - 1)
+    yRes = (y[-1] - y[0]) / (y.size - 1)
+    return (float(x[0] - xRes/2), float(xRes), 0.0, float(y[0] - yRes/2), 0.0, float(yRes))
+
+
+# Projection (WKT) of a DataArray from its rioxarray CRS or "crs" attribute, or
+# None if it is not known
+def projectionOf(dataArray):
+    try:
+        crs = dataArray.rio.crs
+    except AttributeError:
+        crs = None
+    if crs is not None:
+        return crs.to_wkt()
+    return dataArray.attrs.get("crs")
+
+
+def sharpenDataArray(sharpener, highRes, lowRes=None, projection=None,
+                     lowResProjection=None):
+    ''' Lazily apply a trained sharpener to a chunked high-resolution raster.
+
+    Parameters
+    ----------
+    sharpener: DecisionTreeSharpener, CubistSharpener or NeuralNetworkSharpener
+        The trained sharpener.
+
+    highRes: xarray.DataArray
+        High-resolution (band, y, x) data, with NaN marking missing values,
+        chunked along y and x. Chunks spanning all the bands are used.
+
+    lowRes: xarray.DataArray (optional, default: None)
+        Low-resolution (y, x) or (band, y, x) data, of which the first band is used
+        to combine the local and global regressions (see applySharpener). It is
+        loaded into memory.
+
+    projection: string (optional, default: None)
+        Projection of the high-resolution data. If not given it is taken from the
+        rioxarray CRS or the "crs" attribute of highRes. Only needed if lowRes is
+        given.
+
+    lowResProjection: string (optional, default: None)
+        Projection of the low-resolution data, by default taken from lowRes in the
+        same way or else assumed to be the same as of the high-resolution data.
+
+    Returns
+    -------
+    sharpened: xarray.DataArray
+        Lazy (y, x) disaggregated data with the coordinates of highRes.
+    '''
+
+    gt = geotransformFromCoords(highRes)
+    ysize = highRes.sizes["y"]
+    xsize = highRes.sizes["x"]
+    data = highRes.transpose("band", "y", "x").data
+    if not isinstance(data, da.Array):
+        data = da.from_array(data, chunks=(-1, "auto", "auto"))
+    data = data.rechunk({0: -1})
+
+    windows = sharpener._windowPixelExtents(gt, xsize, ysize)
+    # The sharpener is put into the graph once and shared by all the chunks
+    sharpenerKey = dask.delayed(sharpener)
+
+    ww_LR = None
+    gt_LR = None
+    if windows and lowRes is not None:
+        if lowRes.ndim == 3:
+            lowRes = lowRes.transpose("band", "y", "x")[0]
+        projection = projection or projectionOf(highRes)
+        lowResProjection = lowResProjection or projectionOf(lowRes) or projection
+        gt_LR, data_LR = sharpener._subsetLowResArrays(gt, projection, xsize, ysize,
+                                                       (np.asarray(lowRes.values),
+                                                        geotransformFromCoords(lowRes),
+                                                        lowResProjection))
+
+        # Aggregate the local and global predictions of each chunk to the low res
+        # pixels overlapping it and sum the partial aggregates of all the chunks
+        partialSums = da.map_blocks(_lowResPartialSums, data, sharpener=sharpenerKey, gt=gt,
+                                    windows=windows, gt_LR=gt_LR, shape_LR=data_LR.shape,
+                                    drop_axis=0, chunks=(1, 1), dtype=object)
+        ww_LR = dask.delayed(_windowWeights)(sharpenerKey,
+                                             partialSums.to_delayed().ravel().tolist(),
+                                             data_LR)
+
+    sharpened = da.map_blocks(_sharpenChunk, data, sharpener=sharpenerKey, gt=gt,
+                              windows=windows, ww_LR=ww_LR, gt_LR=gt_LR, drop_axis=0,
+                              dtype=np.dtype(sharpener.dtype))
+
+    return xr.DataArray(sharpened, coords={"y": highRes["y"], "x": highRes["x"]},
+                        dims=("y", "x"), attrs=highRes.attrs)
+
+
+def _predictChunk(block, sharpener, gt, windows, block_info):
+    # Predict the local and global regressions within one (band, y, x) chunk
+    y0 = block_info[0]["array-location"][1][0]
+    x0 = block_info[0]["array-location"][2][0]
+    inData = np.moveaxis(block, 0, -1).astype(sharpener.dtype)
+    validPix = ~np.any(np.isnan(inData), -1)
+    outWindowData, outFullData = sharpener._predictTile(inData, validPix, windows, x0, y0)
+    return validPix, outWindowData, outFullData, y0, x0
+
+
+def _lowResPartialSums(block, sharpener=None, gt=None, windows=None, gt_LR=None,
+                       shape_LR=None, block_info=None):
+    validPix, outWindowData, outFullData, y0, x0 = _predictChunk(block, sharpener, gt,
+                                                                 windows, block_info)
+    ny, nx = validPix.shape
+
+    # Low res pixels overlapping the chunk and their footprints clipped to it
+    yMin, yMax, xMin, xMax = utils.footprintIndices(gt, gt_LR, shape_LR[1], shape_LR[0])
+    rows = np.flatnonzero((yMin < y0 + ny) & (yMax > y0))
+    cols = np.flatnonzero((xMin < x0 + nx) & (xMax > x0))
+    yMin = np.clip(yMin[rows] - y0, 0, ny)
+    yMax = np.clip(yMax[rows] - y0, 0, ny)
+    xMin = np.clip(xMin[cols] - x0, 0, nx)
+    xMax = np.clip(xMax[cols] - x0, 0, nx)
+
+    # Sums and numbers of valid pixels of the predictions within each footprint,
+    # (raised to the same exponent as in _residualToLowRes)
+    exponent = 4 if sharpener.disaggregatingTemperature else 1
+    stacked = np.stack([outWindowData**exponent, outFullData**exponent,
+                        ~np.isnan(outWindowData), ~np.isnan(outFullData)], -1)
+    mean, _ = utils.aggregateFootprints(stacked.astype(np.float64), yMin, yMax, xMin, xMax)
+    area = (yMax - yMin)[:, np.newaxis] * (xMax - xMin)[np.newaxis, :]
+    counts = mean[:, :, 2:] * area[:, :, np.newaxis]
+    sums = np.nan_to_num(mean[:, :, :2]) * counts
+
+    partial = np.empty((1, 1), dtype=object)
+    partial[0, 0] = (rows, cols, sums, counts)
+    return partial
+
+
+def _windowWeights(sharpener, partialSums, data_LR):
+    # Sum the partial aggregates of the chunks and derive the weights of the local
+    # regressions from the residuals to the low res data
+    sums = np.zeros(data_LR.shape + (2,))
+    counts = np.zeros(data_LR.shape + (2,))
+    for partial in partialSums:
+        rows, cols, chunkSums, chunkCounts = partial[0, 0]
+        sums[np.ix_(rows, cols)] += chunkSums
+        counts[np.ix_(rows, cols)] += chunkCounts
+    exponent = 4 if sharpener.disaggregatingTemperature else 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        resMean = (sums / counts)**(1.0/exponent)
+    windowedResidual_LR = data_LR - resMean[:, :, 0]
+    fullResidual_LR = data_LR - resMean[:, :, 1]
+    return sharpener._windowWeights(windowedResidual_LR, fullResidual_LR)
+
+
+def _sharpenChunk(block, sharpener=None, gt=None, windows=None, ww_LR=None, gt_LR=None,
+                  block_info=None):
+    validPix, outWindowData, outFullData, y0, x0 = _predictChunk(block, sharpener, gt,
+                                                                 windows, block_info)
+    ny, nx = validPix.shape
+
+    # Combine the windowed and whole image regressions as in applySharpener
+    if outWindowData is None:
+        outData = outFullData
+    elif ww_LR is not None:
+        ww = utils.resampleLowResArrayToHighRes(ww_LR, gt_LR, gt, x0, y0, nx, ny)
+        outData = sharpener._combineRegressions(outWindowData, outFullData, ww)
+    else:
+        outData = outWindowData
+    outData[~validPix] = np.nan
+    return outData.astype(sharpener.dtype, copy=False)
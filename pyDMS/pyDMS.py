@@ -4,21 +4,56 @@
 Copyright: (C) 2017, Radoslaw Guzinski
 """
 
+import contextlib
+import copy
+import json
+import logging
 import math
 import os
-from multiprocessing import Pool
-
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import resource_tracker, shared_memory
+
+import numba
 import numpy as np
+from numba import njit, prange
 from osgeo import gdal
-from sklearn import tree, linear_model, ensemble, preprocessing
+from sklearn import tree, ensemble, preprocessing
+from sklearn.exceptions import ConvergenceWarning
 import sklearn.neural_network as ann_sklearn
 
 import pyDMS.pyDMSUtils as utils
 
+log = logging.getLogger(__name__)
 
 REG_sknn_ann = 0
 REG_sklearn_ann = 1
 
+# The workqueue threading layer of numba can not be entered by several threads at once,
+# so with it (or before the threading layer is chosen by the first kernel call) threads
+# calling the compiled prediction kernels concurrently take turns running them. The TBB
+# and OpenMP layers are thread-safe and run concurrent calls without the lock.
+_kernelLock = threading.Lock()
+
+
+def _kernelGuard():
+    ''' Private function. Returns the context in which the compiled kernels are called.
+    '''
+
+    try:
+        layer = numba.threading_layer()
+    except ValueError:
+        return _kernelLock
+    if layer == "workqueue":
+        return _kernelLock
+    return contextlib.nullcontext()
+
 
 class DecisionTreeRegressorWithLinearLeafRegression(tree.DecisionTreeRegressor):
     ''' Decision tree regressor with added linear (ridge) regression
@@ -81,16 +116,30 @@ class DecisionTreeRegressorWithLinearLeafRegression(tree.DecisionTreeRegressor):
                                                                        **fitOpt)
 
         # Create a linear regression for all input points which fall into
-        # one output leaf
-        predictedValues = super(DecisionTreeRegressorWithLinearLeafRegression, self).predict(X)
-        leafValues = np.unique(predictedValues)
-        for value in leafValues:
-            ind = predictedValues == value
-            leafLinearRegrsion = linear_model.Ridge()
-            leafLinearRegrsion.fit(X[ind, :], y[ind])
-            self.leafParameters[value] = {"linearRegression": leafLinearRegrsion,
-                                          "max": np.max(y[ind]),
-                                          "min": np.min(y[ind])}
+        # one output leaf. Leaves are identified by their node id so that the
+        # regression parameters can be stored in dense arrays indexed by it.
+        leaves = self.apply(X)
+        leafIds, leafCoef, leafIntercept, leafYMax, leafYMin = \
+            _fitGroupedRidge(np.asarray(X, dtype=np.float64),
+                             np.asarray(y, dtype=np.float64),
+                             leaves)
+        coef = np.zeros((self.tree_.node_count, leafCoef.shape[1]))
+        coef[leafIds, :] = leafCoef
+        intercept = np.zeros(self.tree_.node_count)
+        intercept[leafIds] = leafIntercept
+        leafMax = np.zeros(self.tree_.node_count)
+        leafMax[leafIds] = leafYMax
+        leafMin = np.zeros(self.tree_.node_count)
+        leafMin[leafIds] = leafYMin
+
+        # Limit extrapolation
+        extrapolationRange = self.linearRegressionExtrapolationRatio * (leafMax - leafMin)
+        self.leafParameters = {"coef": coef,
+                               "intercept": intercept,
+                               "max": leafMax,
+                               "min": leafMin,
+                               "upperBound": leafMax + extrapolationRange,
+                               "lowerBound": leafMin - extrapolationRange}
 
         return self
 
@@ -115,26 +164,226 @@ class DecisionTreeRegressorWithLinearLeafRegression(tree.DecisionTreeRegressor):
             The predicted classes, or the predict values.
         '''
 
-        # Do normal regression tree prediction
-        y = super(DecisionTreeRegressorWithLinearLeafRegression, self).predict(X, **predictOpt)
-
-        # And also apply per-leaf linear regression
-        for leafValue in self.leafParameters.keys():
-            ind = y == leafValue
-            if X[ind, :].size > 0:
-                y[ind] = self.leafParameters[leafValue]["linearRegression"].predict(X[ind, :])
-                # Limit extrapolation
-                extrapolationRange = self.linearRegressionExtrapolationRatio * (
-                                        self.leafParameters[leafValue]["max"] -
-                                        self.leafParameters[leafValue]["min"])
-                y[ind] = np.maximum(y[ind],
-                                    self.leafParameters[leafValue]["min"] - extrapolationRange)
-                y[ind] = np.minimum(y[ind],
-                                    self.leafParameters[leafValue]["max"] + extrapolationRange)
+        # Find the leaf into which each sample falls and apply the per-leaf
+        # linear regression in one pass
+        leaves = self.apply(X, **predictOpt)
+        with _kernelGuard():
+            y = _predictLeafLinearRegression(np.asarray(X),
+                                             leaves,
+                                             self.leafParameters["coef"],
+                                             self.leafParameters["intercept"],
+                                             self.leafParameters["lowerBound"],
+                                             self.leafParameters["upperBound"])
 
         return y
 
 
+def _fitGroupedRidge(X, y, groups, alpha=1.0):
+    ''' Private function. Fits a separate ridge regression (equivalent to
+    sklearn.linear_model.Ridge(alpha) with intercept) to the samples of each
+    group. The centred normal equations of all the groups are accumulated
+    in one pass over the samples and then solved as a batch.
+    '''
+
+    # Sort the samples by group so that each group is a contiguous block
+    order = np.argsort(groups, kind="stable")
+    X = X[order, :]
+    y = y[order]
+    groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    counts = np.diff(np.r_[starts, groups.size])
+
+    xMean = np.add.reduceat(X, starts, axis=0) / counts[:, np.newaxis]
+    yMean = np.add.reduceat(y, starts) / counts
+    Xc = X - np.repeat(xMean, counts, axis=0)
+    yc = y - np.repeat(yMean, counts)
+
+    XtX = np.add.reduceat(Xc[:, :, np.newaxis] * Xc[:, np.newaxis, :], starts, axis=0)
+    XtX += alpha * np.eye(X.shape[1])
+    Xty = np.add.reduceat(Xc * yc[:, np.newaxis], starts, axis=0)
+    coef = np.linalg.solve(XtX, Xty[:, :, np.newaxis])[:, :, 0]
+    intercept = yMean - np.sum(xMean * coef, axis=1)
+
+    return (groups[starts], coef, intercept, np.maximum.reduceat(y, starts),
+            np.minimum.reduceat(y, starts))
+
+
+@njit(parallel=True)
+def _predictLeafLinearRegression(X, leaves, coef, intercept, lowerBound, upperBound):
+    y = np.empty(X.shape[0])
+    for i in prange(X.shape[0]):
+        leaf = leaves[i]
+        value = intercept[leaf]
+        for j in range(X.shape[1]):
+            value += X[i, j] * coef[leaf, j]
+        y[i] = min(max(value, lowerBound[leaf]), upperBound[leaf])
+    return y
+
+
+class CompiledTreeEnsemble:
+    ''' Flat-array representation of a trained bagging ensemble of
+    regression trees (with or without per-leaf linear regression) which is
+    evaluated by a single compiled kernel. All estimators are traversed and
+    averaged for each sample in one pass, without creating per-estimator
+    temporary arrays. The output is equal to that of the original
+    BaggingRegressor within floating point tolerance.
+
+    Parameters
+    ----------
+    feature: array, shape = [n_nodes]
+        Index of the input feature used in the split of each node.
+
+    threshold: array, shape = [n_nodes]
+        Split threshold of each node.
+
+    childrenLeft: array, shape = [n_nodes]
+        Index of the left child of each node or -1 for leaves.
+
+    childrenRight: array, shape = [n_nodes]
+        Index of the right child of each node or -1 for leaves.
+
+    roots: array, shape = [n_estimators]
+        Index of the root node of each estimator.
+
+    coef: array, shape = [n_nodes, n_features]
+        Linear regression coefficients of each leaf node.
+
+    intercept: array, shape = [n_nodes]
+        Linear regression intercept of each leaf node.
+
+    lowerBound: array, shape = [n_nodes]
+        Minimum value allowed in the output of each leaf node.
+
+    upperBound: array, shape = [n_nodes]
+        Maximum value allowed in the output of each leaf node.
+
+    Returns
+    -------
+    None
+    '''
+    def __init__(self, feature, threshold, childrenLeft, childrenRight, roots, coef, intercept,
+                 lowerBound, upperBound):
+        self.feature = feature
+        self.threshold = threshold
+        self.childrenLeft = childrenLeft
+        self.childrenRight = childrenRight
+        self.roots = roots
+        self.coef = coef
+        self.intercept = intercept
+        self.lowerBound = lowerBound
+        self.upperBound = upperBound
+
+    @classmethod
+    def fromBaggingRegressor(cls, reg):
+        ''' Export a trained BaggingRegressor of DecisionTreeRegressor or
+        DecisionTreeRegressorWithLinearLeafRegression estimators to flat arrays.
+
+        Parameters
+        ----------
+        reg: BaggingRegressor
+            The trained ensemble.
+
+        Returns
+        -------
+        compiled: CompiledTreeEnsemble
+            The flat-array representation of the ensemble.
+        '''
+
+        nFeatures = reg.n_features_in_
+        feature = []
+        threshold = []
+        childrenLeft = []
+        childrenRight = []
+        roots = []
+        coef = []
+        intercept = []
+        lowerBound = []
+        upperBound = []
+        offset = 0
+        for estimator, features in zip(reg.estimators_, reg.estimators_features_):
+            estimatorTree = estimator.tree_
+            nodeCount = estimatorTree.node_count
+            isLeaf = estimatorTree.children_left == -1
+            roots.append(offset)
+            # Node and feature indices are converted to be global within the
+            # ensemble
+            feature.append(np.where(isLeaf, 0, features[np.maximum(estimatorTree.feature, 0)]))
+            threshold.append(estimatorTree.threshold)
+            childrenLeft.append(np.where(isLeaf, -1, estimatorTree.children_left + offset))
+            childrenRight.append(np.where(isLeaf, -1, estimatorTree.children_right + offset))
+            nodeCoef = np.zeros((nodeCount, nFeatures))
+            if isinstance(estimator, DecisionTreeRegressorWithLinearLeafRegression):
+                nodeCoef[:, features] = estimator.leafParameters["coef"]
+                intercept.append(estimator.leafParameters["intercept"])
+                lowerBound.append(estimator.leafParameters["lowerBound"])
+                upperBound.append(estimator.leafParameters["upperBound"])
+            else:
+                intercept.append(estimatorTree.value[:, 0, 0])
+                lowerBound.append(np.full(nodeCount, -np.inf))
+                upperBound.append(np.full(nodeCount, np.inf))
+            coef.append(nodeCoef)
+            offset = offset + nodeCount
+
+        return cls(np.concatenate(feature).astype(np.int64),
+                   np.concatenate(threshold).astype(np.float64),
+                   np.concatenate(childrenLeft).astype(np.int64),
+                   np.concatenate(childrenRight).astype(np.int64),
+                   np.array(roots, dtype=np.int64),
+                   np.concatenate(coef),
+                   np.concatenate(intercept).astype(np.float64),
+                   np.concatenate(lowerBound).astype(np.float64),
+                   np.concatenate(upperBound).astype(np.float64))
+
+    def predict(self, X):
+        ''' Predict regression value for X.
+
+        Parameters
+        ----------
+        X: array-like of shape = [n_samples, n_features]
+            The input samples.
+
+        Returns
+        -------
+        y: array of shape = [n_samples]
+            The predicted values averaged over all the estimators.
+        '''
+
+        X = np.ascontiguousarray(X)
+        with _kernelGuard():
+            return _predictTreeEnsemble(X,
+                                        self.feature,
+                                        self.threshold,
+                                        self.childrenLeft,
+                                        self.childrenRight,
+                                        self.roots,
+                                        self.coef,
+                                        self.intercept,
+                                        self.lowerBound,
+                                        self.upperBound)
+
+
+@njit(parallel=True)
+def _predictTreeEnsemble(X, feature, threshold, childrenLeft, childrenRight, roots, coef,
+                         intercept, lowerBound, upperBound):
+    y = np.empty(X.shape[0])
+    for i in prange(X.shape[0]):
+        total = 0.0
+        for root in roots:
+            node = root
+            # Decision trees compare the features in single precision
+            while childrenLeft[node] != -1:
+                if np.float32(X[i, feature[node]]) <= threshold[node]:
+                    node = childrenLeft[node]
+                else:
+                    node = childrenRight[node]
+            value = intercept[node]
+            for j in range(X.shape[1]):
+                value += X[i, j] * coef[node, j]
+            total += min(max(value, lowerBound[node]), upperBound[node])
+        y[i] = total / roots.size
+    return y
+
+
 class DecisionTreeSharpener(object):
     ''' Decision tree based sharpening (disaggregation) of low-resolution
     images using high-resolution images. The implementation is mostly based on [Gao2012].
@@ -217,6 +466,58 @@ class DecisionTreeSharpener(object):
         http://scikit-learn.org/stable/modules/generated/sklearn.ensemble.BaggingRegressor.html
         for possibilities.
 
+    compiledPredictor: boolean (optional, default: False)
+        Flag indicating whether the trained regression tree ensembles should be
+        exported to flat arrays (see CompiledTreeEnsemble) and evaluated with a
+        compiled parallel kernel instead of the scikit-learn predict functions.
+
+    n_jobs: int (optional, default: 1)
+        Number of parallel processes to use for fitting the local (moving window)
+        and global regressions and number of workers used to apply them to the
+        moving windows in applySharpener.
+
+    predictionExecutor: string (optional, default: "threads")
+        Whether the moving windows are predicted concurrently by "threads",
+        which share the trained regressions and the output arrays, or by
+        "processes", which receive a copy of the trained regressions when they
+        are started. Only used if n_jobs is larger than 1. The compiled
+        kernels used for prediction with perLeafLinearRegression or
+        compiledPredictor already run on all the cores, so in that case the
+        windows are not predicted by threads but one after the other; threads
+        benefit the other regressions (e.g. NeuralNetworkSharpener).
+
+    aggregationStripRows: int (optional, default: None)
+        If given, high-resolution images are read and aggregated to low resolution
+        in horizontal strips of this many low-resolution pixel rows, so that only
+        one strip needs to be held in memory. Otherwise whole images are read at once.
+
+    cacheDir: string (optional, default: None)
+        If given, the reprojected low-resolution data, quality masks and aggregated
+        high-resolution statistics prepared during training are cached in this
+        directory, keyed by the identity of the input files, and reused by later
+        training runs with the same inputs.
+
+    cacheMaxBytes: int (optional, default: 10 GB)
+        Maximum size of the cache directory. Least recently used entries are
+        removed when it is exceeded.
+
+    dtype: string (optional, default: "float64")
+        Floating point data type ("float64" or "float32") in which the
+        high-resolution data, predictions, residuals and weights are held while
+        sharpening. "float32" halves the memory use and the output is saved as
+        float32 in either case.
+
+    metricsCallback: function (optional, default: None)
+        Function called with a dictionary of metrics after each processing stage:
+        "reprojection", "aggregation" and "sampleSelection" of each training scene,
+        "fit" and "predict" of each moving window, "combination" of the local and
+        global predictions, "residual" analysis and "write" of the sharpenSeries
+        outputs. The dictionary contains the stage name ("stage"), its wall time in
+        seconds ("wallTime"), the peak resident set size of the process in bytes
+        ("peakRSS", None if not available) and the number of processed pixels
+        ("pixels") or training samples ("samples"). The metrics are also logged at
+        DEBUG level.
+
     Returns
     -------
     None
@@ -240,7 +541,15 @@ class DecisionTreeSharpener(object):
                  perLeafLinearRegression=True,
                  linearRegressionExtrapolationRatio=0.25,
                  regressorOpt={},
-                 baggingRegressorOpt={}):
+                 baggingRegressorOpt={},
+                 compiledPredictor=False,
+                 n_jobs=1,
+                 predictionExecutor="threads",
+                 aggregationStripRows=None,
+                 cacheDir=None,
+                 cacheMaxBytes=10*1024**3,
+                 dtype="float64",
+                 metricsCallback=None):
 
         self.highResFiles = highResFiles
         self.lowResFiles = lowResFiles
@@ -290,6 +599,14 @@ class DecisionTreeSharpener(object):
 
         self.regressorOpt = regressorOpt
         self.baggingRegressorOpt = baggingRegressorOpt
+        self.compiledPredictor = compiledPredictor
+        self.n_jobs = n_jobs
+        self.predictionExecutor = predictionExecutor
+        self.aggregationStripRows = aggregationStripRows
+        self.cacheDir = cacheDir
+        self.cacheMaxBytes = cacheMaxBytes
+        self.dtype = dtype
+        self.metricsCallback = metricsCallback
 
     def trainSharpener(self):
         ''' Train the sharpener using high- and low-resolution input files
@@ -310,149 +627,294 @@ class DecisionTreeSharpener(object):
         None
         '''
 
-        # Select good data (training samples) from low- and high-resolution
-        # input images.
-        fileNum = 0
-        for highResFile, lowResFile in zip(self.highResFiles, self.lowResFiles):
+        # The input file pairs are prepared one at a time, as they are needed for
+        # selecting the training samples
+        self._fitPreparedScenes(self._prepareTrainingFiles())
 
-            scene_HR = gdal.Open(highResFile)
-            scene_LR = gdal.Open(lowResFile)
+    def fitArrays(self, highResScenes, lowResScenes, lowResQualities=None):
+        ''' Train the sharpener on in-memory high- and low-resolution data instead
+        of the files specified in the constructor (see trainSharpener). The
+        low-resolution data is reprojected and subset to the high-resolution data
+        and the high-resolution data is aggregated to low resolution directly on
+        the arrays.
 
-            # First subset and reproject low res scene to fit with
-            # high res scene
-            subsetScene_LR = utils.reprojectSubsetLowResScene(scene_HR, scene_LR)
-            data_LR = subsetScene_LR.GetRasterBand(1).ReadAsArray()
-            gt_LR = subsetScene_LR.GetGeoTransform()
+        Parameters
+        ----------
+        highResScenes: list of tuples
+            For each scene a (data, geotransform, projection) tuple, where data is
+            a (rows, columns, bands) array of high-resolution data with NaN
+            marking missing values, geotransform is a GDAL geotransform and
+            projection is a WKT (or other pyproj compatible) string.
+
+        lowResScenes: list of tuples
+            For each scene a (data, geotransform, projection) tuple of
+            low-resolution data, where data is a (rows, columns) array.
+
+        lowResQualities: list of arrays (optional, default: None)
+            For each scene the (rows, columns) quality flags on the same grid as
+            the low-resolution data. Pixels with flags in lowResGoodQualityFlags are
+            considered to be of good quality. If not given all low-resolution
+            pixels are considered to be of good quality.
+
+        Returns
+        -------
+        None
+        '''
+
+        if len(highResScenes) != len(lowResScenes):
+            print("There must be matching high resolution data for each low resolution data")
+            raise OSError
+        if lowResQualities is None:
+            lowResQualities = [None] * len(lowResScenes)
+        elif len(lowResQualities) != len(lowResScenes):
+            print("The number of quality arrays must be the same as number of low " +
+                  "resolution arrays")
+            raise OSError
+
+        self._fitPreparedScenes(self._prepareTrainingArrays(highResScene, lowResScene, quality)
+                                for highResScene, lowResScene, quality
+                                in zip(highResScenes, lowResScenes, lowResQualities))
+
+    def _prepareTrainingFiles(self):
+        ''' Private function. Yields the prepared training data (see
+        _prepareTrainingScene) of each pair of input files in turn, taking it from
+        the cache if it was already prepared.
+        '''
 
-            # Do the same with low res quality file (if provided) and flag
-            # pixels which are considered to be of good quality
+        for fileNum, (highResFile, lowResFile) in enumerate(zip(self.highResFiles,
+                                                                self.lowResFiles)):
             if self.useQuality_LR:
-                quality_LR = gdal.Open(self.lowResQualityFiles[fileNum])
-                subsetQuality_LR = utils.reprojectSubsetLowResScene(scene_HR, quality_LR)
-                subsetQualityMask = subsetQuality_LR.GetRasterBand(1).ReadAsArray()
-                qualityPix = np.in1d(subsetQualityMask.ravel(),
-                                     self.lowResGoodQualityFlags).reshape(subsetQualityMask.shape)
-                quality_LR = None
+                qualityFile = self.lowResQualityFiles[fileNum]
             else:
-                qualityPix = np.ones(data_LR.shape).astype(bool)
-
-            # Low resolution pixels with NaN value are always of bad quality
-            qualityPix = np.logical_and(qualityPix, ~np.isnan(data_LR))
-
-            # Then resample high res scene to low res pixel size while
-            # extracting sub-low-res-pixel homogeneity statistics
-            resMean, resStd = utils.resampleHighResToLowRes(scene_HR, subsetScene_LR)
-            resMean[resMean == 0] = 0.000001
-            resCV = np.sum(resStd/resMean, 2) / resMean.shape[2]
-            resCV[np.isnan(resCV)] = 1000
-
-            # Resampled high resolution pixels where at least one "parameter"
-            # is NaN are also of bad quality
-            resNaN = np.any(np.isnan(resMean), -1)
-            qualityPix = np.logical_and(qualityPix, ~resNaN)
-
-            windows = []
-            extents = []
-            # If moving window approach is used (section 2.3 of Gao paper)
-            # then calculate the extent of each sampling window in low
-            # resolution pixels
-            if self.movingWindowSize > 0:
-                for y in range(int(math.ceil(data_LR.shape[0]/self.movingWindowSize))):
-                    for x in range(int(math.ceil(data_LR.shape[1]/self.movingWindowSize))):
-                        windows.append([int(max(y*self.movingWindowSize-self.movingWindowExtension, 0)),
-                                        int(min((y+1)*self.movingWindowSize+self.movingWindowExtension,
-                                                data_LR.shape[0])),
-                                        int(max(x*self.movingWindowSize-self.movingWindowExtension, 0)),
-                                        int(min((x+1)*self.movingWindowSize+self.movingWindowExtension,
-                                                data_LR.shape[1]))])
-                        # Save the extents of this window in projection coordinates as
-                        # UL and LR point coordinates
-                        ul = utils.pix2point([x*self.movingWindowSize, y*self.movingWindowSize],
-                                             gt_LR)
-                        lr = utils.pix2point([(x+1)*self.movingWindowSize,
-                                              (y+1)*self.movingWindowSize],
-                                             gt_LR)
-                        extents.append([ul, lr])
-
-            # And always add the whole extent of low res image to also estimate
-            # the regression tree for the whole image
-            windows.append([0, data_LR.shape[0], 0, data_LR.shape[1]])
-
-            goodData_LR = [None for _ in range(len(windows))]
-            goodData_HR = [None for _ in range(len(windows))]
-            weight = [None for _ in range(len(windows))]
-
-            # For each window extract the good quality low res and high res pixels
-            for i, window in enumerate(windows):
-                rows = slice(window[0], window[1])
-                cols = slice(window[2], window[3])
-                qualityPixWindow = qualityPix[rows, cols]
-                resCVWindow = resCV[rows, cols]
-
-                # Good pixels are those where both low and high resolution data exists
-                goodPix = np.logical_and.reduce((qualityPixWindow,
-                                                 resCVWindow > 0,
-                                                 resCVWindow < 1000))
-                # If number of good pixels is below threshold then do not train a model
-                if np.sum(goodPix) < self.minimumSampleNumber:
-                    goodPix = np.zeros(goodPix.shape).astype(bool)
-
-                if self.autoAdjustCvThreshold:
-                    if ~np.any(goodPix):
-                        self.cvHomogeneityThreshold = 0
-                    else:
-                        self.cvHomogeneityThreshold = np.percentile(resCVWindow[goodPix],
-                                                                    self.precentileThreshold)
-                        print('Homogeneity CV threshold: %.2f' % self.cvHomogeneityThreshold)
-                homogenousPix = np.logical_and(resCVWindow < self.cvHomogeneityThreshold,
-                                               resCVWindow > 0)
-
-                goodData_LR[i] = utils.appendNpArray(goodData_LR[i],
-                                                     data_LR[rows, cols][goodPix])
-                goodData_HR[i] = utils.appendNpArray(goodData_HR[i],
-                                                     resMean[rows, cols, :][goodPix, :], axis=0)
-
-                # Also estimate weight given to each pixel as the inverse of its
-                # heterogeneity. The most heterogenous (beyond CV treshold) pixels are extra
-                # penalized by having their weight halved.
-                w = 1/resCVWindow[goodPix]
-                if w.size > 1:
-                    w = (w - np.min(w)) / (np.max(w) - np.min(w))
-                    w[~homogenousPix[goodPix]] = w[~homogenousPix[goodPix]] / 2
-                weight[i] = utils.appendNpArray(weight[i], w)
-
-                # Print some stats
-                if goodData_LR[i].size > 0:
-                    percentageUsedPixels = int(float(goodData_LR[i].size) /
-                                               float(data_LR[rows, cols][qualityPixWindow].size) * 100)
-                    print('Number of training elements for is ' +
-                          str(goodData_LR[i].size) + ' representing ' +
-                          str(percentageUsedPixels)+'% of avaiable low-resolution data.')
-
-            # Close all files
-            scene_HR = None
-            scene_LR = None
-            subsetScene_LR = None
-            if self.useQuality_LR:
-                subsetQuality_LR = None
-            fileNum = fileNum + 1
+                qualityFile = None
+
+            # Reproject and subset the low res scene (and quality file) to the
+            # high res scene and aggregate the high res scene to low res pixels,
+            # or get them from the cache if this was already done.
+            if self.cacheDir is not None:
+                cache = utils.SceneCache(self.cacheDir, self.cacheMaxBytes)
+                key = cache.key([highResFile, lowResFile, qualityFile],
+                                stage="training")
+                prepared = cache.load(key)
+                if prepared is None:
+                    prepared = self._prepareTrainingScene(highResFile, lowResFile, qualityFile)
+                    cache.store(key, prepared)
+            else:
+                prepared = self._prepareTrainingScene(highResFile, lowResFile, qualityFile)
+            yield prepared
+
+    def _fitPreparedScenes(self, preparedScenes):
+        ''' Private function. Selects the training samples of each window from the
+        prepared training data of each pair of scenes and fits the local and global
+        regressions on them.
+        '''
+
+        # Select good data (training samples) from low- and high-resolution
+        # input images. Samples of each window are accumulated over all the
+        # input scene pairs.
+        samples = None
+        for prepared in preparedScenes:
+            data_LR = prepared["data_LR"]
+            gt_LR = tuple(prepared["gt_LR"].tolist())
+            resMean = prepared["resMean"]
+            resStd = prepared["resStd"]
+            self.gridInfo = {"projection": str(prepared["proj_LR"]),
+                             "geotransform": list(gt_LR),
+                             "shape": list(data_LR.shape)}
+
+            # Select the samples of each window from this pair of scenes
+            with self._measureStage("sampleSelection", pixels=data_LR.size) as metrics:
+                # Flag pixels which are considered to be of good quality
+                if "qualityMask" in prepared:
+                    subsetQualityMask = prepared["qualityMask"]
+                    qualityPix = np.isin(subsetQualityMask.ravel(),
+                                         self.lowResGoodQualityFlags).reshape(subsetQualityMask.shape)
+                else:
+                    qualityPix = np.ones(data_LR.shape).astype(bool)
+
+                # Low resolution pixels with NaN value are always of bad quality
+                qualityPix = np.logical_and(qualityPix, ~np.isnan(data_LR))
+
+                resMean = np.where(resMean == 0, 0.000001, resMean)
+                resCV = np.sum(resStd/resMean, 2) / resMean.shape[2]
+                resCV[np.isnan(resCV)] = 1000
+
+                # Resampled high resolution pixels where at least one "parameter"
+                # is NaN are also of bad quality
+                resNaN = np.any(np.isnan(resMean), -1)
+                qualityPix = np.logical_and(qualityPix, ~resNaN)
+
+                windows = []
+                extents = []
+                # If moving window approach is used (section 2.3 of Gao paper)
+                # then calculate the extent of each sampling window in low
+                # resolution pixels
+                if self.movingWindowSize > 0:
+                    for y in range(int(math.ceil(data_LR.shape[0]/self.movingWindowSize))):
+                        for x in range(int(math.ceil(data_LR.shape[1]/self.movingWindowSize))):
+                            windows.append([int(max(y*self.movingWindowSize-self.movingWindowExtension, 0)),
+                                            int(min((y+1)*self.movingWindowSize+self.movingWindowExtension,
+                                                    data_LR.shape[0])),
+                                            int(max(x*self.movingWindowSize-self.movingWindowExtension, 0)),
+                                            int(min((x+1)*self.movingWindowSize+self.movingWindowExtension,
+                                                    data_LR.shape[1]))])
+                            # Save the extents of this window in projection coordinates as
+                            # UL and LR point coordinates
+                            ul = utils.pix2point([x*self.movingWindowSize, y*self.movingWindowSize],
+                                                 gt_LR)
+                            lr = utils.pix2point([(x+1)*self.movingWindowSize,
+                                                  (y+1)*self.movingWindowSize],
+                                                 gt_LR)
+                            extents.append([ul, lr])
+
+                # And always add the whole extent of low res image to also estimate
+                # the regression tree for the whole image
+                windows.append([0, data_LR.shape[0], 0, data_LR.shape[1]])
+
+                if samples is None:
+                    samples = utils.SampleStore(len(windows), resMean.shape[2])
+                elif samples.windowsNum != len(windows):
+                    print("All the low resolution files must produce the same moving windows")
+                    raise OSError
+
+                # For each window extract the good quality low res and high res pixels
+                metrics["windows"] = len(windows)
+                metrics["samples"] = 0
+                for i, window in enumerate(windows):
+                    rows = slice(window[0], window[1])
+                    cols = slice(window[2], window[3])
+                    qualityPixWindow = qualityPix[rows, cols]
+                    resCVWindow = resCV[rows, cols]
+
+                    # Good pixels are those where both low and high resolution data exists
+                    goodPix = np.logical_and.reduce((qualityPixWindow,
+                                                     resCVWindow > 0,
+                                                     resCVWindow < 1000))
+                    # If number of good pixels is below threshold then do not train a model
+                    if np.sum(goodPix) < self.minimumSampleNumber:
+                        goodPix = np.zeros(goodPix.shape).astype(bool)
+
+                    if self.autoAdjustCvThreshold:
+                        if ~np.any(goodPix):
+                            self.cvHomogeneityThreshold = 0
+                        else:
+                            self.cvHomogeneityThreshold = np.percentile(resCVWindow[goodPix],
+                                                                        self.precentileThreshold)
+                            log.info("Homogeneity CV threshold: %.2f", self.cvHomogeneityThreshold)
+                    homogenousPix = np.logical_and(resCVWindow < self.cvHomogeneityThreshold,
+                                                   resCVWindow > 0)
+
+                    # Also estimate weight given to each pixel as the inverse of its
+                    # heterogeneity. The most heterogenous (beyond CV treshold) pixels are extra
+                    # penalized by having their weight halved.
+                    w = 1/resCVWindow[goodPix]
+                    if w.size > 1:
+                        w = (w - np.min(w)) / (np.max(w) - np.min(w))
+                        w[~homogenousPix[goodPix]] = w[~homogenousPix[goodPix]] / 2
+
+                    samples.append(i,
+                                   data_LR[rows, cols][goodPix],
+                                   resMean[rows, cols, :][goodPix, :],
+                                   w)
+                    metrics["samples"] += w.size
+
+                    # Log some stats
+                    if w.size > 0:
+                        percentageUsedPixels = int(float(w.size) /
+                                                   float(data_LR[rows, cols][qualityPixWindow].size) * 100)
+                        log.info("Number of training elements for window %d is %d representing "
+                                 "%d%% of available low-resolution data.",
+                                 i, w.size, percentageUsedPixels)
 
         self.windowExtents = extents
         windowsNum = len(windows)
 
         # Once all the samples have been picked fit all the local and global
-        # regressions
+        # regressions. The last window is the global one.
         self.reg = [None for _ in range(windowsNum)]
-        for i in range(windowsNum):
-            if i < windowsNum-1:
-                local = True
-            else:
-                local = False
-            if len(goodData_LR[i]) > 0:
-                self.reg[i] = \
-                    self._doFit(goodData_LR[i], goodData_HR[i], weight[i], local)
+        fitWindows = [i for i in range(windowsNum) if samples.size(i) > 0]
+        fitArgs = [(i,) + samples.get(i) + (i < windowsNum-1,) for i in fitWindows]
+        fits = self._fitWindows(fitArgs)
+        for i, (reg, metrics) in zip(fitWindows, fits):
+            self.reg[i] = reg
+            self._reportMetrics(metrics)
+
+    def _prepareTrainingScene(self, highResFile, lowResFile, qualityFile):
+        ''' Private function. Subsets and reprojects the low resolution scene (and
+        quality file if given) to the high resolution scene and resamples the high
+        resolution scene to low resolution pixel size while extracting
+        sub-low-res-pixel homogeneity statistics.
+        '''
+
+        scene_HR = gdal.Open(highResFile)
+        scene_LR = gdal.Open(lowResFile)
+
+        # First subset and reproject low res scene to fit with
+        # high res scene
+        with self._measureStage("reprojection") as metrics:
+            subsetScene_LR = utils.reprojectSubsetLowResScene(scene_HR, scene_LR)
+            prepared = {"data_LR": subsetScene_LR.GetRasterBand(1).ReadAsArray(),
+                        "gt_LR": np.array(subsetScene_LR.GetGeoTransform()),
+                        "proj_LR": np.array(subsetScene_LR.GetProjection())}
 
-    def applySharpener(self, highResFilename, lowResFilename=None):
+            # Do the same with low res quality file (if provided)
+            if qualityFile is not None:
+                quality_LR = gdal.Open(qualityFile)
+                subsetQuality_LR = utils.reprojectSubsetLowResScene(scene_HR, quality_LR)
+                prepared["qualityMask"] = subsetQuality_LR.GetRasterBand(1).ReadAsArray()
+                quality_LR = None
+                subsetQuality_LR = None
+            metrics["pixels"] = prepared["data_LR"].size
+
+        # Then resample high res scene to low res pixel size while
+        # extracting sub-low-res-pixel homogeneity statistics
+        with self._measureStage("aggregation",
+                                pixels=scene_HR.RasterXSize*scene_HR.RasterYSize):
+            prepared["resMean"], prepared["resStd"] = \
+                utils.resampleHighResToLowRes(scene_HR, subsetScene_LR,
+                                              stripRows=self.aggregationStripRows)
+
+        # Close all files
+        scene_HR = None
+        scene_LR = None
+        subsetScene_LR = None
+
+        return prepared
+
+    def _prepareTrainingArrays(self, highResScene, lowResScene, lowResQuality=None):
+        ''' Private function. Same as _prepareTrainingScene but for in-memory
+        (data, geotransform, projection) scenes.
+        '''
+
+        data_HR, gt_HR, proj_HR = highResScene
+        data_HR = np.asarray(data_HR)
+        if data_HR.ndim == 2:
+            data_HR = data_HR[:, :, np.newaxis]
+        data_LR, gt_LR, proj_LR = lowResScene
+
+        # First subset and reproject low res data (and quality flags) to fit with
+        # high res data
+        with self._measureStage("reprojection") as metrics:
+            alignment = utils.alignGrids(proj_HR, gt_HR, data_HR.shape[1], data_HR.shape[0],
+                                         proj_LR, gt_LR, data_LR.shape[1], data_LR.shape[0])
+            prepared = {"data_LR": alignment.subsetLowResArray(data_LR),
+                        "gt_LR": np.array(alignment.gt_LR),
+                        "proj_LR": np.array(proj_HR)}
+            if lowResQuality is not None:
+                prepared["qualityMask"] = alignment.subsetLowResArray(lowResQuality)
+            metrics["pixels"] = prepared["data_LR"].size
+
+        # Then aggregate high res data to low res pixel size while
+        # extracting sub-low-res-pixel homogeneity statistics
+        with self._measureStage("aggregation", pixels=data_HR.shape[0]*data_HR.shape[1]):
+            prepared["resMean"], prepared["resStd"] = \
+                utils.aggregateHighResToLowRes(data_HR, gt_HR, alignment.gt_LR,
+                                               alignment.xSize_LR, alignment.ySize_LR)
+
+        return prepared
+
+    def applySharpener(self, highResFilename, lowResFilename=None, tileSize=None,
+                       outputFilename=None, progressCallback=None):
         ''' Apply the trained sharpener to a given high-resolution image to
         derive corresponding disaggregated low-resolution image. If local
         regressions were used during training then they will only be applied
@@ -475,113 +937,241 @@ class DecisionTreeSharpener(object):
             2.3). If local regressions were trained and low-resolution
             filename is not given then only the local regressions will be used.
 
+        tileSize: integer (optional, default: None)
+            If given, the high-resolution image is processed in square tiles of
+            this size (in high-resolution pixels) which are read, predicted and
+            written to disk one at a time, so that the memory use is bounded by
+            the tile size rather than by the image size.
+
+        outputFilename: string (optional, default: None)
+            Path to the GeoTIFF file to which the output is written when
+            tileSize is given. Required if tileSize is given.
+
+        progressCallback: function (optional, default: None)
+            Function called with the number of processed moving windows (or
+            tiles if tileSize is given) and their total number.
+
 
         Returns
         -------
-        outImage: GDAL memory file object
-            The file object contains an in-memory, georeferenced disaggregator
-            output.
+        outImage: GDAL file object
+            The file object contains an in-memory (or on-disk if tileSize is
+            given), georeferenced disaggregator output.
         '''
 
-        # Open and read the high resolution input file
-        highResFile = gdal.Open(highResFilename)
-        inData = np.zeros((highResFile.RasterYSize, highResFile.RasterXSize,
-                           highResFile.RasterCount))
-        for band in range(highResFile.RasterCount):
-            data = highResFile.GetRasterBand(band+1).ReadAsArray().astype(float)
-            no_data = highResFile.GetRasterBand(band+1).GetNoDataValue()
-            data[data == no_data] = np.nan
-            inData[:, :, band] = data
-        gt = highResFile.GetGeoTransform()
+        if tileSize is not None:
+            if outputFilename is None:
+                raise ValueError("outputFilename must be given when tileSize is given")
+            return self._applySharpenerTiled(highResFilename, lowResFilename, int(tileSize),
+                                             outputFilename, progressCallback)
+
+        # Read the high and low resolution input files
+        inData, gt, proj = utils.readRaster(highResFilename, dtype=self.dtype)
+        lowResScene = None
+        if lowResFilename is not None:
+            data_LR, gt_LR, proj_LR = utils.readRaster(lowResFilename, dtype=self.dtype)
+            lowResScene = (data_LR[:, :, 0], gt_LR, proj_LR)
+
+        outData = self.predictArrays(inData, gt, proj, lowResScene, progressCallback)
+
+        outImage = utils.saveImg(outData, gt, proj, "MEM", noDataValue=np.nan)
+
+        inData = None
+        return outImage
 
+    def predictArrays(self, highResData, geotransform, projection=None, lowResScene=None,
+                      progressCallback=None):
+        ''' Apply the trained sharpener to in-memory high-resolution data (see
+        applySharpener).
+
+        Parameters
+        ----------
+        highResData: array
+            The (rows, columns, bands) high-resolution data, with NaN marking
+            missing values.
+
+        geotransform: tuple
+            GDAL geotransform of the high-resolution data.
+
+        projection: string (optional, default: None)
+            Projection of the high-resolution data. Required if lowResScene is
+            given.
+
+        lowResScene: tuple (optional, default: None)
+            A (data, geotransform, projection) tuple of the low-resolution
+            (rows, columns) data corresponding to the high-resolution data, used
+            to combine the local and global regressions as in applySharpener.
+
+        progressCallback: function (optional, default: None)
+            Function called with the number of processed moving windows and their
+            total number.
+
+
+        Returns
+        -------
+        outData: array
+            The (rows, columns) disaggregated data, with NaN where any of the
+            high-resolution bands is missing.
+        '''
+
+        inData = np.asarray(highResData, dtype=self.dtype)
+        if inData.ndim == 2:
+            inData = inData[:, :, np.newaxis]
+        gt = geotransform
         shape = inData.shape
         ysize = shape[0]
         xsize = shape[1]
 
-        # Temporarly get rid of NaN's
-        nanInd = np.isnan(inData)
-        inData[nanInd] = 0
+        # Only pixels with valid values in all bands are predicted
+        validPix = ~np.any(np.isnan(inData), -1)
 
-        outWindowData = np.empty((ysize, xsize))*np.nan
-        outFullData = np.empty((ysize, xsize))*np.nan
+        outWindowData = np.full((ysize, xsize), np.nan, dtype=self.dtype)
+        outFullData = np.full((ysize, xsize), np.nan, dtype=self.dtype)
         # Do the downscailing on the moving windows if there are any and also process the full
         # scene using the same windows to optimize memory usage
-        for i, extent in enumerate(self.windowExtents):
-            print(i)
-            if self.reg[i] is not None:
-                [minX, minY] = utils.point2pix(extent[0], gt)  # UL
-                [minX, minY] = [max(minX, 0), max(minY, 0)]
-                [maxX, maxY] = utils.point2pix(extent[1], gt)  # LR
-                [maxX, maxY] = [min(maxX, xsize), min(maxY, ysize)]
-                windowInData = inData[minY:maxY, minX:maxX, :]
-                outWindowData[minY:maxY, minX:maxX] = \
-                    self._doPredict(windowInData, self.reg[i])
-                if self.reg[-1] is not None:
-                    outFullData[minY:maxY, minX:maxX] = \
-                        self._doPredict(windowInData, self.reg[-1])
+        windows = [(i, slice(minY, maxY), slice(minX, maxX))
+                   for i, minY, maxY, minX, maxX in self._windowPixelExtents(gt, xsize, ysize)]
+        executor = self._windowExecutor()
+        try:
+            self._predictWindows(inData, validPix, windows, outWindowData, outFullData,
+                                 executor, progressCallback)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
         # If there were no moving windows then do the downscailing on the whole input image
         if np.all(np.isnan(outFullData)) and self.reg[-1] is not None:
-            outFullData = self._doPredict(inData, self.reg[-1])
+            with self._measureStage("predict", window=len(self.reg)-1,
+                                    pixels=int(np.sum(validPix))):
+                self._predictValidPixels(inData, validPix, self.reg[-1], outFullData)
 
         # Combine the windowed and whole image regressions
         # If there is no windowed regression just use the whole image regression
         if np.all(np.isnan(outWindowData)):
             outData = outFullData
-        # If corresponding low resolution file is provided then combine the two
+        # If corresponding low resolution data is provided then combine the two
         # regressions based on residuals (see section 2.3 of Gao paper)
-        elif lowResFilename is not None:
-            lowResScene = gdal.Open(lowResFilename)
-            outWindowScene = utils.saveImg(outWindowData,
-                                           highResFile.GetGeoTransform(),
-                                           highResFile.GetProjection(),
-                                           "MEM",
-                                           noDataValue=np.nan)
-            windowedResidual_LR, gt_LR = self._calculateResidual(outWindowScene, lowResScene)
-            outWindowScene = None
-            outFullScene = utils.saveImg(outFullData,
-                                         highResFile.GetGeoTransform(),
-                                         highResFile.GetProjection(),
-                                         "MEM",
-                                         noDataValue=np.nan)
-            fullResidual_LR, gt_LR = self._calculateResidual(outFullScene, lowResScene)
-            lowResScene = None
-            # windowed weight
-            ww_LR = (1/windowedResidual_LR)**2/((1/windowedResidual_LR)**2 +
-                                                (1/fullResidual_LR)**2)
-            wwLowResScene = utils.saveImg(ww_LR,
-                                          gt_LR,
-                                          highResFile.GetProjection(),
-                                          "MEM",
-                                          noDataValue=np.nan)
-            ww = utils.resampleLowResToHighRes(wwLowResScene, outFullScene)
-            ww = np.clip(ww, 0.0, 1.0)
-            # full weight
-            fw = 1 - ww
-            if self.disaggregatingTemperature:
-                outData = ((outWindowData**4)*ww + (outFullData**4)*fw)**0.25
-            else:
-                outData = outWindowData*ww + outFullData*fw
+        elif lowResScene is not None:
+            # The low res data is subset once and both regressions are aggregated to
+            # it and weighted directly on the arrays
+            with self._measureStage("combination", pixels=xsize*ysize):
+                gt_LR, data_LR = self._subsetLowResArrays(gt, projection, xsize, ysize,
+                                                          lowResScene)
+                windowedResidual_LR = self._residualToLowRes(outWindowData, gt_LR, data_LR,
+                                                             gt_HR=gt)
+                fullResidual_LR = self._residualToLowRes(outFullData, gt_LR, data_LR, gt_HR=gt)
+                ww_LR = self._windowWeights(windowedResidual_LR, fullResidual_LR)
+                ww = utils.resampleLowResArrayToHighRes(ww_LR, gt_LR, gt, 0, 0, xsize, ysize)
+                outData = self._combineRegressions(outWindowData, outFullData, ww)
         # Otherwised use just windowed regression
         else:
             outData = outWindowData
 
         # Fix NaN's
-        nanInd = np.any(nanInd, -1)
-        outData[nanInd] = np.nan
+        outData[~validPix] = np.nan
 
-        outImage = utils.saveImg(outData,
-                                 highResFile.GetGeoTransform(),
-                                 highResFile.GetProjection(),
-                                 "MEM",
-                                 noDataValue=np.nan)
+        return outData
+
+    def _applySharpenerTiled(self, highResFilename, lowResFilename, tileSize, outputFilename,
+                             progressCallback=None):
+        ''' Private function. Tiled, bounded-memory version of applySharpener. Local and
+        global predictions are written tile by tile to temporary GeoTIFFs and then combined,
+        again tile by tile, into the output file.
+        '''
+
+        highResFile = gdal.Open(highResFilename)
+        gt = highResFile.GetGeoTransform()
+        proj = highResFile.GetProjection()
+        xsize = highResFile.RasterXSize
+        ysize = highResFile.RasterYSize
+
+        windows = self._windowPixelExtents(gt, xsize, ysize)
+        tiles = [(x0, y0, min(tileSize, xsize - x0), min(tileSize, ysize - y0))
+                 for y0 in range(0, ysize, tileSize) for x0 in range(0, xsize, tileSize)]
+
+        tempDir = tempfile.mkdtemp()
+        executor = self._windowExecutor()
+        try:
+            outWriter = utils.RasterWriter(outputFilename, xsize, ysize, 1, gt, proj,
+                                           noDataValue=np.nan)
+            if windows:
+                windowScene = utils.createTiledRaster(os.path.join(tempDir, "window.tif"),
+                                                      xsize, ysize, 1, gt, proj)
+                fullScene = utils.createTiledRaster(os.path.join(tempDir, "full.tif"),
+                                                    xsize, ysize, 1, gt, proj)
+                maskScene = utils.createTiledRaster(os.path.join(tempDir, "mask.tif"),
+                                                    xsize, ysize, 1, gt, proj,
+                                                    dataType=gdal.GDT_Byte)
+
+            # First pass: predict the local and global regressions tile by tile
+            windowDataFound = False
+            for tileNum, (x0, y0, nx, ny) in enumerate(tiles):
+                inData = utils.readRasterBlock(highResFile, x0, y0, nx, ny, dtype=self.dtype)
+                validPix = ~np.any(np.isnan(inData), -1)
+                outWindowData, outFullData = self._predictTile(inData, validPix, windows,
+                                                               x0, y0, executor)
+                if progressCallback is not None:
+                    progressCallback(tileNum + 1, len(tiles))
+
+                if not windows:
+                    outWriter.write(outFullData, x0, y0)
+                    continue
+
+                windowDataFound = windowDataFound or not np.all(np.isnan(outWindowData))
+                windowScene.GetRasterBand(1).WriteArray(outWindowData, x0, y0)
+                fullScene.GetRasterBand(1).WriteArray(outFullData, x0, y0)
+                maskScene.GetRasterBand(1).WriteArray((~validPix).astype(np.uint8), x0, y0)
+
+            # Second pass: combine the windowed and whole image regressions
+            if windows:
+                with self._measureStage("combination", pixels=xsize*ysize):
+                    windowScene.FlushCache()
+                    fullScene.FlushCache()
+                    ww_LR = None
+                    if windowDataFound and lowResFilename is not None:
+                        data_LR, gt_LR, proj_LR = utils.readRaster(lowResFilename,
+                                                                   dtype=self.dtype)
+                        gt_LR, data_LR = self._subsetLowResArrays(gt, proj, xsize, ysize,
+                                                                  (data_LR[:, :, 0], gt_LR,
+                                                                   proj_LR))
+                        stripRows = self._tileStripRows(tileSize, gt, gt_LR, xsize)
+                        windowedResidual_LR = self._residualToLowRes(windowScene, gt_LR, data_LR,
+                                                                     stripRows=stripRows)
+                        fullResidual_LR = self._residualToLowRes(fullScene, gt_LR, data_LR,
+                                                                 stripRows=stripRows)
+                        ww_LR = self._windowWeights(windowedResidual_LR, fullResidual_LR)
+
+                    for x0, y0, nx, ny in tiles:
+                        outFullData = fullScene.GetRasterBand(1).ReadAsArray(
+                            x0, y0, nx, ny).astype(self.dtype)
+                        outWindowData = windowScene.GetRasterBand(1).ReadAsArray(
+                            x0, y0, nx, ny).astype(self.dtype)
+                        if not windowDataFound:
+                            outData = outFullData
+                        elif ww_LR is not None:
+                            ww = utils.resampleLowResArrayToHighRes(ww_LR, gt_LR, gt, x0, y0, nx, ny)
+                            outData = self._combineRegressions(outWindowData, outFullData, ww)
+                        else:
+                            outData = outWindowData
+                        nanInd = maskScene.GetRasterBand(1).ReadAsArray(x0, y0, nx, ny).astype(bool)
+                        outData[nanInd] = np.nan
+                        outWriter.write(outData, x0, y0)
+
+                    windowScene = None
+                    fullScene = None
+                    maskScene = None
+
+            outImage = outWriter.close()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            shutil.rmtree(tempDir, ignore_errors=True)
 
         highResFile = None
-        inData = None
         return outImage
 
     def residualAnalysis(self, disaggregatedFile, lowResFilename, lowResQualityFilename=None,
-                         doCorrection=True):
+                         doCorrection=True, tileSize=None, outputFilename=None):
         ''' Perform residual analysis and (optional) correction on the
         disaggregated file (see [Gao2012] 2.4).
 
@@ -604,6 +1194,17 @@ class DecisionTreeSharpener(object):
             Flag indication whether residual (bias) correction should be
             performed or not.
 
+        tileSize: integer (optional, default: None)
+            If given, the disaggregated image is aggregated to the low
+            resolution in strips and corrected in square tiles of this size (in
+            high-resolution pixels), so that the memory use is bounded by the
+            tile size rather than by the image size.
+
+        outputFilename: string (optional, default: None)
+            Path to the GeoTIFF file to which the corrected image is written
+            when tileSize is given. Required if tileSize is given and
+            doCorrection is set.
+
 
         Returns
         -------
@@ -611,138 +1212,698 @@ class DecisionTreeSharpener(object):
             The file object contains an in-memory, georeferenced residual image.
 
         correctedImage: GDAL memory file object
-            The file object contains an in-memory, georeferenced residual
-            corrected disaggregated image, or None if doCorrection was set to
-            False.
+            The file object contains an in-memory (or on-disk if tileSize is
+            given), georeferenced residual corrected disaggregated image, or
+            None if doCorrection was set to False.
         '''
 
         if not os.path.isfile(str(disaggregatedFile)):
             scene_HR = disaggregatedFile
         else:
             scene_HR = gdal.Open(disaggregatedFile)
-        scene_LR = gdal.Open(lowResFilename)
+
+        if tileSize is not None:
+            if doCorrection and outputFilename is None:
+                raise ValueError("outputFilename must be given when tileSize is given")
+            return self._residualAnalysisTiled(scene_HR, lowResFilename, lowResQualityFilename,
+                                               doCorrection, int(tileSize), outputFilename)
+
+        data_HR, gt, proj = utils.readRaster(scene_HR, dtype=self.dtype)
+        scene_HR = None
+        data_LR, gt_LR, proj_LR = utils.readRaster(lowResFilename, dtype=self.dtype)
         if lowResQualityFilename is not None:
-            quality_LR = gdal.Open(lowResQualityFilename)
+            quality_LR = utils.readRaster(lowResQualityFilename)[0][:, :, 0]
         else:
             quality_LR = None
 
-        residual_LR, gt_res = self._calculateResidual(scene_HR, scene_LR, quality_LR)
-        residualImage = utils.saveImg(residual_LR,
-                                      gt_res,
-                                      scene_HR.GetProjection(),
-                                      "MEM",
-                                      noDataValue=np.nan)
-        residual_HR = utils.resampleLowResToHighRes(residualImage, scene_HR)
-
-        if doCorrection:
-            corrected = residual_HR + scene_HR.GetRasterBand(1).ReadAsArray()
-            correctedImage = utils.saveImg(corrected,
-                                           scene_HR.GetGeoTransform(),
-                                           scene_HR.GetProjection(),
-                                           "MEM",
-                                           noDataValue=np.nan)
+        residual_LR, gt_res, corrected = self.residualArrays(data_HR[:, :, 0], gt, proj,
+                                                             (data_LR[:, :, 0], gt_LR, proj_LR),
+                                                             quality_LR, doCorrection)
+
+        residualImage = utils.saveImg(residual_LR, gt_res, proj, "MEM", noDataValue=np.nan)
+        if corrected is not None:
+            correctedImage = utils.saveImg(corrected, gt, proj, "MEM", noDataValue=np.nan)
         else:
             correctedImage = None
 
-        print("LR residual bias: "+str(np.nanmean(residual_LR)))
-        print("LR residual RMSD: "+str(np.nanmean(residual_LR**2)**0.5))
+        return residualImage, correctedImage
 
-        scene_HR = None
-        scene_LR = None
-        quality_LR = None
+    def _residualAnalysisTiled(self, scene_HR, lowResFilename, lowResQualityFilename,
+                               doCorrection, tileSize, outputFilename):
+        ''' Private function. Tiled, bounded-memory version of residualAnalysis. The
+        disaggregated scene is aggregated to the low resolution in strips and the corrected
+        image is written tile by tile to the output file.
+        '''
+
+        gt = scene_HR.GetGeoTransform()
+        proj = scene_HR.GetProjection()
+        xsize = scene_HR.RasterXSize
+        ysize = scene_HR.RasterYSize
+        data_LR, gt_LR, proj_LR = utils.readRaster(lowResFilename, dtype=self.dtype)
+        if lowResQualityFilename is not None:
+            quality_LR = utils.readRaster(lowResQualityFilename)[0][:, :, 0]
+        else:
+            quality_LR = None
+
+        with self._measureStage("residual", pixels=xsize*ysize) as metrics:
+            gt_res, data_LR = self._subsetLowResArrays(gt, proj, xsize, ysize,
+                                                       (data_LR[:, :, 0], gt_LR, proj_LR),
+                                                       quality_LR)
+            residual_LR = self._residualToLowRes(scene_HR, gt_res, data_LR,
+                                                 stripRows=self._tileStripRows(tileSize, gt,
+                                                                               gt_res, xsize))
 
+            correctedImage = None
+            if doCorrection:
+                outWriter = utils.RasterWriter(outputFilename, xsize, ysize, 1, gt, proj,
+                                               noDataValue=np.nan)
+                for y0 in range(0, ysize, tileSize):
+                    for x0 in range(0, xsize, tileSize):
+                        nx = min(tileSize, xsize - x0)
+                        ny = min(tileSize, ysize - y0)
+                        data_HR = utils.readRasterBlock(scene_HR, x0, y0, nx, ny,
+                                                        dtype=self.dtype)[:, :, 0]
+                        residual_HR = utils.resampleLowResArrayToHighRes(residual_LR, gt_res, gt,
+                                                                         x0, y0, nx, ny)
+                        outWriter.write(residual_HR.astype(self.dtype) + data_HR, x0, y0)
+                correctedImage = outWriter.close()
+            metrics["bias"] = float(np.nanmean(residual_LR))
+            metrics["rmsd"] = float(np.nanmean(residual_LR**2)**0.5)
+
+        log.info("LR residual bias: %s", metrics["bias"])
+        log.info("LR residual RMSD: %s", metrics["rmsd"])
+
+        residualImage = utils.saveImg(residual_LR, gt_res, proj, "MEM", noDataValue=np.nan)
         return residualImage, correctedImage
 
+    def residualArrays(self, disaggregatedData, geotransform, projection, lowResScene,
+                       lowResQuality=None, doCorrection=True):
+        ''' Perform residual analysis and (optional) correction on in-memory
+        disaggregated data (see residualAnalysis).
+
+        Parameters
+        ----------
+        disaggregatedData: array
+            The (rows, columns) disaggregated data, e.g. output of predictArrays.
+
+        geotransform: tuple
+            GDAL geotransform of the disaggregated data.
+
+        projection: string
+            Projection of the disaggregated data.
+
+        lowResScene: tuple
+            A (data, geotransform, projection) tuple of the low-resolution
+            (rows, columns) data corresponding to the disaggregated data.
+
+        lowResQuality: array (optional, default: None)
+            The (rows, columns) quality flags on the same grid as the
+            low-resolution data. If provided then low quality values are masked
+            out during residual analysis. Otherwise all values are considered to be
+            of good quality.
+
+        doCorrection: boolean (optional, default: True)
+            Flag indication whether residual (bias) correction should be
+            performed or not.
+
+
+        Returns
+        -------
+        residual_LR: array
+            The residual on the low-resolution grid subset to the extent of the
+            disaggregated data.
+
+        gt_res: tuple
+            GDAL geotransform of the residual, in the projection of the
+            disaggregated data.
+
+        corrected: array
+            The residual corrected disaggregated data, or None if doCorrection
+            was set to False.
+        '''
+
+        data_HR = np.asarray(disaggregatedData, dtype=self.dtype)
+        ysize, xsize = data_HR.shape
+
+        with self._measureStage("residual", pixels=xsize*ysize) as metrics:
+            gt_res, data_LR = self._subsetLowResArrays(geotransform, projection, xsize, ysize,
+                                                       lowResScene, lowResQuality)
+            residual_LR = self._residualToLowRes(data_HR, gt_res, data_LR, gt_HR=geotransform)
+
+            if doCorrection:
+                residual_HR = utils.resampleLowResArrayToHighRes(residual_LR, gt_res,
+                                                                 geotransform, 0, 0, xsize, ysize)
+                corrected = residual_HR.astype(self.dtype) + data_HR
+            else:
+                corrected = None
+            metrics["bias"] = float(np.nanmean(residual_LR))
+            metrics["rmsd"] = float(np.nanmean(residual_LR**2)**0.5)
+
+        log.info("LR residual bias: %s", metrics["bias"])
+        log.info("LR residual RMSD: %s", metrics["rmsd"])
+
+        return residual_LR, gt_res, corrected
+
+    def sharpenSeries(self, pairs, outputs, n_workers=1, doCorrection=True, tileSize=None):
+        ''' Apply the trained sharpener to a series of scenes (e.g. many dates of
+        low-resolution images), performing the residual analysis and writing the
+        output of each scene. The scenes are processed in parallel by a pool of
+        worker processes which receive the trained sharpener once, when they are
+        started, and not with each scene.
+
+        Parameters
+        ----------
+        pairs: list of tuples
+            For each scene a (highResFilename, lowResFilename) or a
+            (highResFilename, lowResFilename, lowResQualityFilename) tuple.
+
+        outputs: list of strings
+            For each scene the path of the output file. The residual image is
+            saved next to it with "_residual" appended to the file name.
+
+        n_workers: int (optional, default: 1)
+            Number of worker processes used to process the scenes.
+
+        doCorrection: boolean (optional, default: True)
+            Flag indication whether residual (bias) correction should be
+            performed or not.
+
+        tileSize: integer (optional, default: None)
+            If given, the high-resolution images are sharpened in tiles of this
+            size (see applySharpener).
+
+
+        Returns
+        -------
+        summary: list of dictionaries
+            For each scene the output file name and the time, in seconds, spent on
+            sharpening, residual analysis, writing and in total.
+        '''
+
+        if len(pairs) != len(outputs):
+            print("The number of scene pairs and output files must be the same")
+            raise OSError
+
+        tasks = [(tuple(pair) + (None,))[:3] + (output, doCorrection, tileSize)
+                 for pair, output in zip(pairs, outputs)]
+        if n_workers > 1:
+            with utils.processContext.Pool(processes=n_workers,
+                                           initializer=_initSharpenerWorker,
+                                           initargs=(self,)) as pool:
+                summary = pool.starmap(_sharpenSeriesScene, tasks)
+        else:
+            summary = [self._sharpenScene(*task) for task in tasks]
+
+        for times in summary:
+            log.info("%s: sharpening %.1f s, residual analysis %.1f s, writing %.1f s, "
+                     "total %.1f s", times["output"], times["sharpening"],
+                     times["residualAnalysis"], times["writing"], times["total"])
+        return summary
+
+    def _sharpenScene(self, highResFilename, lowResFilename, lowResQualityFilename,
+                      outputFilename, doCorrection, tileSize):
+        ''' Private function. Sharpens one scene of a series, performs the residual
+        analysis and writes the outputs. Returns the time spent on each step.
+        '''
+
+        times = {"output": outputFilename}
+        start = time.time()
+        base, ext = os.path.splitext(outputFilename)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            if tileSize is not None:
+                # Tiled outputs are written to disk as they are produced: the sharpened
+                # image directly to the output file unless it is still to be corrected
+                if doCorrection:
+                    sharpenedFilename = os.path.join(tmpDir, "sharpened.tif")
+                else:
+                    sharpenedFilename = outputFilename
+                downscaledFile = self.applySharpener(highResFilename, lowResFilename,
+                                                     tileSize=tileSize,
+                                                     outputFilename=sharpenedFilename)
+            else:
+                downscaledFile = self.applySharpener(highResFilename, lowResFilename)
+            times["sharpening"] = time.time() - start
+
+            step = time.time()
+            residualImage, correctedImage = self.residualAnalysis(downscaledFile,
+                                                                  lowResFilename,
+                                                                  lowResQualityFilename,
+                                                                  doCorrection=doCorrection,
+                                                                  tileSize=tileSize,
+                                                                  outputFilename=outputFilename)
+            times["residualAnalysis"] = time.time() - step
+
+            with self._measureStage("write") as metrics:
+                if correctedImage is not None:
+                    outImage = correctedImage
+                else:
+                    outImage = downscaledFile
+                metrics["pixels"] = outImage.RasterXSize*outImage.RasterYSize
+                if tileSize is None:
+                    utils.saveImg(outImage.GetRasterBand(1).ReadAsArray(),
+                                  outImage.GetGeoTransform(),
+                                  outImage.GetProjection(),
+                                  outputFilename,
+                                  noDataValue=np.nan)
+                utils.saveImg(residualImage.GetRasterBand(1).ReadAsArray(),
+                              residualImage.GetGeoTransform(),
+                              residualImage.GetProjection(),
+                              base + "_residual" + ext,
+                              noDataValue=np.nan)
+                outImage = None
+                downscaledFile = None
+                correctedImage = None
+                residualImage = None
+            times["writing"] = metrics["wallTime"]
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        times["total"] = time.time() - start
+
+        return times
+
+    def save(self, path):
+        ''' Save the trained sharpener to a directory. The window extents, the
+        grid of the training low-resolution data and the sharpener settings are
+        stored in a JSON file while each window model is stored as a set of
+        NumPy (.npy) arrays which can be memory-mapped when loading. TypeError is
+        raised if any of the settings is not JSON serialisable.
+
+        Parameters
+        ----------
+        path: string
+            Path to the output directory. It is created if it does not exist.
+
+        Returns
+        -------
+        None
+        '''
+
+        # All the settings needed to apply the sharpener are kept. The metrics callback
+        # and private (e.g. worker pool) attributes are not part of the trained sharpener.
+        settings = {}
+        for key, value in vars(self).items():
+            if key in ("reg", "windowExtents", "metricsCallback") or key.startswith("_"):
+                continue
+            try:
+                json.dumps(value)
+            except TypeError:
+                raise TypeError(f"Setting {key} ({value!r}) can not be saved since it is "
+                                "not JSON serialisable")
+            settings[key] = value
+
+        os.makedirs(path, exist_ok=True)
+
+        models = []
+        for i, reg in enumerate(self.reg):
+            if reg is None:
+                models.append(None)
+                continue
+            arrays = self._exportModel(reg)
+            for name, array in arrays.items():
+                np.save(os.path.join(path, f"window_{i}_{name}.npy"), array)
+            models.append(sorted(arrays.keys()))
+
+        metadata = {"class": type(self).__name__,
+                    "windowExtents": self.windowExtents,
+                    "models": models,
+                    "settings": settings}
+        with open(os.path.join(path, "model.json"), "w") as fp:
+            json.dump(metadata, fp, indent=1)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        ''' Load a trained sharpener saved with the save function.
+
+        Parameters
+        ----------
+        path: string
+            Path to the directory containing the saved sharpener.
+
+        mmap_mode: string or None (optional, default: "r")
+            Memory-map mode used when loading the model arrays (see numpy.load).
+            If None the arrays are read into memory.
+
+        Returns
+        -------
+        sharpener: DecisionTreeSharpener, CubistSharpener or NeuralNetworkSharpener
+            The trained sharpener which can be used with applySharpener and
+            residualAnalysis.
+        '''
+
+        with open(os.path.join(path, "model.json"), "r") as fp:
+            metadata = json.load(fp)
+        if metadata["class"] != cls.__name__:
+            print(f"The saved sharpener is a {metadata['class']}, not a {cls.__name__}")
+            raise OSError
+
+        sharpener = cls.__new__(cls)
+        sharpener.metricsCallback = None
+        sharpener.__dict__.update(metadata["settings"])
+        sharpener.windowExtents = metadata["windowExtents"]
+        sharpener.reg = []
+        for i, names in enumerate(metadata["models"]):
+            if names is None:
+                sharpener.reg.append(None)
+                continue
+            arrays = {name: np.load(os.path.join(path, f"window_{i}_{name}.npy"),
+                                    mmap_mode=mmap_mode)
+                      for name in names}
+            sharpener.reg.append(sharpener._importModel(arrays))
+
+        return sharpener
+
+    def _exportModel(self, reg):
+        ''' Private function. Converts a trained window model to a dictionary of arrays.
+        '''
+
+        if not isinstance(reg, CompiledTreeEnsemble):
+            reg = CompiledTreeEnsemble.fromBaggingRegressor(reg)
+        return dict(vars(reg))
+
+    def _importModel(self, arrays):
+        ''' Private function. Creates a window model from a dictionary of arrays.
+        '''
+
+        return CompiledTreeEnsemble(**arrays)
+
+    def _windowPixelExtents(self, gt, xsize, ysize):
+        ''' Private function. Returns the index and the pixel extent (minY, maxY, minX, maxX),
+        within the high resolution image, of each trained local regression.
+        '''
+
+        windows = []
+        for i, extent in enumerate(self.windowExtents):
+            if self.reg[i] is not None:
+                [minX, minY] = utils.point2pix(extent[0], gt)  # UL
+                [minX, minY] = [max(minX, 0), max(minY, 0)]
+                [maxX, maxY] = utils.point2pix(extent[1], gt)  # LR
+                [maxX, maxY] = [min(maxX, xsize), min(maxY, ysize)]
+                windows.append((i, minY, maxY, minX, maxX))
+        return windows
+
+    def __getstate__(self):
+        # Metrics callbacks which can not be pickled (e.g. lambdas) are not passed to
+        # worker processes, which then only log the metrics
+        state = self.__dict__.copy()
+        try:
+            pickle.dumps(state.get("metricsCallback"))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            state["metricsCallback"] = None
+        return state
+
+    @contextlib.contextmanager
+    def _measureStage(self, stage, **counts):
+        ''' Private function. Measures the processing stage run within the with block
+        and reports its metrics.
+        '''
+
+        with utils.stageMetrics(stage, **counts) as metrics:
+            yield metrics
+        self._reportMetrics(metrics)
+
+    def _reportMetrics(self, metrics):
+        ''' Private function. Logs the metrics of a processing stage and passes them to
+        the metrics callback, if one was given.
+        '''
+
+        log.debug("%s: %s", metrics["stage"],
+                  ", ".join(f"{key}={value}" for key, value in metrics.items()
+                            if key != "stage"))
+        if self.metricsCallback is not None:
+            self.metricsCallback(metrics)
+
     def _doFit(self, goodData_LR, goodData_HR, weight, local):
         ''' Private function. Fits the regression tree.
         '''
 
+        # Work on a copy of the options since fits might run concurrently
+        regressorOpt = self.regressorOpt.copy()
+
         # For local regression constrain the number of tree
         # nodes (rules) - section 2.3
         if local:
-            self.regressorOpt["max_leaf_nodes"] = 10
+            regressorOpt["max_leaf_nodes"] = 10
         else:
-            self.regressorOpt["max_leaf_nodes"] = 30
-        self.regressorOpt["min_samples_leaf"] = min(self.minimumSampleNumber, 10)
+            regressorOpt["max_leaf_nodes"] = 30
+        regressorOpt["min_samples_leaf"] = min(self.minimumSampleNumber, 10)
 
         # If per leaf linear regression is used then use modified
         # DecisionTreeRegressor. Otherwise use the standard one.
         if self.perLeafLinearRegression:
             baseRegressor = \
                 DecisionTreeRegressorWithLinearLeafRegression(self.linearRegressionExtrapolationRatio,
-                                                              self.regressorOpt)
+                                                              regressorOpt)
         else:
             baseRegressor = \
-                tree.DecisionTreeRegressor(**self.regressorOpt)
+                tree.DecisionTreeRegressor(**regressorOpt)
 
         reg = ensemble.BaggingRegressor(baseRegressor, **self.baggingRegressorOpt)
         if goodData_HR.shape[0] <= 1:
             reg.max_samples = 1.0
         reg = reg.fit(goodData_HR, goodData_LR, sample_weight=weight)
 
+        if self.compiledPredictor:
+            reg = CompiledTreeEnsemble.fromBaggingRegressor(reg)
+
         return reg
 
-    def _doPredict(self, inData, reg):
-        ''' Private function. Calls the regression tree.
+    def _fitWindows(self, fitArgs):
+        ''' Private function. Fits the regressions of the windows given as _fitWindow
+        argument tuples, in parallel processes if n_jobs is larger than 1, and returns
+        the fitted regressions and their metrics in the same order.
+        '''
+
+        if self.n_jobs > 1 and len(fitArgs) > 1:
+            # The workers receive the sharpener once, when they are started
+            with utils.processContext.Pool(processes=self.n_jobs,
+                                           initializer=_initSharpenerWorker,
+                                           initargs=(self,)) as pool:
+                return pool.starmap(_fitSharpenerWindow, fitArgs)
+        return [self._fitWindow(*args) for args in fitArgs]
+
+    def _fitWindow(self, i, goodData_LR, goodData_HR, weight, local):
+        ''' Private function. Fits the regression of window i and returns it together
+        with the metrics of the fit, which are reported by the calling process.
+        '''
+
+        with utils.stageMetrics("fit", window=i, samples=goodData_LR.size) as metrics:
+            reg = self._doFit(goodData_LR, goodData_HR, weight, local)
+        return reg, metrics
+
+    def _windowExecutor(self):
+        ''' Private function. Returns the executor used to predict the moving windows
+        concurrently, or None if they should be predicted sequentially.
+        '''
+
+        if self.n_jobs <= 1:
+            return None
+        if self.predictionExecutor == "processes":
+            return ProcessPoolExecutor(max_workers=self.n_jobs,
+                                       mp_context=utils.processContext,
+                                       initializer=_initSharpenerWorker,
+                                       initargs=(self,))
+        # The compiled kernels are parallel already, so threads would only contend for
+        # the cores
+        if self._predictsWithKernels():
+            return None
+        return ThreadPoolExecutor(max_workers=self.n_jobs)
+
+    def _predictsWithKernels(self):
+        ''' Private function. Returns True if the trained regressions are evaluated with
+        the parallel compiled kernels.
+        '''
+
+        return self.perLeafLinearRegression or any(isinstance(reg, CompiledTreeEnsemble)
+                                                   for reg in self.reg)
+
+    def _tileWindows(self, windows, x0, y0, nx, ny):
+        ''' Private function. Returns the parts of the windows, given as pixel extents
+        (see _windowPixelExtents), which overlap with the nx by ny pixels tile at x0, y0
+        as (regression index, rows, columns) tuples in tile pixel coordinates.
+        '''
+
+        tileWindows = []
+        for i, minY, maxY, minX, maxX in windows:
+            rows = slice(max(minY, y0) - y0, min(maxY, y0 + ny) - y0)
+            cols = slice(max(minX, x0) - x0, min(maxX, x0 + nx) - x0)
+            if rows.start < rows.stop and cols.start < cols.stop:
+                tileWindows.append((i, rows, cols))
+        return tileWindows
+
+    def _predictTile(self, inData, validPix, windows, x0, y0, executor=None):
+        ''' Private function. Predicts the local and global regressions in the tile of
+        inData at x0, y0 and returns them, or None instead of the local prediction if
+        there are no windows, in which case the global regression is applied to the whole
+        tile.
         '''
 
-        origShape = inData.shape
-        if len(origShape) == 3:
-            bands = origShape[2]
+        ny, nx = validPix.shape
+        outFullData = np.full((ny, nx), np.nan, dtype=self.dtype)
+        if not windows:
+            if self.reg[-1] is not None:
+                with self._measureStage("predict", window=len(self.reg)-1,
+                                        pixels=int(np.sum(validPix))):
+                    self._predictValidPixels(inData, validPix, self.reg[-1], outFullData)
+            return None, outFullData
+
+        outWindowData = np.full((ny, nx), np.nan, dtype=self.dtype)
+        self._predictWindows(inData, validPix, self._tileWindows(windows, x0, y0, nx, ny),
+                             outWindowData, outFullData, executor)
+        return outWindowData, outFullData
+
+    def _windowWeights(self, windowedResidual_LR, fullResidual_LR):
+        ''' Private function. Weights of the local (windowed) regression based on the
+        residuals of the local and global regressions (see section 2.3 of Gao paper).
+        '''
+
+        return (1/windowedResidual_LR)**2/((1/windowedResidual_LR)**2 + (1/fullResidual_LR)**2)
+
+    def _combineRegressions(self, outWindowData, outFullData, ww):
+        ''' Private function. Combines the local and global predictions with the weights
+        ww of the local predictions.
+        '''
+
+        ww = np.clip(ww, 0.0, 1.0)
+        # full weight
+        fw = 1 - ww
+        if self.disaggregatingTemperature:
+            return ((outWindowData**4)*ww + (outFullData**4)*fw)**0.25
+        return outWindowData*ww + outFullData*fw
+
+    def _predictWindows(self, inData, validPix, windows, outWindowData, outFullData,
+                        executor=None, progressCallback=None):
+        ''' Private function. Predicts the local regression of each window, given as a
+        (regression index, rows, columns) tuple, and the global regression within the
+        same window into outWindowData and outFullData. The windows do not overlap so
+        they can be predicted concurrently by the executor.
+        '''
+
+        if executor is None:
+            results = (self._predictWindow(inData[rows, cols, :], validPix[rows, cols], i) +
+                       (rows, cols) for i, rows, cols in windows)
         else:
-            bands = 1
-        # Do the actual decision tree regression
-        inData = inData.reshape((-1, bands))
-        outData = reg.predict(inData)
-        outData = outData.reshape((origShape[0], origShape[1]))
+            if isinstance(executor, ProcessPoolExecutor):
+                predictWindow = _predictSharpenerWindow
+            else:
+                predictWindow = self._predictWindow
+            futures = {executor.submit(predictWindow, inData[rows, cols, :],
+                                       validPix[rows, cols], i): (rows, cols)
+                       for i, rows, cols in windows}
+            results = (future.result() + futures[future] for future in as_completed(futures))
+
+        for windowNum, (windowData, fullData, metrics, rows, cols) in enumerate(results):
+            outWindowData[rows, cols] = windowData
+            if fullData is not None:
+                outFullData[rows, cols] = fullData
+            self._reportMetrics(metrics)
+            if progressCallback is not None:
+                progressCallback(windowNum + 1, len(windows))
+
+    def _predictWindow(self, inData, validPix, i):
+        ''' Private function. Returns the local regression i and the global regression
+        predicted within one window, or None instead of the global prediction if there is
+        no global regression, and the metrics of the prediction.
+        '''
 
-        return outData
+        with utils.stageMetrics("predict", window=i, pixels=int(np.sum(validPix))) as metrics:
+            windowData = np.full(validPix.shape, np.nan, dtype=self.dtype)
+            self._predictValidPixels(inData, validPix, self.reg[i], windowData)
+            fullData = None
+            if self.reg[-1] is not None:
+                fullData = np.full(validPix.shape, np.nan, dtype=self.dtype)
+                self._predictValidPixels(inData, validPix, self.reg[-1], fullData)
+        return windowData, fullData, metrics
+
+    def _predictValidPixels(self, inData, validPix, reg, outData):
+        ''' Private function. Compacts the valid pixels of inData (rows, columns, bands)
+        into a contiguous array of samples, applies the regression to them and scatters
+        the predictions into outData (rows, columns). Other pixels of outData are not
+        modified.
+        '''
 
-    def _calculateResidual(self, downscaledScene, originalScene, originalSceneQuality=None):
-        ''' Private function. Calculates residual between overlapping
-            high-resolution and low-resolution images.
+        if np.any(validPix):
+            outData[validPix] = self._doPredict(inData[validPix], reg)
+
+    def _doPredict(self, inData, reg):
+        ''' Private function. Calls the regression tree on the samples (pixels, bands).
+        '''
+
+        # Do the actual decision tree regression
+        return reg.predict(inData)
+
+    def _subsetLowResArrays(self, gt_HR, proj_HR, xSize_HR, ySize_HR, lowResScene,
+                            lowResQuality=None):
+        ''' Private function. Subsets and reprojects the low-resolution (data, geotransform,
+        projection) scene to the high-resolution grid and returns the geotransform of the
+        subset and its data, with bad quality pixels set to NaN.
         '''
 
-        # First subset and reproject original (low res) scene to fit with
-        # downscaled (high res) scene
-        subsetScene_LR = utils.reprojectSubsetLowResScene(downscaledScene,
-                                                          originalScene,
-                                                          resampleAlg=gdal.GRA_NearestNeighbour)
-        data_LR = subsetScene_LR.GetRasterBand(1).ReadAsArray().astype(float)
-        gt_LR = subsetScene_LR.GetGeoTransform()
+        data_LR, gt_LR, proj_LR = lowResScene
+        alignment = utils.alignGrids(proj_HR, gt_HR, xSize_HR, ySize_HR,
+                                     proj_LR, gt_LR, data_LR.shape[1], data_LR.shape[0])
+        subset_LR = alignment.subsetLowResArray(data_LR).astype(self.dtype)
 
-        # If quality file for the low res scene is provided then mask out all
-        # bad quality pixels in the subsetted LR scene. Otherwise assume that all
+        # If quality flags for the low res data are provided then mask out all
+        # bad quality pixels in the subsetted LR data. Otherwise assume that all
         # low res pixels are of good quality.
-        if originalSceneQuality is not None:
-            subsetQuality_LR = utils.reprojectSubsetLowResScene(downscaledScene,
-                                                                originalSceneQuality,
-                                                                resampleAlg=gdal.GRA_NearestNeighbour)
-            goodPixMask_LR = subsetQuality_LR.GetRasterBand(1).ReadAsArray()
-            goodPixMask_LR = np.in1d(goodPixMask_LR.ravel(),
+        if lowResQuality is not None:
+            goodPixMask_LR = alignment.subsetLowResArray(lowResQuality)
+            goodPixMask_LR = np.isin(goodPixMask_LR.ravel(),
                                      self.lowResGoodQualityFlags).reshape(goodPixMask_LR.shape)
-            data_LR[~goodPixMask_LR] = np.nan
+            subset_LR[~goodPixMask_LR] = np.nan
+
+        return alignment.gt_LR, subset_LR
+
+    def _tileStripRows(self, tileSize, gt_HR, gt_LR, xSize_HR):
+        ''' Private function. Returns the number of low-resolution rows aggregated at a time
+        when a scene is processed in tiles of tileSize high-resolution pixels. Unless
+        aggregationStripRows is set the strips are sized to hold about as many
+        high-resolution pixels as one tile.
+        '''
+
+        if self.aggregationStripRows is not None:
+            return self.aggregationStripRows
+        rowsPerPixel_LR = max(1.0, abs(gt_LR[5] / gt_HR[5]))
+        rows_HR = max(1.0, float(tileSize) * tileSize / xSize_HR)
+        return max(1, int(rows_HR / rowsPerPixel_LR))
+
+    def _residualToLowRes(self, downscaled, gt_LR, data_LR, gt_HR=None, stripRows=None):
+        ''' Private function. Resamples the downscaled image, either a GDAL scene or an
+        array with geotransform gt_HR, to the grid of the subset low-resolution data with
+        geotransform gt_LR and returns its residual to the low-resolution data. A scene is
+        read in strips of stripRows low-resolution rows (aggregationStripRows by default).
+        '''
 
-        # Then resample high res scene to low res pixel size
+        if stripRows is None:
+            stripRows = self.aggregationStripRows
+
+        # When working with tempratures they should be converted to
+        # radiance values before aggregating to be physically accurate.
         if self.disaggregatingTemperature:
-            # When working with tempratures they should be converted to
-            # radiance values before aggregating to be physically accurate.
-            radianceScene = utils.saveImg(downscaledScene.GetRasterBand(1).ReadAsArray()**4,
-                                          downscaledScene.GetGeoTransform(),
-                                          downscaledScene.GetProjection(),
-                                          "MEM",
-                                          noDataValue=np.nan)
-            resMean, _ = utils.resampleHighResToLowRes(radianceScene,
-                                                       subsetScene_LR)
-            # Find the residual (difference) between the two)
-            residual_LR = data_LR - resMean[:, :, 0]**0.25
+            exponent = 4
+        else:
+            exponent = 1
+
+        # Resample high res data to low res pixel size
+        if isinstance(downscaled, np.ndarray):
+            resMean, _ = utils.aggregateHighResToLowRes(downscaled[:, :, np.newaxis]**exponent,
+                                                        gt_HR,
+                                                        gt_LR,
+                                                        data_LR.shape[1],
+                                                        data_LR.shape[0])
+            resMean = resMean.astype(self.dtype)
         else:
-            resMean, _ = utils.resampleHighResToLowRes(downscaledScene,
-                                                       subsetScene_LR)
-            # Find the residual (difference) between the two
-            residual_LR = data_LR - resMean[:, :, 0]
+            resMean, _ = utils.aggregateRasterToLowRes(downscaled,
+                                                       gt_LR,
+                                                       data_LR.shape[1],
+                                                       data_LR.shape[0],
+                                                       stripRows=stripRows,
+                                                       exponent=exponent,
+                                                       dtype=self.dtype)
 
-        return residual_LR, gt_LR
+        # Find the residual (difference) between the two
+        return data_LR - resMean[:, :, 0]**(1.0/exponent)
 
 
 class CubistSharpener(DecisionTreeSharpener):
@@ -806,6 +1967,12 @@ class CubistSharpener(DecisionTreeSharpener):
 
     n_processes: int (optional, default: 3)
         Number of parallel processes to use during application of Cubist regression.
+        The processes are started at the first prediction, receive the trained
+        models once and are kept until close is called or the sharpener is deleted.
+
+    n_jobs, predictionExecutor, aggregationStripRows, cacheDir, cacheMaxBytes, dtype,
+    metricsCallback: (optional)
+        See DecisionTreeSharpener.
 
     regressorOpt: dictionary (optional, default: {})
         Options to pass to cubist regressor constructor See
@@ -838,8 +2005,16 @@ class CubistSharpener(DecisionTreeSharpener):
                  n_processes=3,
                  linearRegressionExtrapolationRatio=0.25,
                  regressorOpt={},
-                 baggingRegressorOpt={}):
-
+                 baggingRegressorOpt={},
+                 n_jobs=1,
+                 predictionExecutor="threads",
+                 aggregationStripRows=None,
+                 cacheDir=None,
+                 cacheMaxBytes=10*1024**3,
+                 dtype="float64",
+                 metricsCallback=None):
+
+        regressorOpt = regressorOpt.copy()
         regressorOpt.setdefault("n_committees", 5)
         regressorOpt.setdefault("composite", True)
         regressorOpt.setdefault("neighbors", 3)
@@ -851,10 +2026,17 @@ class CubistSharpener(DecisionTreeSharpener):
                                               lowResGoodQualityFlags,
                                               cvHomogeneityThreshold,
                                               movingWindowSize,
-                                              disaggregatingTemperature,
+                                              disaggregatingTemperature=disaggregatingTemperature,
                                               linearRegressionExtrapolationRatio=linearRegressionExtrapolationRatio,
                                               regressorOpt=regressorOpt,
-                                              baggingRegressorOpt=baggingRegressorOpt)
+                                              baggingRegressorOpt=baggingRegressorOpt,
+                                              n_jobs=n_jobs,
+                                              predictionExecutor=predictionExecutor,
+                                              aggregationStripRows=aggregationStripRows,
+                                              cacheDir=cacheDir,
+                                              cacheMaxBytes=cacheMaxBytes,
+                                              dtype=dtype,
+                                              metricsCallback=metricsCallback)
         self.n_processes = n_processes
 
     def _doFit(self, goodData_LR, goodData_HR, weight, local):
@@ -865,36 +2047,218 @@ class CubistSharpener(DecisionTreeSharpener):
         # install but this shouldn't prevent the use of other parts of pyDMS.
         from cubist import Cubist
 
+        # Work on a copy of the options since fits might run concurrently
+        regressorOpt = self.regressorOpt.copy()
+
         # For local regression constrain the number of rules - section 2.3
         if local:
-            self.regressorOpt["n_rules"] = 5
+            regressorOpt["n_rules"] = 5
         else:
-            self.regressorOpt["n_rules"] = 500
-        reg = Cubist(**self.regressorOpt)
+            regressorOpt["n_rules"] = 500
+        reg = Cubist(**regressorOpt)
         reg = reg.fit(goodData_HR, goodData_LR, sample_weight=weight)
 
         return reg
 
+    def _exportModel(self, reg):
+        ''' Private function. Converts a trained cubist model to a dictionary of arrays. The
+        rule set and the (compressed) names and data descriptions, which the cubist library
+        keeps as strings, are stored as byte arrays.
+        '''
+
+        # Releases of cubist before 1.0 name the compressed strings names_string_ and
+        # data_string_
+        names = getattr(reg, "_names_string", None) or reg.names_string_
+        data = getattr(reg, "_data_string", None) or reg.data_string_
+        return {"model": np.frombuffer(reg.model_.encode(), dtype=np.uint8),
+                "names": np.frombuffer(names, dtype=np.uint8),
+                "data": np.frombuffer(data, dtype=np.uint8),
+                "featureNames": np.array(reg.feature_names_in_, dtype=str),
+                "sampleWeighted": np.array(reg.is_sample_weighted_)}
+
+    def _importModel(self, arrays):
+        ''' Private function. Creates a cubist model, which can be used for prediction,
+        from a dictionary of arrays.
+        '''
+
+        from cubist import Cubist
+
+        reg = Cubist(**self.regressorOpt)
+        reg.model_ = np.asarray(arrays["model"]).tobytes().decode()
+        reg._names_string = reg.names_string_ = np.asarray(arrays["names"]).tobytes()
+        reg._data_string = reg.data_string_ = np.asarray(arrays["data"]).tobytes()
+        reg.feature_names_in_ = [str(name) for name in arrays["featureNames"]]
+        reg.n_features_in_ = len(reg.feature_names_in_)
+        reg.n_outputs_ = 1
+        reg.is_sample_weighted_ = bool(arrays["sampleWeighted"])
+        return reg
+
+    def close(self):
+        ''' Stop the worker processes used to apply the cubist regressions. They are
+        started again if the sharpener is used after it is closed.
+
+        Returns
+        -------
+        None
+        '''
+
+        with _cubistPoolLock:
+            finalizer = getattr(self, "_predictionPoolFinalizer", None)
+            if finalizer is not None:
+                finalizer.detach()
+                self._predictionPool.close()
+                self._predictionPool.join()
+            self._predictionPool = None
+            self._predictionPoolModels = None
+            self._predictionPoolFinalizer = None
+
+    def __getstate__(self):
+        # The worker pool stays with the process which started it
+        state = super().__getstate__()
+        for key in ("_predictionPool", "_predictionPoolModels", "_predictionPoolFinalizer"):
+            state.pop(key, None)
+        return state
+
+    def _predictsWithKernels(self):
+        ''' Private function. Cubist models are not evaluated with the compiled kernels.
+        '''
+
+        return False
+
+    def _predictionPoolFor(self, reg):
+        ''' Private function. Returns the pool of worker processes holding the trained
+        models and the index of reg among them, or None if reg is not one of the trained
+        models. The pool is started for all the trained models when first needed and only
+        restarted once the sharpener has been retrained, so that windows predicted
+        concurrently never see it restarted.
+        '''
+
+        with _cubistPoolLock:
+            models = getattr(self, "_predictionPoolModels", None)
+            if models is None or len(models) != len(self.reg) or \
+                    any(model is not trained for model, trained in zip(models, self.reg)):
+                self.close()
+                models = list(self.reg)
+                # The workers share the resource tracker of this process, which is
+                # responsible for the shared memory buffers, and receive the models once,
+                # when they start
+                resource_tracker.ensure_running()
+                pool = utils.processContext.Pool(processes=self.n_processes,
+                                                 initializer=_initCubistWorker,
+                                                 initargs=(models,))
+                self._predictionPool = pool
+                self._predictionPoolModels = models
+                self._predictionPoolFinalizer = weakref.finalize(self, pool.terminate)
+            for index, model in enumerate(models):
+                if model is reg:
+                    return self._predictionPool, index
+        return None
+
     def _doPredict(self, inData, reg):
         ''' Private function. Applies the cubist regression. The free version of cubist does not
-        support native (C) parallelization so we do it in Python.
+        support native (C) parallelization so we do it in Python, in a pool of worker processes
+        which read the samples from and write the predictions to shared memory.
         '''
 
-        origShape = inData.shape
-        if len(origShape) == 3:
-            bands = origShape[2]
-        else:
-            bands = 1
         # Do the actual cubist regression
-        inData = inData.reshape((-1, bands))
-        chunks = np.array_split(inData, self.n_processes)
-        with Pool(processes=self.n_processes) as pool:
-            res_chunks = pool.map(reg.predict, chunks)
-        outData = np.concatenate(res_chunks)
-        outData = outData.reshape((origShape[0], origShape[1]))
+        numSamples = inData.shape[0]
+        if self.n_processes <= 1 or numSamples < self.n_processes:
+            return reg.predict(inData)
+
+        poolAndIndex = self._predictionPoolFor(reg)
+        if poolAndIndex is None:
+            return reg.predict(inData)
+        pool, index = poolAndIndex
+        inData = np.ascontiguousarray(inData)
+        inBuffer = shared_memory.SharedMemory(create=True, size=inData.nbytes)
+        outBuffer = shared_memory.SharedMemory(create=True, size=numSamples * 8)
+        try:
+            np.ndarray(inData.shape, dtype=inData.dtype, buffer=inBuffer.buf)[:] = inData
+            bounds = np.linspace(0, numSamples, self.n_processes + 1).astype(int)
+            pool.starmap(_predictCubistChunk,
+                         [(index, inBuffer.name, inData.shape, inData.dtype.str, outBuffer.name,
+                           start, stop) for start, stop in zip(bounds[:-1], bounds[1:])])
+            outData = np.ndarray(numSamples, dtype=np.float64, buffer=outBuffer.buf).copy()
+        finally:
+            inBuffer.close()
+            inBuffer.unlink()
+            outBuffer.close()
+            outBuffer.unlink()
 
         return outData
 
+
+class MLPEnsemble:
+    ''' Array representation of a trained bagging ensemble of scikit-learn
+    MLPRegressor networks. The output is equal to that of the original
+    BaggingRegressor.
+
+    Parameters
+    ----------
+    coefs: list of arrays, shape = [n_estimators, n_inputs, n_outputs]
+        Weights of each layer of all the networks.
+
+    intercepts: list of arrays, shape = [n_estimators, n_outputs]
+        Biases of each layer of all the networks.
+
+    features: array, shape = [n_estimators, n_features]
+        Indices of the input features used by each network.
+
+    activation: string (optional, default: "relu")
+        Activation function of the hidden layers.
+
+    Returns
+    -------
+    None
+    '''
+    def __init__(self, coefs, intercepts, features, activation="relu"):
+        self.coefs = coefs
+        self.intercepts = intercepts
+        self.features = features
+        self.activation = activation
+
+    @classmethod
+    def fromBaggingRegressor(cls, reg):
+        ''' Export a trained BaggingRegressor of MLPRegressor estimators to arrays.
+        '''
+
+        return cls.fromNetworks(reg.estimators_, reg.estimators_features_)
+
+    @classmethod
+    def fromNetworks(cls, networks, features):
+        ''' Export trained MLPRegressor networks of the same architecture, each using the
+        given indices of the input features, to arrays.
+        '''
+
+        layers = len(networks[0].coefs_)
+        coefs = [np.stack([network.coefs_[layer] for network in networks])
+                 for layer in range(layers)]
+        intercepts = [np.stack([network.intercepts_[layer] for network in networks])
+                      for layer in range(layers)]
+        return cls(coefs, intercepts, np.stack(features), networks[0].activation)
+
+    def predict(self, X):
+        ''' Predict regression value for X averaged over all the networks.
+        '''
+
+        y = np.zeros(X.shape[0])
+        for estimator in range(self.features.shape[0]):
+            activations = X[:, self.features[estimator]]
+            for layer in range(len(self.coefs)):
+                activations = activations @ self.coefs[layer][estimator] + \
+                    self.intercepts[layer][estimator]
+                if layer < len(self.coefs) - 1:
+                    activations = _MLP_ACTIVATIONS[self.activation](activations)
+            y += activations[:, 0]
+        return y / self.features.shape[0]
+
+
+_MLP_ACTIVATIONS = {"identity": lambda x: x,
+                    "logistic": lambda x: 1 / (1 + np.exp(-x)),
+                    "tanh": np.tanh,
+                    "relu": lambda x: np.maximum(x, 0)}
+
+
 class NeuralNetworkSharpener(DecisionTreeSharpener):
     ''' Neural Network based sharpening (disaggregation) of low-resolution
     images using high-resolution images. The implementation is mostly based on [Gao2012] as
@@ -972,6 +2336,23 @@ class NeuralNetworkSharpener(DecisionTreeSharpener):
         http://scikit-learn.org/stable/modules/generated/sklearn.ensemble.BaggingRegressor.html
         for possibilities.
 
+    n_jobs, predictionExecutor, aggregationStripRows, cacheDir, cacheMaxBytes, dtype,
+    metricsCallback: (optional)
+        See DecisionTreeSharpener.
+
+    warmStartLocal: boolean (optional, default: False)
+        If True, each bagged network of the local (moving window) regressions is
+        initialised with the weights of the corresponding network of the global
+        regression and trained on a bootstrap sample of the window's samples, scaled
+        as the global samples, for at most localMaxIter iterations. This is much
+        faster than training the local networks from random initialisation. The
+        global regression is then fitted before the local ones, with its bagged
+        networks trained in n_jobs parallel processes. Only used with scikit-learn
+        networks.
+
+    localMaxIter: int (optional, default: 50)
+        Maximum number of training iterations of the warm started local networks.
+
 
     Returns
     -------
@@ -995,7 +2376,16 @@ class NeuralNetworkSharpener(DecisionTreeSharpener):
                  disaggregatingTemperature=False,
                  regressionType=REG_sknn_ann,
                  regressorOpt={},
-                 baggingRegressorOpt={}):
+                 baggingRegressorOpt={},
+                 n_jobs=1,
+                 predictionExecutor="threads",
+                 aggregationStripRows=None,
+                 cacheDir=None,
+                 cacheMaxBytes=10*1024**3,
+                 dtype="float64",
+                 metricsCallback=None,
+                 warmStartLocal=False,
+                 localMaxIter=50):
 
         super(NeuralNetworkSharpener, self).__init__(highResFiles,
                                                      lowResFiles,
@@ -1003,70 +2393,261 @@ class NeuralNetworkSharpener(DecisionTreeSharpener):
                                                      lowResGoodQualityFlags,
                                                      cvHomogeneityThreshold,
                                                      movingWindowSize,
-                                                     disaggregatingTemperature,
+                                                     disaggregatingTemperature=disaggregatingTemperature,
                                                      regressorOpt=regressorOpt,
-                                                     baggingRegressorOpt=baggingRegressorOpt)
+                                                     baggingRegressorOpt=baggingRegressorOpt,
+                                                     n_jobs=n_jobs,
+                                                     predictionExecutor=predictionExecutor,
+                                                     aggregationStripRows=aggregationStripRows,
+                                                     cacheDir=cacheDir,
+                                                     cacheMaxBytes=cacheMaxBytes,
+                                                     dtype=dtype,
+                                                     metricsCallback=metricsCallback)
         self.regressionType = regressionType
+        self.warmStartLocal = warmStartLocal
+        self.localMaxIter = localMaxIter
         # Move the import of sknn here because this library is not easy to
         # install but this shouldn't prevent the use of other parts of pyDMS.
         if self.regressionType == REG_sknn_ann:
             import sknn.mlp as ann_sknn
 
+    def _warmStartsLocal(self):
+        ''' Private function. Returns True if the local networks are warm started from the
+        global network.
+        '''
+
+        return self.warmStartLocal and self.regressionType == REG_sklearn_ann
+
+    def _fitWindows(self, fitArgs):
+        ''' Private function. When the local networks are warm started, fits the global
+        network first, so that its bagged networks are trained in parallel and the local
+        networks can be warm started from it, and then the local networks.
+        '''
+
+        if not self._warmStartsLocal() or not fitArgs or fitArgs[-1][-1]:
+            # Not warm started or there are samples only for local regressions
+            return super()._fitWindows(fitArgs)
+
+        globalFit = self._fitWindow(*fitArgs[-1])
+        self._globalNetwork = globalFit[0]
+        try:
+            localFits = super()._fitWindows(fitArgs[:-1])
+        finally:
+            self.__dict__.pop("_globalNetwork", None)
+        return localFits + [globalFit]
+
+    def _fitWindow(self, i, goodData_LR, goodData_HR, weight, local):
+        ''' Private function. Fits the network of window i, warm started from the global
+        network if it has been fitted already (see _fitWindows).
+        '''
+
+        if local and getattr(self, "_globalNetwork", None) is not None:
+            with utils.stageMetrics("fit", window=i, samples=goodData_LR.size) as metrics:
+                nn = self._fitWarmStarted(i, goodData_LR, goodData_HR, self._globalNetwork)
+            return nn, metrics
+        return super()._fitWindow(i, goodData_LR, goodData_HR, weight, local)
+
     def _doFit(self, goodData_LR, goodData_HR, weight, local):
         ''' Private function. Fits the neural network.
         '''
 
         # Once all the samples have been picked build the regression using
         # neural network approach
-        print('Fitting neural network')
+        log.info("Fitting neural network")
         HR_scaler = preprocessing.StandardScaler()
         data_HR = HR_scaler.fit_transform(goodData_HR)
         LR_scaler = preprocessing.StandardScaler()
         data_LR = LR_scaler.fit_transform(goodData_LR.reshape(-1, 1))
+        # Work on a copy of the options since fits might run concurrently
+        regressorOpt = self.regressorOpt.copy()
         if self.regressionType == REG_sknn_ann:
+            import sknn.mlp as ann_sknn
             layers = []
-            if 'hidden_layer_sizes' in self.regressorOpt.keys():
-                for layer in self.regressorOpt['hidden_layer_sizes']:
-                    layers.append(ann_sknn.Layer(self.regressorOpt['activation'], units=layer))
+            if 'hidden_layer_sizes' in regressorOpt.keys():
+                for layer in regressorOpt['hidden_layer_sizes']:
+                    layers.append(ann_sknn.Layer(regressorOpt['activation'], units=layer))
             else:
-                layers.append(ann_sknn.Layer(self.regressorOpt['activation'], units=100))
-            self.regressorOpt.pop('activation')
-            self.regressorOpt.pop('hidden_layer_sizes')
+                layers.append(ann_sknn.Layer(regressorOpt['activation'], units=100))
+            regressorOpt.pop('activation')
+            regressorOpt.pop('hidden_layer_sizes', None)
             output_layer = ann_sknn.Layer('Linear', units=1)
             layers.append(output_layer)
-            baseRegressor = ann_sknn.Regressor(layers, **self.regressorOpt)
+            baseRegressor = ann_sknn.Regressor(layers, **regressorOpt)
         else:
-            baseRegressor = ann_sklearn.MLPRegressor(**self.regressorOpt)
+            baseRegressor = ann_sklearn.MLPRegressor(**regressorOpt)
 
         # NN regressors do not support sample weights.
         weight = None
 
-        reg = ensemble.BaggingRegressor(baseRegressor, **self.baggingRegressorOpt)
+        baggingRegressorOpt = self.baggingRegressorOpt.copy()
+        if not local and self._warmStartsLocal():
+            # The global network is fitted on its own so train the bagged networks in
+            # parallel
+            baggingRegressorOpt.setdefault("n_jobs", self.n_jobs)
+        reg = ensemble.BaggingRegressor(baseRegressor, **baggingRegressorOpt)
         if data_HR.shape[0] <= 1:
             reg.max_samples = 1.0
         reg = reg.fit(data_HR, np.ravel(data_LR), sample_weight=weight)
 
         return {"reg": reg, "HR_scaler": HR_scaler, "LR_scaler": LR_scaler}
 
+    def _fitWarmStarted(self, i, goodData_LR, goodData_HR, globalNetwork):
+        ''' Private function. Fits the local network of window i by continuing the
+        training of each of the bagged global networks on a bootstrap sample of the local
+        samples. Each window draws its samples from its own seed derived from the bagging
+        random_state.
+        '''
+
+        HR_scaler = globalNetwork["HR_scaler"]
+        LR_scaler = globalNetwork["LR_scaler"]
+        data_HR = HR_scaler.transform(goodData_HR)
+        data_LR = LR_scaler.transform(goodData_LR.reshape(-1, 1))[:, 0]
+
+        globalReg = globalNetwork["reg"]
+        rng = np.random.default_rng(np.random.SeedSequence(
+            self.baggingRegressorOpt.get("random_state"), spawn_key=(i,)))
+        networks = []
+        for network, features in zip(globalReg.estimators_, globalReg.estimators_features_):
+            network = copy.deepcopy(network)
+            network.set_params(warm_start=True, max_iter=self.localMaxIter)
+            sample = rng.integers(0, data_HR.shape[0], data_HR.shape[0])
+            # The number of iterations is capped so the networks are not expected to
+            # converge
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", ConvergenceWarning)
+                network.fit(data_HR[sample][:, features], data_LR[sample])
+            networks.append(network)
+
+        return {"reg": MLPEnsemble.fromNetworks(networks, globalReg.estimators_features_),
+                "HR_scaler": HR_scaler,
+                "LR_scaler": LR_scaler}
+
+    def save(self, path):
+        ''' Save the trained sharpener to a directory (see DecisionTreeSharpener.save).
+        Only scikit-learn neural networks (regressionType REG_sklearn_ann) can be saved,
+        otherwise TypeError is raised.
+        '''
+
+        if self.regressionType != REG_sklearn_ann:
+            raise TypeError("Only scikit-learn neural networks (REG_sklearn_ann) can be saved")
+        super().save(path)
+
+    def _exportModel(self, nn):
+        ''' Private function. Converts a trained neural network and its scalers to a
+        dictionary of arrays.
+        '''
+
+        reg = nn["reg"]
+        if not isinstance(reg, MLPEnsemble):
+            reg = MLPEnsemble.fromBaggingRegressor(reg)
+        arrays = {"features": reg.features,
+                  "activation": np.array(reg.activation),
+                  "HR_mean": nn["HR_scaler"].mean_,
+                  "HR_scale": nn["HR_scaler"].scale_,
+                  "LR_mean": nn["LR_scaler"].mean_,
+                  "LR_scale": nn["LR_scaler"].scale_}
+        for layer in range(len(reg.coefs)):
+            arrays[f"coef_{layer}"] = reg.coefs[layer]
+            arrays[f"intercept_{layer}"] = reg.intercepts[layer]
+        return arrays
+
+    def _importModel(self, arrays):
+        ''' Private function. Creates a neural network and its scalers from a dictionary
+        of arrays.
+        '''
+
+        layers = len([name for name in arrays if name.startswith("coef_")])
+        reg = MLPEnsemble([arrays[f"coef_{layer}"] for layer in range(layers)],
+                          [arrays[f"intercept_{layer}"] for layer in range(layers)],
+                          arrays["features"],
+                          str(arrays["activation"]))
+        return {"reg": reg,
+                "HR_scaler": _standardScaler(arrays["HR_mean"], arrays["HR_scale"]),
+                "LR_scaler": _standardScaler(arrays["LR_mean"], arrays["LR_scale"])}
+
+    def _predictsWithKernels(self):
+        ''' Private function. Neural networks are not evaluated with the compiled kernels.
+        '''
+
+        return False
+
     def _doPredict(self, inData, nn):
-        ''' Private function. Calls the neural network.
+        ''' Private function. Calls the neural network on the samples (pixels, bands).
         '''
 
         reg = nn["reg"]
         HR_scaler = nn["HR_scaler"]
         LR_scaler = nn["LR_scaler"]
 
-        origShape = inData.shape
-        if len(origShape) == 3:
-            bands = origShape[2]
-        else:
-            bands = 1
-
         # Do the actual neural network regression
-        inData = inData.reshape((-1, bands))
         inData = HR_scaler.transform(inData)
         outData = reg.predict(inData)
-        outData = LR_scaler.inverse_transform(outData)
-        outData = outData.reshape((origShape[0], origShape[1]))
+        outData = LR_scaler.inverse_transform(outData.reshape(-1, 1))[:, 0]
 
         return outData
+
+
+# Sharpener shared by the scenes or windows processed in a worker process
+_workerSharpener = None
+
+
+def _initSharpenerWorker(sharpener):
+    global _workerSharpener
+    # The work is already done in parallel so don't start nested pools
+    sharpener.n_jobs = 1
+    if hasattr(sharpener, "n_processes"):
+        sharpener.n_processes = 1
+    _workerSharpener = sharpener
+
+
+# Trained cubist models held by a CubistSharpener prediction worker process
+_workerCubistModels = None
+
+# Serialises starting and stopping the CubistSharpener prediction pools
+_cubistPoolLock = threading.RLock()
+
+
+def _initCubistWorker(models):
+    global _workerCubistModels
+    _workerCubistModels = models
+
+
+# Predict the samples start to stop of the shared memory input buffer with cubist
+# model index and write them to the shared memory output buffer
+def _predictCubistChunk(index, inName, shape, dtype, outName, start, stop):
+    inBuffer = shared_memory.SharedMemory(name=inName)
+    outBuffer = shared_memory.SharedMemory(name=outName)
+    try:
+        inData = np.ndarray(shape, dtype=dtype, buffer=inBuffer.buf)
+        outData = np.ndarray(shape[0], dtype=np.float64, buffer=outBuffer.buf)
+        outData[start:stop] = _workerCubistModels[index].predict(inData[start:stop])
+        # Release the views before closing the buffers
+        del inData, outData
+    finally:
+        inBuffer.close()
+        outBuffer.close()
+
+
+def _sharpenSeriesScene(*args):
+    return _workerSharpener._sharpenScene(*args)
+
+
+def _fitSharpenerWindow(*args):
+    return _workerSharpener._fitWindow(*args)
+
+
+def _predictSharpenerWindow(*args):
+    return _workerSharpener._predictWindow(*args)
+
+
+def _standardScaler(mean, scale):
+    ''' Private function. Creates a fitted StandardScaler from its parameters.
+    '''
+
+    scaler = preprocessing.StandardScaler()
+    scaler.mean_ = np.asarray(mean)
+    scaler.scale_ = np.asarray(scale)
+    scaler.var_ = scaler.scale_**2
+    scaler.n_features_in_ = scaler.mean_.size
+    scaler.n_samples_seen_ = 0
+    return scaler
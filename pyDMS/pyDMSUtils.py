@@ -4,16 +4,42 @@
 Copyright: (C) 2017, Radoslaw Guzinski
 """
 
+import contextlib
+import functools
+import hashlib
+import json
+import logging
 import math
+import multiprocessing
 import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
 
 import numpy as np
 import scipy.ndimage as ndi
-from numba import njit, stencil
+from numba import njit, prange
 
 from osgeo import gdal
 from pyproj import Proj, Transformer
 
+log = logging.getLogger(__name__)
+
+# Start method context of all the worker process pools. Forking a process in which the
+# numba kernels have started their thread pool is not safe, so the workers are started
+# by a fork server where it is available.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    processContext = multiprocessing.get_context("forkserver")
+else:
+    processContext = multiprocessing.get_context()
+
 
 def openRaster(raster):
     closeOnExit = True
@@ -78,51 +104,41 @@ def pix2point(pix, gt):
 
 
 # save the data to geotiff or memory
-def saveImg(data, geotransform, proj, outPath, noDataValue=None, fieldNames=[]):
+def saveImg(data, geotransform, proj, outPath, noDataValue=None, fieldNames=[],
+            computeStats=True, cog=False):
     outPath = str(outPath)
 
-    # Save to memory first
-    is_netCDF = False
-    memDriver = gdal.GetDriverByName("MEM")
     shape = data.shape
     if len(shape) > 2:
-        ds = memDriver.Create("MEM", shape[1], shape[0], shape[2], gdal.GDT_Float32)
-        ds.SetProjection(proj)
-        ds.SetGeoTransform(geotransform)
-        for i in range(shape[2]):
-            ds.GetRasterBand(i+1).WriteArray(data[:, :, i])
+        bands = shape[2]
     else:
-        ds = memDriver.Create("MEM", shape[1], shape[0], 1, gdal.GDT_Float32)
-        ds.SetProjection(proj)
-        ds.SetGeoTransform(geotransform)
-        ds.GetRasterBand(1).WriteArray(data)
+        bands = 1
+
+    # If the output file has .nc extension then save it as netCDF (through
+    # memory), otherwise write it directly to tiled GeoTIFF (optionally COG)
+    is_netCDF = outPath != "MEM" and os.path.splitext(outPath)[1].lower() == ".nc"
+    if outPath == "MEM" or is_netCDF:
+        writer = RasterWriter("MEM", shape[1], shape[0], bands, geotransform, proj)
+    else:
+        writer = RasterWriter(outPath, shape[1], shape[0], bands, geotransform, proj,
+                              noDataValue=noDataValue, cog=cog, computeStats=computeStats)
+    writer.write(data)
+    ds = writer.close()
 
-    # Save to file if required
     if outPath == "MEM":
         if noDataValue is None:
             noDataValue = np.nan
         ds.GetRasterBand(1).SetNoDataValue(noDataValue)
-    else:
-        # If the output file has .nc extension then save it as netCDF,
-        # otherwise assume that the output should be a GeoTIFF (COG)
-        ext = os.path.splitext(outPath)[1]
-        if ext.lower() == ".nc":
-            fileFormat = "netCDF"
-            driverOpt = ["FORMAT=NC2"]
-            is_netCDF = True
-        else:
-            fileFormat = "COG"
-            driverOpt = ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BIGTIFF=IF_SAFER']
-        out_ds = gdal.Translate(outPath, ds, format=fileFormat, creationOptions=driverOpt,
-                                noData=noDataValue, stats=True)
+    elif is_netCDF:
+        out_ds = gdal.Translate(outPath, ds, format="netCDF", creationOptions=["FORMAT=NC2"],
+                                noData=noDataValue, stats=computeStats)
         # If GDAL driers for other formats do not exist then default to GeoTiff
         if out_ds is None:
-            print("Warning: Selected GDAL driver is not supported! Saving as GeoTiff!")
-            fileFormat = "GTiff"
+            log.warning("Selected GDAL driver is not supported! Saving as GeoTiff!")
             driverOpt = ['COMPRESS=DEFLATE', 'PREDICTOR=1', 'BIGTIFF=IF_SAFER']
             is_netCDF = False
-            ds = gdal.Translate(outPath, ds, format=fileFormat, creationOptions=driverOpt,
-                                noData=noDataValue, stats=True)
+            ds = gdal.Translate(outPath, ds, format="GTiff", creationOptions=driverOpt,
+                                noData=noDataValue, stats=computeStats)
         else:
             ds = out_ds
 
@@ -140,163 +156,800 @@ def saveImg(data, geotransform, proj, outPath, noDataValue=None, fieldNames=[]):
             ds.close()
             ds = gdal.Open('NETCDF:"'+outPath+'":'+fieldNames[0])
 
-        print('Saved ' + outPath)
+    if outPath != "MEM":
+        log.info("Saved %s", outPath)
 
     return ds
 
 
-def binomialSmoother(data):
-    def filterFunction(footprint):
-        weight = [1, 2, 1, 2, 4, 2, 1, 2, 1]
-        # Don't smooth land and invalid pixels
-        if np.isnan(footprint[4]):
-            return footprint[4]
-
-        footprintSum = 0
-        weightSum = 0
-        for i in range(len(weight)):
-            # Don't use land and invalid pixels in smoothing of other pixels
-            if not np.isnan(footprint[i]):
-                footprintSum = footprintSum + weight[i] * footprint[i]
-                weightSum = weightSum + weight[i]
-        try:
-            ans = footprintSum/weightSum
-        except ZeroDivisionError:
-            ans = footprint[4]
-        return ans
+class RasterWriter:
+    ''' Incremental raster writer. The output is created directly on disk as a
+    tiled, compressed GeoTIFF to which blocks of data can be written as they
+    are produced, so that the whole raster never needs to be held in memory.
+    Internal overviews and (optionally) statistics are created in the same
+    file when the writer is closed.
+
+    Parameters
+    ----------
+    outPath: string
+        Path to the output file or "MEM" for an in-memory dataset.
+
+    xSize, ySize, bands: integers
+        Size of the output raster.
+
+    geotransform: list of floats
+        GDAL geotransform of the output raster.
+
+    proj: string
+        Projection of the output raster in WKT or other GDAL supported format.
+
+    noDataValue: float (optional, default: None)
+        No-data value to be set on all the bands.
+
+    dataType: GDAL data type (optional, default: gdal.GDT_Float32)
+        Data type of the output raster.
+
+    cog: boolean (optional, default: False)
+        Flag indicating whether the file should be converted to Cloud Optimized
+        GeoTIFF when closed. The COG layout can only be created by copying, so
+        the blocks are then written to a temporary file in the output directory
+        which is copied to the output file when closed, needing twice the disk
+        space and a second pass over the data. If COG driver is not available
+        then a tiled GeoTIFF is produced.
+
+    buildOverviews: boolean (optional, default: True)
+        Flag indicating whether overviews should be built when closed.
+
+    computeStats: boolean (optional, default: False)
+        Flag indicating whether band statistics should be computed when closed.
+
+    Returns
+    -------
+    None
+    '''
+    def __init__(self, outPath, xSize, ySize, bands, geotransform, proj, noDataValue=None,
+                 dataType=gdal.GDT_Float32, cog=False, buildOverviews=True, computeStats=False):
+        self.outPath = str(outPath)
+        self.xSize = xSize
+        self.ySize = ySize
+        self.computeStats = computeStats
+
+        if self.outPath == "MEM":
+            self.cog = False
+            self.buildOverviews = False
+            self.ds = gdal.GetDriverByName("MEM").Create("MEM", xSize, ySize, bands, dataType)
+            self.ds.SetProjection(proj)
+            self.ds.SetGeoTransform(geotransform)
+        else:
+            self.cog = cog
+            if self.cog and gdal.GetDriverByName("COG") is None:
+                log.warning("COG driver is not supported! Saving as tiled GeoTiff!")
+                self.cog = False
+            self.buildOverviews = buildOverviews
+            # COG layout can only be created by copying so the blocks are first
+            # written to a temporary tiled GeoTIFF next to the output file
+            if self.cog:
+                fd, self.tempPath = tempfile.mkstemp(suffix=".tif",
+                                                     dir=os.path.dirname(os.path.abspath(
+                                                         self.outPath)))
+                os.close(fd)
+            else:
+                self.tempPath = self.outPath
+            self.ds = createTiledRaster(self.tempPath, xSize, ySize, bands, geotransform, proj,
+                                        dataType=dataType)
+
+        if noDataValue is not None:
+            for band in range(bands):
+                self.ds.GetRasterBand(band+1).SetNoDataValue(noDataValue)
+
+    def write(self, data, xOff=0, yOff=0):
+        ''' Write a block of data with upper left corner at the given pixel
+        offset. Data can be 2D (single band) or 3D with bands in the last
+        dimension.
+        '''
+        if data.ndim > 2:
+            for band in range(data.shape[2]):
+                self.ds.GetRasterBand(band+1).WriteArray(data[:, :, band], xOff, yOff)
+        else:
+            self.ds.GetRasterBand(1).WriteArray(data, xOff, yOff)
+
+    def close(self):
+        ''' Finalise the output file and return it opened as GDAL dataset.
+        '''
+        if self.buildOverviews:
+            levels = []
+            level = 2
+            while max(self.xSize, self.ySize) / level > 256:
+                levels.append(level)
+                level = level * 2
+            if levels:
+                self.ds.BuildOverviews("AVERAGE", levels)
+
+        if self.cog:
+            self.ds = None
+            ds = gdal.Translate(self.outPath, self.tempPath, format="COG",
+                                creationOptions=['COMPRESS=DEFLATE', 'PREDICTOR=YES',
+                                                 'BIGTIFF=IF_SAFER'],
+                                stats=self.computeStats)
+            gdal.GetDriverByName("GTiff").Delete(self.tempPath)
+        else:
+            ds = self.ds
+            if self.computeStats:
+                for band in range(ds.RasterCount):
+                    ds.GetRasterBand(band+1).ComputeStatistics(False)
+            ds.FlushCache()
+        self.ds = None
+        return ds
+
+
+def createTiledRaster(outPath, xSize, ySize, bands, geotransform, proj,
+                      dataType=gdal.GDT_Float32):
+    ds = gdal.GetDriverByName("GTiff").Create(str(outPath), xSize, ySize, bands, dataType,
+                                              ['TILED=YES', 'COMPRESS=DEFLATE',
+                                               'BIGTIFF=IF_SAFER'])
+    ds.SetProjection(proj)
+    ds.SetGeoTransform(geotransform)
+    return ds
 
-    smoothedData = ndi.filters.generic_filter(data, filterFunction, 3)
 
-    return smoothedData
+# Read all the raster bands into (rows, columns, bands) array with no-data values
+# set to NaN and return it together with the geotransform and projection of the raster
+def readRaster(raster, dtype=float):
+    r, closeOnExit = openRaster(raster)
+    data = readRasterBlock(r, 0, 0, r.RasterXSize, r.RasterYSize, dtype=dtype)
+    gt = r.GetGeoTransform()
+    proj = r.GetProjection()
+    if closeOnExit:
+        r = None
+    return data, gt, proj
+
+
+# Read a block of all the raster bands into (rows, columns, bands) array with
+# no-data values set to NaN
+def readRasterBlock(raster, xOff, yOff, xSize, ySize, dtype=float):
+    r, closeOnExit = openRaster(raster)
+    data = np.empty((ySize, xSize, r.RasterCount), dtype=dtype)
+    for band in range(r.RasterCount):
+        rasterBand = r.GetRasterBand(band+1)
+        bandData = rasterBand.ReadAsArray(xOff, yOff, xSize, ySize).astype(dtype)
+        bandData[bandData == rasterBand.GetNoDataValue()] = np.nan
+        data[:, :, band] = bandData
+    if closeOnExit:
+        r = None
+    return data
 
 
-def appendNpArray(array, data, axis=None):
-    if array is None or array.size == 0:
-        array = data
+# Peak resident set size of the process in bytes, or None where it is not
+# available (Windows)
+def peakRSS():
+    if resource is None:
+        return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    if sys.platform != "darwin":
+        maxRSS = maxRSS * 1024
+    return maxRSS
+
+
+# Measure a processing stage. Yields a dictionary with the stage name and the
+# given counts (e.g. pixels or samples), to which further counts can be added
+# within the block, and adds the wall time (s) and the peak resident set size
+# of the process (bytes) once the block exits.
+@contextlib.contextmanager
+def stageMetrics(stage, **counts):
+    metrics = {"stage": stage}
+    metrics.update(counts)
+    start = time.perf_counter()
+    yield metrics
+    metrics["wallTime"] = time.perf_counter() - start
+    metrics["peakRSS"] = peakRSS()
+
+
+# Smooth the data with a binomial kernel ignoring NaN pixels, which are also
+# kept as NaN in the output. This is done by normalised convolution: the
+# NaN-zeroed data and the validity mask are convolved with the same separable
+# kernel and divided. kernelSize must be odd (3 gives the 1-2-1 kernel).
+def binomialSmoother(data, kernelSize=3, useNumba=False):
+    weights = np.array([math.comb(kernelSize - 1, k) for k in range(kernelSize)],
+                       dtype=np.float64)
+
+    if useNumba:
+        smoothedData = _binomialSmoother(np.asarray(data, dtype=np.float64), weights)
     else:
-        array = np.append(array, data, axis=axis)
-    return array
+        valid = ~np.isnan(data)
+        filledData = np.where(valid, data, 0).astype(np.float64)
+        validWeight = valid.astype(np.float64)
+        for axis in range(2):
+            filledData = ndi.correlate1d(filledData, weights, axis=axis, mode="reflect")
+            validWeight = ndi.correlate1d(validWeight, weights, axis=axis, mode="reflect")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            smoothedData = filledData / validWeight
+        smoothedData[~valid] = np.nan
+
+    return smoothedData.astype(data.dtype)
+
+
+@njit(parallel=True)
+def _binomialSmoother(data, weights):
+    rows, cols = data.shape
+    half = weights.size // 2
+    smoothedData = np.empty(data.shape)
+    for row in prange(rows):
+        for col in range(cols):
+            if np.isnan(data[row, col]):
+                smoothedData[row, col] = np.nan
+                continue
+            footprintSum = 0.0
+            weightSum = 0.0
+            for i in range(weights.size):
+                footprintRow = _reflectIndex(row + i - half, rows)
+                for j in range(weights.size):
+                    footprintCol = _reflectIndex(col + j - half, cols)
+                    value = data[footprintRow, footprintCol]
+                    if not np.isnan(value):
+                        footprintSum += weights[i] * weights[j] * value
+                        weightSum += weights[i] * weights[j]
+            smoothedData[row, col] = footprintSum / weightSum
+    return smoothedData
+
+
+# Index into an array of given size with "reflect" boundary mode (d c b a | a b c d)
+@njit
+def _reflectIndex(index, size):
+    while index < 0 or index >= size:
+        if index < 0:
+            index = -index - 1
+        else:
+            index = 2 * size - index - 1
+    return index
+
+
+class SampleStore:
+    ''' Store of training samples (low resolution values, high resolution
+    features and weights) for a number of windows. The arrays of each window
+    grow geometrically so that appending samples from many scenes does not
+    require copying the whole store on every append.
+
+    Parameters
+    ----------
+    windowsNum: integer
+        Number of windows for which samples are stored.
+
+    bands: integer
+        Number of high resolution features of each sample.
+
+    dtype_HR: numpy data type (optional, default: np.float32)
+        Data type in which high resolution features are stored.
+
+    initialCapacity: integer (optional, default: 1024)
+        Initial number of samples allocated for each window.
+
+    Returns
+    -------
+    None
+    '''
+    def __init__(self, windowsNum, bands, dtype_HR=np.float32, initialCapacity=1024):
+        self.windowsNum = windowsNum
+        self.bands = bands
+        self.dtype_HR = dtype_HR
+        self.initialCapacity = initialCapacity
+        self.data_LR = [None for _ in range(windowsNum)]
+        self.data_HR = [None for _ in range(windowsNum)]
+        self.weight = [None for _ in range(windowsNum)]
+        self.sizes = [0 for _ in range(windowsNum)]
+
+    def append(self, i, data_LR, data_HR, weight):
+        ''' Append samples to window i.
+        '''
+        n = data_LR.shape[0]
+        size = self.sizes[i]
+        if self.data_LR[i] is None:
+            capacity = max(self.initialCapacity, n)
+            self.data_LR[i] = np.empty(capacity)
+            self.data_HR[i] = np.empty((capacity, self.bands), dtype=self.dtype_HR)
+            self.weight[i] = np.empty(capacity)
+        elif size + n > self.data_LR[i].shape[0]:
+            capacity = max(2 * self.data_LR[i].shape[0], size + n)
+            self.data_LR[i] = self._grow(self.data_LR[i], size, capacity)
+            self.data_HR[i] = self._grow(self.data_HR[i], size, capacity)
+            self.weight[i] = self._grow(self.weight[i], size, capacity)
+        self.data_LR[i][size:size+n] = data_LR
+        self.data_HR[i][size:size+n, :] = data_HR
+        self.weight[i][size:size+n] = weight
+        self.sizes[i] = size + n
+
+    def size(self, i):
+        ''' Number of samples stored for window i.
+        '''
+        return self.sizes[i]
+
+    def get(self, i):
+        ''' Return (data_LR, data_HR, weight) arrays of window i.
+        '''
+        size = self.sizes[i]
+        if self.data_LR[i] is None:
+            return (np.empty(0), np.empty((0, self.bands), dtype=self.dtype_HR), np.empty(0))
+        return (self.data_LR[i][:size], self.data_HR[i][:size, :], self.weight[i][:size])
+
+    @staticmethod
+    def _grow(array, size, capacity):
+        grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[:size] = array[:size]
+        return grown
+
+
+class SceneCache:
+    ''' On-disk cache of arrays derived from input rasters. Each entry is a
+    directory of .npy files, named by a hash of the identity of the input files
+    (path, size and modification time, or content hash) and of any additional
+    parameters used to derive the arrays. Cached arrays are returned as read-only
+    memory maps. When the cache grows beyond maxBytes the least recently used
+    entries are removed.
+
+    Parameters
+    ----------
+    cacheDir: string
+        Directory in which the cache entries are stored.
+
+    maxBytes: integer (optional, default: 10 GB)
+        Maximum total size of the cache entries.
+
+    hashContents: boolean (optional, default: False)
+        If True, input files are identified by hash of their contents instead of
+        by their size and modification time.
+
+    Returns
+    -------
+    None
+    '''
+    def __init__(self, cacheDir, maxBytes=10*1024**3, hashContents=False):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hashContents = hashContents
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def fileIdentity(self, filename):
+        ''' Identity of an input file, or None if filename is None.
+        '''
+        if filename is None:
+            return None
+        filename = os.path.abspath(str(filename))
+        stat = os.stat(filename)
+        identity = [filename, stat.st_size]
+        if self.hashContents:
+            fileHash = hashlib.sha256()
+            with open(filename, "rb") as fp:
+                for chunk in iter(lambda: fp.read(2**20), b""):
+                    fileHash.update(chunk)
+            identity.append(fileHash.hexdigest())
+        else:
+            identity.append(stat.st_mtime_ns)
+        return identity
+
+    def key(self, filenames, **params):
+        ''' Cache key of arrays derived from the given files with the given
+        parameters.
+        '''
+        identity = {"files": [self.fileIdentity(f) for f in filenames],
+                    "params": params}
+        return hashlib.sha256(json.dumps(identity, sort_keys=True,
+                                         default=str).encode()).hexdigest()
+
+    def load(self, key):
+        ''' Return dictionary of cached arrays or None if key is not cached.
+        '''
+        entryDir = os.path.join(self.cacheDir, key)
+        if not os.path.isdir(entryDir):
+            return None
+        try:
+            arrays = {f[:-4]: np.load(os.path.join(entryDir, f), mmap_mode="r")
+                      for f in os.listdir(entryDir) if f.endswith(".npy")}
+        except (OSError, ValueError):
+            # Entry removed or corrupted by another process
+            return None
+        # Mark as recently used
+        os.utime(entryDir)
+        return arrays
+
+    def store(self, key, arrays):
+        ''' Store dictionary of arrays under key and evict old entries if the
+        cache became too large.
+        '''
+        entryDir = os.path.join(self.cacheDir, key)
+        # Write to a temporary directory first so that other processes never
+        # see a partial entry.
+        tmpDir = tempfile.mkdtemp(dir=self.cacheDir, prefix=".tmp_")
+        for name, array in arrays.items():
+            np.save(os.path.join(tmpDir, name+".npy"), np.asarray(array))
+        try:
+            os.rename(tmpDir, entryDir)
+        except OSError:
+            # Entry was stored by another process in the meantime
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        ''' Remove least recently used entries until the cache fits in maxBytes.
+        '''
+        entries = []
+        totalBytes = 0
+        for name in os.listdir(self.cacheDir):
+            entryDir = os.path.join(self.cacheDir, name)
+            if name.startswith(".") or not os.path.isdir(entryDir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entryDir, f))
+                       for f in os.listdir(entryDir))
+            entries.append((os.path.getmtime(entryDir), size, entryDir))
+            totalBytes += size
+        for _, size, entryDir in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalBytes -= size
+
+
+class GridAlignment:
+    ''' Alignment of a low resolution grid with a high resolution grid. The low
+    resolution grid is expressed in the high resolution projection and subset to
+    the high resolution extent without shifting its pixels. The alignment only
+    depends on the two grids so it can be reused for all the scenes on them (see
+    getGridAlignment).
+
+    Parameters
+    ----------
+    proj_HR, gt_HR, xSize_HR, ySize_HR: string, tuple, integer, integer
+        Projection, geotransform and size of the high resolution grid.
+
+    proj_LR, gt_LR, xSize_LR, ySize_LR: string, tuple, integer, integer
+        Projection, geotransform and size of the low resolution grid.
+
+    Returns
+    -------
+    None
+    '''
+    def __init__(self, proj_HR, gt_HR, xSize_HR, ySize_HR, proj_LR, gt_LR, xSize_LR, ySize_LR):
+        self.proj_HR = proj_HR
+        self.gt_HR = tuple(gt_HR)
+        self.proj_LR = proj_LR
+        self.sourceGt_LR = tuple(gt_LR)
+        self.sourceSize_LR = (int(xSize_LR), int(ySize_LR))
+        self._nearestIndices = None
+        extent = [gt_HR[0], gt_HR[3]+gt_HR[5]*ySize_HR, gt_HR[0]+gt_HR[1]*xSize_HR, gt_HR[3]]
+
+        # Transform "middle pixel" and "middle pixel + 1" between LR and HR projections
+        # to obtain LR resolution in HR projection. This method can handle different
+        # x and y resolution
+        midPix = [int(xSize_LR/2), int(ySize_LR/2)]
+        midPix_2 = [midPix[0]+1, midPix[1]+1]
+        midPoint = pix2point(midPix, gt_LR)
+        midPoint_2 = pix2point(midPix_2, gt_LR)
+        transformer = Transformer.from_proj(Proj(proj_LR), Proj(proj_HR), always_xy=True)
+        x1, y1 = transformer.transform(midPoint[0], midPoint[1])
+        x2, y2 = transformer.transform(midPoint_2[0], midPoint_2[1])
+        xRes_LR_proj = x2 - x1
+        yRes_LR_proj = y2 - y1
+        # Now do the same with UL pixel to obtain low resolution geotransform in
+        # the new projection
+        UL_x, UL_y = transformer.transform(gt_LR[0], gt_LR[3])
+        gt_LR = [UL_x, xRes_LR_proj, 0, UL_y, 0, yRes_LR_proj]
+
+        # Now subset to high resolution scene extent while not shifting pixels
+        UL = pix2point(point2pix([extent[0], extent[3]], gt_LR, upperBound=False), gt_LR)
+        BR = pix2point(point2pix([extent[2], extent[1]], gt_LR, upperBound=True), gt_LR)
+        self.outputBounds = [UL[0], BR[1], BR[0], UL[1]]
+        self.gt_LR = (UL[0], xRes_LR_proj, 0, UL[1], 0, yRes_LR_proj)
+        self.xSize_LR = int(round((BR[0] - UL[0]) / xRes_LR_proj))
+        self.ySize_LR = int(round((BR[1] - UL[1]) / yRes_LR_proj))
+
+    def footprints(self):
+        ''' Range of high resolution rows and columns falling within each pixel of the
+        subset low resolution grid (see footprintIndices).
+        '''
+        return footprintIndices(self.gt_HR, self.gt_LR, self.xSize_LR, self.ySize_LR)
+
+    def subsetLowResScene(self, lowResScene):
+        ''' Reproject and subset a low resolution scene to the aligned grid.
+        '''
+        return gdal.Warp("",
+                         openRaster(lowResScene)[0],
+                         format="MEM",
+                         dstSRS=self.proj_HR,
+                         resampleAlg=gdal.GRA_NearestNeighbour,
+                         xRes=self.gt_LR[1],
+                         yRes=self.gt_LR[5],
+                         outputBounds=self.outputBounds)
+
+    def nearestIndices(self):
+        ''' Rows and columns of the low resolution pixels nearest to the aligned
+        pixels falling inside the low resolution grid, and the mask of those aligned
+        pixels. The (read-only) index map is computed when first needed and kept
+        with the alignment.
+        '''
+        if self._nearestIndices is None:
+            x = self.gt_LR[0] + (np.arange(self.xSize_LR) + 0.5) * self.gt_LR[1]
+            y = self.gt_LR[3] + (np.arange(self.ySize_LR) + 0.5) * self.gt_LR[5]
+            x, y = np.meshgrid(x, y)
+            transformer = Transformer.from_proj(Proj(self.proj_HR), Proj(self.proj_LR),
+                                                always_xy=True)
+            x, y = transformer.transform(x, y)
+            gt = self.sourceGt_LR
+            cols = np.floor((x - gt[0]) / gt[1]).astype(np.int64)
+            rows = np.floor((y - gt[3]) / gt[5]).astype(np.int64)
+            inside = np.logical_and.reduce((cols >= 0, cols < self.sourceSize_LR[0],
+                                            rows >= 0, rows < self.sourceSize_LR[1]))
+            indices = (rows[inside], cols[inside], inside)
+            for index in indices:
+                index.flags.writeable = False
+            self._nearestIndices = indices
+        return self._nearestIndices
+
+    def subsetLowResArray(self, data_LR):
+        ''' Reproject and subset an array (rows, columns) on the low resolution grid
+        to the aligned grid with nearest neighbour resampling, without GDAL. Aligned
+        pixels falling outside the low resolution grid are set to NaN.
+        '''
+        rows, cols, inside = self.nearestIndices()
+        subset = np.full((self.ySize_LR, self.xSize_LR), np.nan)
+        subset[inside] = data_LR[rows, cols]
+        return subset
+
+
+# Get the alignment of the grids of the given high and low resolution scenes.
+# Alignments of recently used pairs of grids are cached.
+def getGridAlignment(highResScene, lowResScene):
+    proj_HR, gt_HR, xSize_HR, ySize_HR = getRasterInfo(highResScene)[0:4]
+    proj_LR, gt_LR, xSize_LR, ySize_LR = getRasterInfo(lowResScene)[0:4]
+    return alignGrids(proj_HR, gt_HR, xSize_HR, ySize_HR, proj_LR, gt_LR, xSize_LR, ySize_LR)
+
+
+# Get the alignment of the given high and low resolution grids (projection,
+# geotransform and size), e.g. of in-memory arrays.
+def alignGrids(proj_HR, gt_HR, xSize_HR, ySize_HR, proj_LR, gt_LR, xSize_LR, ySize_LR):
+    return _gridAlignment(proj_HR, tuple(gt_HR), xSize_HR, ySize_HR,
+                          proj_LR, tuple(gt_LR), xSize_LR, ySize_LR)
+
+
+@functools.lru_cache(maxsize=32)
+def _gridAlignment(*grids):
+    return GridAlignment(*grids)
 
 
 # Reproject and subset the given low resolution datasets to high resolution
 # scene projection and extent
 def reprojectSubsetLowResScene(highResScene, lowResScene, resampleAlg=gdal.GRA_Bilinear):
-
-    # Read the required metadata
-    proj_HR, gt_HR, xsize_HR, ysize_HR, extent = getRasterInfo(highResScene)[0:5]
-    proj_LR, gt_LR, xsize_LR, ysize_LR = getRasterInfo(lowResScene)[0:4]
-
-    # Transform "middle pixel" and "middle pixel + 1" between LR and HR projections
-    # to obtain LR resolution in HR projection. This method can handle different
-    # x and y resolution
-    midPix = [int(xsize_LR/2), int(ysize_LR/2)]
-    midPix_2 = [midPix[0]+1, midPix[1]+1]
-    midPoint = pix2point(midPix, gt_LR)
-    midPoint_2 = pix2point(midPix_2, gt_LR)
-    transformer = Transformer.from_proj(Proj(proj_LR), Proj(proj_HR), always_xy=True)
-    x1, y1 = transformer.transform(midPoint[0], midPoint[1])
-    x2, y2 = transformer.transform(midPoint_2[0], midPoint_2[1])
-    xRes_LR_proj = x2 - x1
-    yRes_LR_proj = y2 - y1
-    # Now do the same with UL pixel to obtain low resolution geotransform in
-    # the new projection
-    UL_x, UL_y = transformer.transform(gt_LR[0], gt_LR[3])
-    gt_LR = [UL_x, xRes_LR_proj, 0, UL_y, 0, yRes_LR_proj]
-
-    # Now subset to high resolution scene extent while not shifting pixels
-    UL = pix2point(point2pix([extent[0], extent[3]], gt_LR, upperBound=False), gt_LR)
-    BR = pix2point(point2pix([extent[2], extent[1]], gt_LR, upperBound=True), gt_LR)
-    out = gdal.Warp("",
-                    openRaster(lowResScene)[0],
-                    format="MEM",
-                    dstSRS=proj_HR,
-                    resampleAlg=gdal.GRA_NearestNeighbour,
-                    xRes=gt_LR[1],
-                    yRes=gt_LR[5],
-                    outputBounds=[UL[0], BR[1], BR[0], UL[1]])
-
-    return out
+    return getGridAlignment(highResScene, lowResScene).subsetLowResScene(lowResScene)
 
 
 # Resample high res scene to low res pixel while extracting homogeneity
 # statistics. It is assumed that both scenes have the same projection and extent.
-def resampleHighResToLowRes(highResScene, lowResScene):
-
-    gt_HR = getRasterInfo(highResScene)[1]
-    bands_HR = getRasterInfo(highResScene)[5]
+# If stripRows is given then the high res scene is read in horizontal strips
+# covering that many low res rows, so that only one strip is held in memory.
+# The high res data can be raised to a given exponent before aggregation and the
+# statistics are returned as arrays of the given dtype.
+def resampleHighResToLowRes(highResScene, lowResScene, stripRows=None, exponent=1,
+                            dtype=np.float64):
     gt_LR, xSize_LR, ySize_LR = getRasterInfo(lowResScene)[1:4]
-    xRes_HR = gt_HR[1]
-    yRes_HR = abs(gt_HR[5])
-    xRes_LR = gt_LR[1]
-    yRes_LR = gt_LR[5]
-
-    aggregatedMean = np.zeros((ySize_LR,
-                               xSize_LR,
-                               bands_HR))
-    aggregatedStd = np.zeros(aggregatedMean.shape)
-
-    # Go through all the high res bands and calculate mean and standard
-    # deviation when aggregated to the low resolution
+    return aggregateRasterToLowRes(highResScene, gt_LR, xSize_LR, ySize_LR, stripRows=stripRows,
+                                   exponent=exponent, dtype=dtype)
+
+
+# Same as resampleHighResToLowRes but with the low res grid given by its geotransform
+# and size
+def aggregateRasterToLowRes(highResScene, gt_LR, xSize_LR, ySize_LR, stripRows=None,
+                            exponent=1, dtype=np.float64):
     highRes, close = openRaster(highResScene)
-    for band in range(bands_HR):
-        bandData_HR = highRes.GetRasterBand(band+1).ReadAsArray().astype(np.float32)
-        nodataValue = highRes.GetRasterBand(1).GetNoDataValue()
-        bandData_HR[bandData_HR == nodataValue] = np.nan
-        aggregatedMean[:, :, band], aggregatedStd[:, :, band] =\
-            _resampleHighResToLowRes(bandData_HR, ySize_LR, yRes_LR, yRes_HR, xSize_LR, xRes_LR,
-                                     xRes_HR, gt_HR, gt_LR)
+    gt_HR = highRes.GetGeoTransform()
+    xSize_HR = highRes.RasterXSize
+    ySize_HR = highRes.RasterYSize
+    yMin, yMax, xMin, xMax = footprintIndices(gt_HR, gt_LR, xSize_LR, ySize_LR)
+
+    aggregatedMean = np.empty((ySize_LR, xSize_LR, highRes.RasterCount), dtype=dtype)
+    aggregatedStd = np.empty(aggregatedMean.shape, dtype=dtype)
+    if stripRows is None:
+        stripRows = ySize_LR
+    # Go through the strips of high res data, reading all the bands at once and
+    # then calculating mean and standard deviation of all of them when
+    # aggregated to the low resolution
+    for row_LR in range(0, ySize_LR, stripRows):
+        rows_LR = slice(row_LR, min(row_LR + stripRows, ySize_LR))
+        yOff = min(yMin[rows_LR.start], ySize_HR)
+        ySize = min(np.max(yMax[rows_LR]), ySize_HR) - yOff
+        if ySize <= 0:
+            aggregatedMean[rows_LR] = np.nan
+            aggregatedStd[rows_LR] = np.nan
+            continue
+        data_HR = readRasterBlock(highRes, 0, yOff, xSize_HR, ySize, dtype=np.float32)
+        if exponent != 1:
+            data_HR = data_HR**exponent
+        aggregatedMean[rows_LR], aggregatedStd[rows_LR] = \
+            aggregateFootprints(data_HR, yMin[rows_LR] - yOff, yMax[rows_LR] - yOff, xMin, xMax)
+        data_HR = None
+
     if close:
         highRes = None
     return aggregatedMean, aggregatedStd
 
 
-@njit
-def _resampleHighResToLowRes(bandData_HR, ySize_LR, yRes_LR, yRes_HR, xSize_LR, xRes_LR, xRes_HR,
-                             gt_HR, gt_LR):
-    aggregatedMean = np.zeros((ySize_LR, xSize_LR))
-    aggregatedStd = np.zeros((ySize_LR, xSize_LR))
-    for yPix_LR in range(ySize_LR):
-        yPos_LR_min = gt_LR[3] + yPix_LR*yRes_LR
-        yPix_HR_min = int(round(max(0, gt_HR[3] - yPos_LR_min) / yRes_HR))
-        yPix_HR_max = int(round(max(0, gt_HR[3] - (yPos_LR_min + yRes_LR)) / yRes_HR))
+# Calculate the range of high res pixels (rows and columns) falling within each
+# low res pixel. The (read-only) index tables of recently used grids are cached.
+def footprintIndices(gt_HR, gt_LR, xSize_LR, ySize_LR):
+    return _footprintIndices(tuple(gt_HR), tuple(gt_LR), int(xSize_LR), int(ySize_LR))
+
+
+@functools.lru_cache(maxsize=64)
+def _footprintIndices(gt_HR, gt_LR, xSize_LR, ySize_LR):
+    yPos_LR_min = gt_LR[3] + np.arange(ySize_LR)*gt_LR[5]
+    yPix_HR_min = np.round(np.maximum(0, gt_HR[3] - yPos_LR_min) / abs(gt_HR[5]))
+    yPix_HR_max = np.round(np.maximum(0, gt_HR[3] - (yPos_LR_min + gt_LR[5])) / abs(gt_HR[5]))
+    xPos_LR_min = gt_LR[0] + np.arange(xSize_LR)*gt_LR[1]
+    xPix_HR_min = np.round(np.maximum(0, xPos_LR_min - gt_HR[0]) / gt_HR[1])
+    xPix_HR_max = np.round(np.maximum(0, xPos_LR_min + gt_LR[1] - gt_HR[0]) / gt_HR[1])
+    indices = (yPix_HR_min.astype(np.int64), yPix_HR_max.astype(np.int64),
+               xPix_HR_min.astype(np.int64), xPix_HR_max.astype(np.int64))
+    for index in indices:
+        index.flags.writeable = False
+    return indices
+
+
+# Aggregate high res data with shape (rows, columns, bands) to low res pixels
+# returning NaN-aware mean and (population) standard deviation of each band
+def aggregateHighResToLowRes(data_HR, gt_HR, gt_LR, xSize_LR, ySize_LR):
+    yMin, yMax, xMin, xMax = footprintIndices(gt_HR, gt_LR, xSize_LR, ySize_LR)
+    return aggregateFootprints(data_HR, yMin, yMax, xMin, xMax)
+
+
+def aggregateFootprints(data_HR, yMin, yMax, xMin, xMax):
+    # Footprints extending past the high res data are truncated
+    yMin = np.minimum(yMin, data_HR.shape[0])
+    yMax = np.minimum(yMax, data_HR.shape[0])
+    xMin = np.minimum(xMin, data_HR.shape[1])
+    xMax = np.minimum(xMax, data_HR.shape[1])
+
+    # When each low res pixel covers the same integer number of high res pixels
+    # the data can be streamed row by row into blocks without index lookups
+    yRegular = _regularFootprints(yMin, yMax, data_HR.shape[0])
+    xRegular = _regularFootprints(xMin, xMax, data_HR.shape[1])
+    if yRegular is not None and xRegular is not None:
+        return _aggregateRegularFootprints(data_HR, yRegular[0], yRegular[1], yMin.size,
+                                           xRegular[0], xRegular[1], xMin.size)
+    return _aggregateFootprints(data_HR, yMin, yMax, xMin, xMax)
+
+
+# Check if footprints are contiguous and of equal size (apart from the first and
+# last one which can be truncated by the data extent) and if so return the
+# (possibly negative) offset of the first footprint and footprint size
+def _regularFootprints(minIdx, maxIdx, size):
+    lengths = maxIdx - minIdx
+    if lengths.size < 2:
+        return None
+    ratio = lengths[1]
+    if (ratio <= 0 or
+            np.any(minIdx[1:] != maxIdx[:-1]) or
+            np.any(lengths[1:-1] != ratio) or
+            lengths[0] > ratio or (lengths[0] < ratio and minIdx[0] != 0) or
+            lengths[-1] > ratio or (lengths[-1] < ratio and maxIdx[-1] != size)):
+        return None
+    return int(maxIdx[0] - ratio), int(ratio)
+
+
+@njit(parallel=True)
+def _aggregateRegularFootprints(data_HR, yOffset, yRatio, ySize_LR, xOffset, xRatio, xSize_LR):
+    bands = data_HR.shape[2]
+    aggregatedMean = np.empty((ySize_LR, xSize_LR, bands))
+    aggregatedStd = np.empty((ySize_LR, xSize_LR, bands))
+    colStart = max(xOffset, 0)
+    colEnd = min(xOffset + xSize_LR*xRatio, data_HR.shape[1])
+    for yPix_LR in prange(ySize_LR):
+        count = np.zeros((xSize_LR, bands))
+        mean = np.zeros((xSize_LR, bands))
+        m2 = np.zeros((xSize_LR, bands))
+        rowStart = max(yOffset + yPix_LR*yRatio, 0)
+        rowEnd = min(yOffset + (yPix_LR+1)*yRatio, data_HR.shape[0])
+        # Welford's online mean and variance of all the footprints in one pass
+        # over the high res rows
+        for yPix_HR in range(rowStart, rowEnd):
+            for xPix_HR in range(colStart, colEnd):
+                xPix_LR = (xPix_HR - xOffset) // xRatio
+                for band in range(bands):
+                    value = data_HR[yPix_HR, xPix_HR, band]
+                    if not np.isnan(value):
+                        count[xPix_LR, band] += 1
+                        delta = value - mean[xPix_LR, band]
+                        mean[xPix_LR, band] += delta / count[xPix_LR, band]
+                        m2[xPix_LR, band] += delta * (value - mean[xPix_LR, band])
         for xPix_LR in range(xSize_LR):
-            xPos_LR_min = gt_LR[0] + xPix_LR*xRes_LR
-            xPix_HR_min = int(round(max(0, xPos_LR_min - gt_HR[0]) / xRes_HR))
-            xPix_HR_max = int(round(max(0, xPos_LR_min + xRes_LR - gt_HR[0]) / xRes_HR))
-            aggregatedMean[yPix_LR, xPix_LR] =\
-                np.nanmean(bandData_HR[yPix_HR_min:yPix_HR_max, xPix_HR_min:xPix_HR_max])
-            aggregatedStd[yPix_LR, xPix_LR] =\
-                np.nanstd(bandData_HR[yPix_HR_min:yPix_HR_max, xPix_HR_min:xPix_HR_max])
+            for band in range(bands):
+                if count[xPix_LR, band] > 0:
+                    aggregatedMean[yPix_LR, xPix_LR, band] = mean[xPix_LR, band]
+                    aggregatedStd[yPix_LR, xPix_LR, band] = \
+                        np.sqrt(m2[xPix_LR, band] / count[xPix_LR, band])
+                else:
+                    aggregatedMean[yPix_LR, xPix_LR, band] = np.nan
+                    aggregatedStd[yPix_LR, xPix_LR, band] = np.nan
 
     return aggregatedMean, aggregatedStd
 
 
-def resampleLowResToHighRes(lowResScene, highResScene, resampleAlg="cubic"):
+@njit(parallel=True)
+def _aggregateFootprints(data_HR, yMin, yMax, xMin, xMax):
+    bands = data_HR.shape[2]
+    aggregatedMean = np.empty((yMin.size, xMin.size, bands))
+    aggregatedStd = np.empty((yMin.size, xMin.size, bands))
+    for yPix_LR in prange(yMin.size):
+        for xPix_LR in range(xMin.size):
+            for band in range(bands):
+                # Welford's online mean and variance
+                count = 0
+                mean = 0.0
+                m2 = 0.0
+                for yPix_HR in range(yMin[yPix_LR], yMax[yPix_LR]):
+                    for xPix_HR in range(xMin[xPix_LR], xMax[xPix_LR]):
+                        value = data_HR[yPix_HR, xPix_HR, band]
+                        if not np.isnan(value):
+                            count += 1
+                            delta = value - mean
+                            mean += delta / count
+                            m2 += delta * (value - mean)
+                if count > 0:
+                    aggregatedMean[yPix_LR, xPix_LR, band] = mean
+                    aggregatedStd[yPix_LR, xPix_LR, band] = np.sqrt(m2 / count)
+                else:
+                    aggregatedMean[yPix_LR, xPix_LR, band] = np.nan
+                    aggregatedStd[yPix_LR, xPix_LR, band] = np.nan
 
-    lowResScene_resampled = resampleWithGdalWarp(lowResScene, highResScene,
-                                                 resampleAlg=resampleAlg)
+    return aggregatedMean, aggregatedStd
 
-    data = lowResScene_resampled.GetRasterBand(1).ReadAsArray()
-    # Sometimes there can be 1 HR pixel NaN border arond LR invalid pixels due to resampling.
-    # Fuction below fixes this. Image border pixels are excluded due to numba stencil
-    # limitations.
-    data[1:-1, 1:-1] = removeEdgeNaNs(data)[1:-1, 1:-1]
 
-    # The resampled array might be slightly smaller then the high-res because
-    # of the subsetting of the low resolution scene. In that case just pad
-    # the missing values with neighbours.
-    highResShape = (getRasterInfo(highResScene)[3], getRasterInfo(highResScene)[2])
-    if highResShape != data.shape:
-        data = np.pad(data,
-                      ((0, highResShape[0]-data.shape[0]), (0, highResShape[1]-data.shape[1])),
-                      "edge")
-    return data
+# Cubic convolution (Keys, a = -0.5, as in GDAL) weights and clamped indices of
+# the four low res pixels contributing to each of the given high res pixel
+# centres along one axis, and the index of the nearest low res pixel
+def _cubicTaps(pix_HR, origin_HR, res_HR, origin_LR, res_LR, size_LR):
+    pos = (origin_HR + (pix_HR + 0.5)*res_HR - origin_LR) / res_LR - 0.5
+    pos = np.clip(pos, 0, size_LR - 1)
+    nearest = np.floor(pos + 0.5).astype(np.int64)
+    start = np.floor(pos).astype(np.int64)
+    dist = np.abs(pos[:, np.newaxis] - (start[:, np.newaxis] + np.arange(-1, 3)))
+    weights = np.where(dist <= 1, (1.5*dist - 2.5)*dist**2 + 1,
+                       np.where(dist < 2, ((-0.5*dist + 2.5)*dist - 4)*dist + 2, 0.0))
+    indices = np.clip(start[:, np.newaxis] + np.arange(-1, 3), 0, size_LR - 1)
+    return indices, weights, nearest
+
+
+@njit(parallel=True)
+def _cubicResample(data_LR, rowIdx, rowW, rowNearest, colIdx, colW, colNearest):
+    out = np.empty((rowIdx.shape[0], colIdx.shape[0]), dtype=data_LR.dtype)
+    for row in prange(rowIdx.shape[0]):
+        for col in range(colIdx.shape[0]):
+            nearest = data_LR[rowNearest[row], colNearest[col]]
+            if np.isnan(nearest):
+                out[row, col] = np.nan
+                continue
+            # Leave NaN pixels out of the interpolation and renormalize
+            total = 0.0
+            weightSum = 0.0
+            for i in range(4):
+                for j in range(4):
+                    value = data_LR[rowIdx[row, i], colIdx[col, j]]
+                    if not np.isnan(value):
+                        weight = rowW[row, i] * colW[col, j]
+                        total += weight * value
+                        weightSum += weight
+            if weightSum > 1e-6:
+                out[row, col] = total / weightSum
+            else:
+                out[row, col] = nearest
+    return out
 
 
-@stencil(cval=1.0)
-def removeEdgeNaNs(a):
-    if np.isnan(a[0, 0]) and (not np.isnan(a[-1, 0]) or not np.isnan(a[1, 0]) or
-                              not np.isnan(a[0, -1]) or not np.isnan(a[0, 1])):
-        return np.nanmean(np.array([a[-1, 0], a[1, 0], a[0, -1], a[0, 1]]))
-    else:
-        return a[0, 0]
+# Cubic resampling of low res data array to the block (xOff, yOff, xSize, ySize)
+# of the high res grid, without going through GDAL. Both grids are given by
+# geotransforms in the same projection. High res pixels falling into NaN low res
+# pixels are NaN, while NaN neighbours are left out of the interpolation, and pixels
+# beyond the low res extent take the values of the nearest low res pixels.
+def resampleLowResArrayToHighRes(data_LR, gt_LR, gt_HR, xOff, yOff, xSize, ySize):
+    rowIdx, rowW, rowNearest = _cubicTaps(np.arange(yOff, yOff + ySize), gt_HR[3], gt_HR[5],
+                                          gt_LR[3], gt_LR[5], data_LR.shape[0])
+    colIdx, colW, colNearest = _cubicTaps(np.arange(xOff, xOff + xSize), gt_HR[0], gt_HR[1],
+                                          gt_LR[0], gt_LR[1], data_LR.shape[1])
+    return _cubicResample(np.ascontiguousarray(data_LR), rowIdx, rowW, rowNearest,
+                          colIdx, colW, colNearest)
@@ -3,6 +3,7 @@
 @author: radoslaw guzinski
 Copyright: (C) 2017, Radoslaw Guzinski
 """
+import logging
 import os
 import time
 
@@ -37,16 +38,21 @@ if __name__ == "__main__":
     nnOpts =     {"regressionType":             REG_sklearn_ann,
                   "regressorOpt":               sknnOpts}
 
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    # Collect the wall time and memory use of each processing stage
+    stageMetrics = []
+
     start_time = time.time()
 
     if useDecisionTree:
         opts = commonOpts.copy()
         opts.update(dtOpts)
-        disaggregator = DecisionTreeSharpener(**opts)
+        disaggregator = DecisionTreeSharpener(metricsCallback=stageMetrics.append, **opts)
     else:
         opts = commonOpts.copy()
         opts.update(nnOpts)
-        disaggregator = NeuralNetworkSharpener(**opts)
+        disaggregator = NeuralNetworkSharpener(metricsCallback=stageMetrics.append, **opts)
 
     print("Training regressor...")
     disaggregator.trainSharpener()
@@ -78,4 +84,11 @@ if __name__ == "__main__":
     downsaceldFile = None
     highResFile = None
 
+    for stage in dict.fromkeys(m["stage"] for m in stageMetrics):
+        metrics = [m for m in stageMetrics if m["stage"] == stage]
+        wallTime = sum(m["wallTime"] for m in metrics)
+        print(f"{stage:<16} {wallTime:8.2f} s in {len(metrics)} calls")
+    peakRSS = [m["peakRSS"] for m in stageMetrics if m["peakRSS"] is not None]
+    if peakRSS:
+        print("Peak memory use: %.1f MB" % (max(peakRSS) / 2**20))
     print(time.time() - start_time, "seconds")
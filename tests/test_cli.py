@@ -0,0 +1,119 @@
+import json
+
+import numpy as np
+import pytest
+
+import pyDMS.pyDMSUtils as utils
+from pyDMS import cli
+
+
+def test_parse_memory_size():
+    assert cli.parseMemorySize("512MB") == 512 * 1024**2
+    assert cli.parseMemorySize("1.5 gb") == int(1.5 * 1024**3)
+    assert cli.parseMemorySize("2048") == 2048
+    assert cli.parseMemorySize(None) is None
+
+
+def test_memory_budget_bounds_tiles_and_strips(tmp_path):
+    highResFile = str(tmp_path / "h.tif")
+    lowResFile = str(tmp_path / "l.tif")
+    utils.saveImg(np.zeros((400, 300, 2)), (500000.0, 30.0, 0, 4000000.0, 0, -30.0),
+                  "EPSG:32633", highResFile)
+    utils.saveImg(np.zeros((40, 30)), (500000.0, 300.0, 0, 4000000.0, 0, -300.0),
+                  "EPSG:32633", lowResFile)
+    # Two bands and the sharpening arrays of 8 bytes each
+    budget = 100 * 100 * 10 * 8
+
+    assert cli.tileSizeForMemoryBudget(highResFile, budget) == 100
+    assert cli.tileSizeForMemoryBudget(highResFile, 400 * 300 * 10 * 8) is None
+    # Strips of 10000 high resolution pixels hold 33 rows, i.e. 3 low resolution rows
+    assert cli.stripRowsForMemoryBudget(highResFile, lowResFile, budget) == 3
+    assert cli.stripRowsForMemoryBudget(highResFile, lowResFile, 400 * 300 * 10 * 8) is None
+    with pytest.raises(ValueError):
+        cli.stripRowsForMemoryBudget(highResFile, lowResFile, 300 * 5 * 10 * 8)
+    with pytest.raises(ValueError):
+        cli.tileSizeForMemoryBudget(highResFile, 10)
+
+
+def test_read_job_file_requires_a_mapping_of_jobs(tmp_path):
+    jobFile = tmp_path / "jobs.json"
+    jobFile.write_text(json.dumps([{"name": "job"}]))
+    with pytest.raises(TypeError):
+        cli.readJobFile(str(jobFile))
+    assert cli.main([str(jobFile)]) == 2
+
+
+def test_main_exits_with_2_on_bad_memory_budget_or_yaml(tmp_path):
+    jobFile = tmp_path / "jobs.json"
+    jobFile.write_text(json.dumps({"memoryBudget": "16G", "jobs": []}))
+    assert cli.main([str(jobFile)]) == 2
+    jobFile.write_text(json.dumps({"jobs": []}))
+    assert cli.main([str(jobFile), "--memory-budget", "16G"]) == 2
+
+    pytest.importorskip("yaml")
+    yamlFile = tmp_path / "jobs.yaml"
+    yamlFile.write_text("jobs: [{name: job\n")
+    with pytest.raises(ValueError):
+        cli.readJobFile(str(yamlFile))
+    assert cli.main([str(yamlFile)]) == 2
+
+
+def test_job_scenes_default_to_training_pairs():
+    job = {"highResFiles": ["h1.tif", "h2.tif"], "lowResFiles": ["l1.tif", "l2.tif"],
+           "lowResQualityFiles": ["q1.tif", "q2.tif"], "outputs": ["o1.tif", "o2.tif"]}
+    pairs, outputs = cli.jobScenes(job)
+    assert pairs == [("h1.tif", "l1.tif", "q1.tif"), ("h2.tif", "l2.tif", "q2.tif")]
+    assert outputs == ["o1.tif", "o2.tif"]
+
+    job["scenes"] = [{"highResFile": "h3.tif", "lowResFile": "l3.tif", "output": "o3.tif"}]
+    assert cli.jobScenes(job) == ([("h3.tif", "l3.tif", None)], ["o3.tif"])
+
+    del job["scenes"]
+    job["outputs"] = ["o1.tif"]
+    with pytest.raises(ValueError):
+        cli.jobScenes(job)
+
+
+def test_main_exits_non_zero_on_failed_job(tmp_path):
+    jobFile = tmp_path / "jobs.json"
+    jobFile.write_text(json.dumps({"jobs": [{"name": "bad", "sharpener": "Unknown",
+                                             "highResFiles": ["h.tif"],
+                                             "lowResFiles": ["l.tif"],
+                                             "outputs": [str(tmp_path / "o.tif")]}]}))
+    summary = tmp_path / "summary.json"
+
+    assert cli.main([str(jobFile), "--summary", str(summary)]) == 1
+    assert json.loads(summary.read_text())["failed"][0]["name"] == "bad"
+    assert cli.main([str(tmp_path / "missing.json")]) == 2
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_main_runs_jobs_end_to_end(tmp_path, workers):
+    rng = np.random.default_rng(0)
+    proj = "EPSG:32633"
+    jobs = []
+    for index in range(2):
+        data_HR = rng.random((60, 60, 2))
+        data_LR = (300 + 5*data_HR[:, :, 0] - 3*data_HR[:, :, 1]).reshape(6, 10, 6, 10).mean((1, 3))
+        highResFile = str(tmp_path / f"h{index}.tif")
+        lowResFile = str(tmp_path / f"l{index}.tif")
+        utils.saveImg(data_HR, (500000.0, 30.0, 0, 4000000.0, 0, -30.0), proj, highResFile)
+        utils.saveImg(data_LR, (500000.0, 300.0, 0, 4000000.0, 0, -300.0), proj, lowResFile)
+        jobs.append({"name": f"job{index}",
+                     "highResFiles": [highResFile],
+                     "lowResFiles": [lowResFile],
+                     "options": {"movingWindowSize": 3, "minimumSampleNumber": 5},
+                     "outputs": [str(tmp_path / "out" / f"o{index}.tif")]})
+    jobFile = tmp_path / "jobs.json"
+    jobFile.write_text(json.dumps({"workers": workers, "jobs": jobs}))
+    summary = tmp_path / "summary.json"
+
+    assert cli.main([str(jobFile), "--summary", str(summary)]) == 0
+    timings = json.loads(summary.read_text())
+    assert timings["failed"] == []
+    assert sorted(timing["name"] for timing in timings["finished"]) == ["job0", "job1"]
+    for timing in timings["finished"]:
+        assert timing["training"] >= 0 and timing["total"] >= timing["training"]
+        output = timing["scenes"][0]["output"]
+        assert utils.readRaster(output)[0].shape == (60, 60, 1)
+        assert utils.readRaster(output.replace(".tif", "_residual.tif"))[0].shape == (6, 6, 1)
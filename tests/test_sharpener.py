@@ -1,8 +1,21 @@
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 import numpy as np
+from sklearn.ensemble import BaggingRegressor
+from sklearn.linear_model import Ridge
+import pyDMS.pyDMSUtils as utils
 from pyDMS.pyDMS import (
+    CompiledTreeEnsemble,
+    CubistSharpener,
     DecisionTreeSharpener,
     DecisionTreeRegressorWithLinearLeafRegression,
+    MLPEnsemble,
+    NeuralNetworkSharpener,
+    REG_sklearn_ann,
+    _fitGroupedRidge,
 )
 
 
@@ -19,7 +32,45 @@ def test_tree_fit_and_predict_basic():
 
     assert isinstance(y_pred, np.ndarray)
     assert y_pred.shape == y.shape
-    assert len(model.leafParameters) > 0
+    assert model.leafParameters["coef"].shape == (model.tree_.node_count, X.shape[1])
+    assert np.all(y_pred >= model.leafParameters["lowerBound"][model.apply(X)])
+    assert np.all(y_pred <= model.leafParameters["upperBound"][model.apply(X)])
+
+
+def test_grouped_ridge_matches_sklearn():
+    rng = np.random.default_rng(42)
+    X = rng.random((300, 3))
+    y = X @ np.array([1.0, -2.0, 0.5]) + rng.normal(0, 0.1, 300)
+    groups = rng.integers(0, 5, 300) * 2 + 1
+
+    ids, coef, intercept, yMax, yMin = _fitGroupedRidge(X, y, groups)
+
+    assert np.array_equal(ids, np.unique(groups))
+    for i, group in enumerate(ids):
+        ind = groups == group
+        ridge = Ridge().fit(X[ind], y[ind])
+        assert np.allclose(coef[i], ridge.coef_)
+        assert np.isclose(intercept[i], ridge.intercept_)
+        assert yMax[i] == np.max(y[ind])
+        assert yMin[i] == np.min(y[ind])
+
+
+# ----------------------------------------------------------------------
+# CompiledTreeEnsemble
+# ----------------------------------------------------------------------
+def test_compiled_ensemble_matches_bagging_regressor():
+    rng = np.random.default_rng(0)
+    X = rng.random((500, 3))
+    y = X @ np.array([1.0, 2.0, 3.0]) + np.sin(10 * X[:, 0])
+
+    base = DecisionTreeRegressorWithLinearLeafRegression(
+        decisionTreeRegressorOpt={"max_leaf_nodes": 10})
+    reg = BaggingRegressor(base, n_estimators=5, max_features=0.7, random_state=0)
+    reg.fit(X, y)
+    compiled = CompiledTreeEnsemble.fromBaggingRegressor(reg)
+
+    X_test = rng.random((1000, 3)) * 1.2 - 0.1
+    assert np.allclose(compiled.predict(X_test), reg.predict(X_test))
 
 
 # ----------------------------------------------------------------------
@@ -32,8 +83,606 @@ def test_sharpener_init_basic():
     assert isinstance(sharp.regressorOpt, dict)
 
 
+def test_sharpener_save_and_load(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.random((200, 3))
+    y = X @ np.array([1.0, 2.0, 3.0])
+    sharp = DecisionTreeSharpener(["h1.tif"], ["l1.tif"], movingWindowSize=5)
+    sharp.reg = [None, sharp._doFit(y, X, None, False)]
+    sharp.windowExtents = [[[0.0, 10.0], [10.0, 0.0]]]
+
+    sharp.save(tmp_path)
+    loaded = DecisionTreeSharpener.load(tmp_path)
+
+    assert loaded.reg[0] is None
+    assert isinstance(loaded.reg[1], CompiledTreeEnsemble)
+    assert loaded.windowExtents == sharp.windowExtents
+    assert loaded.movingWindowSize == sharp.movingWindowSize
+    assert np.allclose(loaded.reg[1].predict(X), sharp.reg[1].predict(X))
+
+
+def test_sharpener_save_fails_for_unsavable_settings(tmp_path):
+    sharp = DecisionTreeSharpener(["h1.tif"], ["l1.tif"],
+                                  baggingRegressorOpt={"random_state": np.random.RandomState(0)})
+    sharp.reg = [None]
+    sharp.windowExtents = []
+    with pytest.raises(TypeError):
+        sharp.save(tmp_path)
+    assert not (tmp_path / "model.json").exists()
+
+
+def test_cubist_save_and_load(tmp_path):
+    Cubist = pytest.importorskip("cubist").Cubist
+    rng = np.random.default_rng(0)
+    X = rng.random((200, 3))
+    y = 300 + 10*X[:, 0] - 5*X[:, 1]*X[:, 2]
+    sharp = CubistSharpener([], [], n_processes=1)
+    # Recent releases of cubist no longer take the composite option
+    if "composite" not in inspect.signature(Cubist).parameters:
+        del sharp.regressorOpt["composite"]
+    sharp.reg = [sharp._doFit(y[:100], X[:100], None, True),
+                 sharp._doFit(y, X, np.ones(200), False)]
+    sharp.windowExtents = [[[0.0, 10.0], [10.0, 0.0]]]
+    sharp.save(tmp_path)
+
+    loaded = CubistSharpener.load(tmp_path)
+    assert loaded.n_processes == 1
+    for reg, loadedReg in zip(sharp.reg, loaded.reg):
+        assert np.array_equal(loaded._doPredict(X, loadedReg), sharp._doPredict(X, reg))
+
+
+def test_neural_network_save_and_load_keeps_activation(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.random((200, 3))
+    y = 300 + 10*X[:, 0] - 5*X[:, 1]*X[:, 2]
+    sharp = NeuralNetworkSharpener([], [], regressionType=REG_sklearn_ann,
+                                   regressorOpt={"hidden_layer_sizes": (5,), "max_iter": 20,
+                                                 "activation": "tanh"},
+                                   baggingRegressorOpt={"n_estimators": 2, "random_state": 0})
+    sharp.reg = [sharp._doFit(y, X, None, False)]
+    sharp.windowExtents = []
+    sharp.save(tmp_path)
+
+    assert str(np.load(tmp_path / "window_0_activation.npy")) == "tanh"
+    loaded = NeuralNetworkSharpener.load(tmp_path)
+    assert loaded.reg[0]["reg"].activation == "tanh"
+    assert np.allclose(loaded._doPredict(X, loaded.reg[0]), sharp._doPredict(X, sharp.reg[0]))
+
+
+def test_parallel_fitting_matches_serial_fitting():
+    rng = np.random.default_rng(0)
+    X = rng.random((300, 3))
+    y = X @ np.array([1.0, 2.0, 3.0]) + np.sin(10 * X[:, 0])
+    fitArgs = [(0, y[:150], X[:150], None, True), (1, y[150:], X[150:], None, True),
+               (2, y, X, np.ones(300), False)]
+
+    models = []
+    for n_jobs in (1, 2):
+        sharp = DecisionTreeSharpener(["h1.tif"], ["l1.tif"], n_jobs=n_jobs,
+                                      baggingRegressorOpt={"random_state": 0})
+        models.append([reg for reg, _ in sharp._fitWindows(fitArgs)])
+
+    for serial, parallel in zip(*models):
+        assert np.array_equal(serial.predict(X), parallel.predict(X))
+
+
+def test_concurrent_prediction_matches_sequential_prediction():
+    rng = np.random.default_rng(0)
+    proj = "EPSG:32633"
+    gt_HR = (500000.0, 30.0, 0, 4000000.0, 0, -30.0)
+    gt_LR = (500000.0, 300.0, 0, 4000000.0, 0, -300.0)
+    data_HR = rng.random((60, 60, 2))
+    data_LR = (300 + 5*data_HR[:, :, 0]**2 - 3*data_HR[:, :, 1]).reshape(6, 10, 6, 10).mean((1, 3))
+
+    for perLeafLinearRegression, compiledPredictor in ((False, False), (True, True)):
+        sharp = DecisionTreeSharpener([], [], movingWindowSize=3, minimumSampleNumber=5,
+                                      perLeafLinearRegression=perLeafLinearRegression,
+                                      compiledPredictor=compiledPredictor,
+                                      baggingRegressorOpt={"random_state": 0})
+        sharp.fitArrays([(data_HR, gt_HR, proj)], [(data_LR, gt_LR, proj)])
+        sequential = sharp.predictArrays(data_HR, gt_HR, proj, (data_LR, gt_LR, proj))
+        sharp.n_jobs = 4
+        # The compiled kernels are parallel so their windows are not predicted by threads
+        executor = sharp._windowExecutor()
+        assert (executor is None) == compiledPredictor
+        if executor is not None:
+            executor.shutdown()
+        concurrent = sharp.predictArrays(data_HR, gt_HR, proj, (data_LR, gt_LR, proj))
+        assert np.array_equal(concurrent, sequential, equal_nan=True)
+
+    # Compiled kernels called from several threads at once give the sequential results
+    X = data_HR.reshape(-1, 2)
+    regs = [reg for reg in sharp.reg if reg is not None]
+    expected = [reg.predict(X) for reg in regs]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda reg: reg.predict(X), regs))
+    for result, value in zip(results, expected):
+        assert np.array_equal(result, value)
+
+
+def test_predict_valid_pixels_skips_nans():
+    rng = np.random.default_rng(0)
+    X = rng.random((200, 3))
+    y = X @ np.array([1.0, 2.0, 3.0])
+    sharp = DecisionTreeSharpener(["h1.tif"], ["l1.tif"])
+    reg = sharp._doFit(y, X, None, False)
+
+    inData = rng.random((10, 12, 3))
+    inData[rng.random(inData.shape) < 0.2] = np.nan
+    validPix = ~np.any(np.isnan(inData), -1)
+    outData = np.full((10, 12), np.nan)
+    sharp._predictValidPixels(inData, validPix, reg, outData)
+
+    assert np.array_equal(np.isnan(outData), ~validPix)
+    assert np.allclose(outData[validPix], reg.predict(inData[validPix]))
+
+
+def test_cubist_prediction_pool_is_reused_across_windows():
+    rng = np.random.default_rng(0)
+    X = rng.random((100, 3))
+    regs = [Ridge().fit(X, X @ w) for w in ([1.0, 2.0, 3.0], [-1.0, 0.5, 0.0])]
+    sharp = CubistSharpener([], [], n_processes=2)
+    sharp.reg = regs
+    try:
+        inData = rng.random((50, 3)).astype(np.float32)
+        assert np.allclose(sharp._doPredict(inData, regs[0]), regs[0].predict(inData))
+        pool = sharp._predictionPool
+        assert np.allclose(sharp._doPredict(inData, regs[1]), regs[1].predict(inData))
+        assert sharp._predictionPool is pool
+        # Windows predicted concurrently share the pool, which is not restarted for a
+        # model that is not one of the trained models
+        other = Ridge().fit(X, X[:, 0])
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            predictions = list(executor.map(lambda reg: sharp._doPredict(inData, reg),
+                                            regs + [other]))
+        for reg, prediction in zip(regs + [other], predictions):
+            assert np.allclose(prediction, reg.predict(inData))
+        assert sharp._predictionPool is pool
+        # Retraining replaces the models held by the workers
+        sharp.reg = regs[::-1]
+        assert np.allclose(sharp._doPredict(inData, regs[0]), regs[0].predict(inData))
+        assert sharp._predictionPool is not pool
+    finally:
+        sharp.close()
+    assert sharp._predictionPool is None
+
+
+def test_neural_network_local_fits_warm_start_from_global():
+    rng = np.random.default_rng(0)
+    X = rng.random((400, 3))
+    y = 300 + 10*X[:, 0] - 5*X[:, 1]*X[:, 2]
+    sharp = NeuralNetworkSharpener([], [], regressionType=REG_sklearn_ann,
+                                   regressorOpt={"hidden_layer_sizes": (5,), "max_iter": 200},
+                                   baggingRegressorOpt={"n_estimators": 3, "random_state": 0},
+                                   warmStartLocal=True, localMaxIter=5)
+    fitArgs = [(0, y[:100], X[:100], None, True), (1, y[:100], X[:100], None, True),
+               (2, y, X, None, False)]
+    (localNN, _), (otherNN, _), (globalNN, _) = sharp._fitWindows(fitArgs)
+
+    assert isinstance(localNN["reg"], MLPEnsemble)
+    assert localNN["reg"].features.shape[0] == 3
+    assert localNN["HR_scaler"] is globalNN["HR_scaler"]
+    assert not hasattr(sharp, "_globalNetwork")
+    assert np.all(np.isfinite(sharp._doPredict(X[:100], localNN)))
+    # Windows with the same samples draw different bootstrap samples
+    assert not np.allclose(sharp._doPredict(X, localNN), sharp._doPredict(X, otherNN))
+
+
+def test_neural_network_without_warm_start_fits_in_window_order(monkeypatch):
+    sharp = NeuralNetworkSharpener([], [], regressionType=REG_sklearn_ann)
+    fitted = []
+    monkeypatch.setattr(sharp, "_fitWindow", lambda i, *args: fitted.append(i) or (i, {}))
+    fitArgs = [(i, None, None, None, i < 2) for i in range(3)]
+
+    assert [fit for fit, _ in sharp._fitWindows(fitArgs)] == [0, 1, 2]
+    assert fitted == [0, 1, 2]
+
+
+def test_metrics_callback_receives_window_predictions():
+    rng = np.random.default_rng(0)
+    X = rng.random((200, 3))
+    y = X @ np.array([1.0, 2.0, 3.0])
+    metrics = []
+    sharp = DecisionTreeSharpener(["h1.tif"], ["l1.tif"], metricsCallback=metrics.append)
+    reg, fitMetrics = sharp._fitWindow(0, y, X, None, False)
+    assert fitMetrics["stage"] == "fit" and fitMetrics["samples"] == 200
+    sharp.reg = [reg, reg]
+
+    inData = rng.random((10, 12, 3))
+    inData[0, :, :] = np.nan
+    validPix = ~np.any(np.isnan(inData), -1)
+    outWindowData = np.full((10, 12), np.nan)
+    outFullData = np.full((10, 12), np.nan)
+    windows = [(0, slice(0, 5), slice(0, 12)), (0, slice(5, 10), slice(0, 12))]
+    sharp._predictWindows(inData, validPix, windows, outWindowData, outFullData)
+
+    assert [m["stage"] for m in metrics] == ["predict", "predict"]
+    assert sum(m["pixels"] for m in metrics) == np.sum(validPix)
+    assert all(m["wallTime"] >= 0 for m in metrics)
+
+
+def test_array_api_fits_predicts_and_corrects_residuals():
+    rng = np.random.default_rng(0)
+    proj = "EPSG:32633"
+    gt_HR = (500000.0, 30.0, 0, 4000000.0, 0, -30.0)
+    gt_LR = (500000.0, 300.0, 0, 4000000.0, 0, -300.0)
+    data_HR = rng.random((60, 60, 2))
+    target = 300 + 5*data_HR[:, :, 0] - 3*data_HR[:, :, 1]
+    data_LR = target.reshape(6, 10, 6, 10).mean((1, 3))
+    data_HR[0, 0, 0] = np.nan
+    quality_LR = np.ones(data_LR.shape)
+    quality_LR[0, 0] = 0
+
+    sharp = DecisionTreeSharpener([], [], lowResGoodQualityFlags=[1], minimumSampleNumber=5)
+    sharp.fitArrays([(data_HR, gt_HR, proj)], [(data_LR, gt_LR, proj)], [quality_LR])
+    assert sharp.gridInfo["shape"] == [6, 6]
+
+    downscaled = sharp.predictArrays(data_HR, gt_HR, proj, (data_LR, gt_LR, proj))
+    assert downscaled.shape == (60, 60)
+    assert np.isnan(downscaled[0, 0]) and np.sum(np.isnan(downscaled)) == 1
+
+    residual_LR, gt_res, corrected = sharp.residualArrays(downscaled, gt_HR, proj,
+                                                          (data_LR, gt_LR, proj), quality_LR)
+    assert np.allclose(gt_res, gt_LR)
+    assert np.isnan(residual_LR[0, 0]) and np.sum(np.isnan(residual_LR)) == 1
+    assert corrected.shape == downscaled.shape
+
+
+def _fittedScenePair(tmp_path, dtype="float64"):
+    rng = np.random.default_rng(2)
+    proj = "EPSG:32633"
+    gt_HR = (500000.0, 30.0, 0, 4000000.0, 0, -30.0)
+    gt_LR = (500000.0, 300.0, 0, 4000000.0, 0, -300.0)
+    data_HR = rng.random((60, 60, 2))
+    data_LR = (300 + 5*data_HR[:, :, 0]**2 - 3*data_HR[:, :, 1]).reshape(6, 10, 6, 10).mean((1, 3))
+    data_HR[5, 7, 1] = np.nan
+    highResFile = str(tmp_path / "highRes.tif")
+    lowResFile = str(tmp_path / "lowRes.tif")
+    utils.saveImg(data_HR, gt_HR, proj, highResFile, noDataValue=np.nan)
+    utils.saveImg(data_LR, gt_LR, proj, lowResFile, noDataValue=np.nan)
+
+    sharp = DecisionTreeSharpener([], [], movingWindowSize=3, minimumSampleNumber=5,
+                                  baggingRegressorOpt={"random_state": 0}, dtype=dtype)
+    sharp.fitArrays([(data_HR, gt_HR, proj)], [(data_LR, gt_LR, proj)])
+    return sharp, highResFile, lowResFile
+
+
+def test_tiled_application_matches_in_memory_application(tmp_path):
+    sharp, highResFile, lowResFile = _fittedScenePair(tmp_path)
+    expected = sharp.applySharpener(highResFile, lowResFile).GetRasterBand(1).ReadAsArray()
+
+    with pytest.raises(ValueError):
+        sharp.applySharpener(highResFile, lowResFile, tileSize=25)
+    # Residual strips hold about as many high resolution pixels as one tile
+    gt_HR = (500000.0, 30.0, 0, 4000000.0, 0, -30.0)
+    gt_LR = (500000.0, 300.0, 0, 4000000.0, 0, -300.0)
+    assert sharp._tileStripRows(25, gt_HR, gt_LR, 60) == 1
+    assert sharp._tileStripRows(50, gt_HR, gt_LR, 60) == 4
+    outImage = sharp.applySharpener(highResFile, lowResFile, tileSize=25,
+                                    outputFilename=str(tmp_path / "tiled.tif"))
+    tiled = outImage.GetRasterBand(1).ReadAsArray()
+    assert np.allclose(tiled, expected, equal_nan=True)
+
+
+def test_tiled_residual_analysis_matches_in_memory_analysis(tmp_path):
+    sharp, highResFile, lowResFile = _fittedScenePair(tmp_path)
+    downscaled = sharp.applySharpener(highResFile, lowResFile)
+    residual, corrected = sharp.residualAnalysis(downscaled, lowResFile)
+
+    tiledResidual, tiledCorrected = sharp.residualAnalysis(
+        downscaled, lowResFile, tileSize=25, outputFilename=str(tmp_path / "corrected.tif"))
+    assert np.allclose(tiledResidual.GetRasterBand(1).ReadAsArray(),
+                       residual.GetRasterBand(1).ReadAsArray(), equal_nan=True)
+    assert np.allclose(tiledCorrected.GetRasterBand(1).ReadAsArray(),
+                       corrected.GetRasterBand(1).ReadAsArray(), equal_nan=True)
+
+
+def test_float32_sharpening_matches_float64(tmp_path):
+    sharp64, highResFile, lowResFile = _fittedScenePair(tmp_path)
+    sharp32 = _fittedScenePair(tmp_path, dtype="float32")[0]
+    data_HR, gt_HR, proj = utils.readRaster(highResFile)
+    lowResScene = utils.readRaster(lowResFile)
+    lowResScene = (lowResScene[0][:, :, 0],) + lowResScene[1:]
+
+    outputs = []
+    for sharp in (sharp64, sharp32):
+        downscaled = sharp.predictArrays(data_HR, gt_HR, proj, lowResScene)
+        residual_LR, _, corrected = sharp.residualArrays(downscaled, gt_HR, proj, lowResScene)
+        outImage = sharp.applySharpener(highResFile, lowResFile)
+        residualImage, correctedImage = sharp.residualAnalysis(outImage, lowResFile)
+        outputs.append((downscaled, residual_LR, corrected,
+                        outImage.GetRasterBand(1).ReadAsArray(),
+                        residualImage.GetRasterBand(1).ReadAsArray(),
+                        correctedImage.GetRasterBand(1).ReadAsArray()))
+
+    assert all(output.dtype == np.float32 for output in outputs[1])
+    for output64, output32 in zip(*outputs):
+        assert np.allclose(output32, output64, rtol=1e-5, atol=1e-3, equal_nan=True)
+
+
+def test_series_in_parallel_matches_serial_series(tmp_path):
+    sharp, highResFile, lowResFile = _fittedScenePair(tmp_path)
+    # A second date, 2 K warmer than the first
+    data_LR, gt_LR, proj = utils.readRaster(lowResFile)
+    secondLowResFile = str(tmp_path / "lowRes2.tif")
+    utils.saveImg(data_LR[:, :, 0] + 2, gt_LR, proj, secondLowResFile, noDataValue=np.nan)
+    pairs = [(highResFile, lowResFile), (highResFile, secondLowResFile)]
+
+    results = []
+    for n_workers in (1, 2):
+        outputs = [str(tmp_path / f"out_{n_workers}_{date}.tif") for date in (1, 2)]
+        summary = sharp.sharpenSeries(pairs, outputs, n_workers=n_workers)
+        assert [times["output"] for times in summary] == outputs
+        for times in summary:
+            assert all(times[step] >= 0 for step in
+                       ("sharpening", "residualAnalysis", "writing", "total"))
+        images = []
+        for output in outputs:
+            residualFile = output.replace(".tif", "_residual.tif")
+            assert os.path.exists(output) and os.path.exists(residualFile)
+            images += [utils.readRaster(output)[0], utils.readRaster(residualFile)[0]]
+        results.append(images)
+
+    for serial, parallel in zip(*results):
+        assert np.array_equal(parallel, serial, equal_nan=True)
+
+
+def test_xarray_chunks_match_array_api():
+    xr = pytest.importorskip("xarray")
+    pytest.importorskip("dask.array")
+    from pyDMS.dataarray import sharpenDataArray
+
+    rng = np.random.default_rng(1)
+    proj = "EPSG:32633"
+    gt_HR = (500000.0, 30.0, 0, 4000000.0, 0, -30.0)
+    gt_LR = (500000.0, 300.0, 0, 4000000.0, 0, -300.0)
+    data_HR = rng.random((60, 60, 2))
+    data_LR = (300 + 5*data_HR[:, :, 0]**2 - 3*data_HR[:, :, 1]).reshape(6, 10, 6, 10).mean((1, 3))
+    data_HR[5, 7, 1] = np.nan
+    sharp = DecisionTreeSharpener([], [], movingWindowSize=3, minimumSampleNumber=5,
+                                  baggingRegressorOpt={"random_state": 0})
+    sharp.fitArrays([(data_HR, gt_HR, proj)], [(data_LR, gt_LR, proj)])
+    expected = sharp.predictArrays(data_HR, gt_HR, proj, (data_LR, gt_LR, proj))
+
+    centres = gt_HR[0] + 15.0 + 30.0*np.arange(60)
+    highRes = xr.DataArray(np.moveaxis(data_HR, -1, 0), dims=("band", "y", "x"),
+                           coords={"y": 4000000.0 - (centres - gt_HR[0]), "x": centres},
+                           attrs={"crs": proj}).chunk({"y": 25, "x": 35})
+    centres_LR = gt_LR[0] + 150.0 + 300.0*np.arange(6)
+    lowRes = xr.DataArray(data_LR, dims=("y", "x"),
+                          coords={"y": 4000000.0 - (centres_LR - gt_LR[0]), "x": centres_LR})
+    sharpened = sharpenDataArray(sharp, highRes, lowRes)
+    assert sharpened.chunks == ((25, 25, 10), (35, 25))
+    assert np.allclose(sharpened.values, expected, equal_nan=True)
+
+
+def test_geotransform_from_coords_needs_the_resolution():
+    xr = pytest.importorskip("xarray")
+    pytest.importorskip("dask.array")
+    from pyDMS.dataarray import geotransformFromCoords
+
+    data = xr.DataArray(np.zeros((2, 3)), dims=("y", "x"),
+                        coords={"y": [3985.0, 3955.0], "x": [515.0, 545.0, 575.0]})
+    assert geotransformFromCoords(data) == (500.0, 30.0, 0.0, 4000.0, 0.0, -30.0)
+    with pytest.raises(ValueError):
+        geotransformFromCoords(data.isel(y=[0]))
+
+
 def test_sharpener_init_qualityfile_mismatch():
     with pytest.raises(IOError):
         DecisionTreeSharpener(
             ["h1.tif"], ["l1.tif"], lowResQualityFiles=["q1.tif", "q2.tif"]
         )
+
+
+# ----------------------------------------------------------------------
+# SampleStore
+# ----------------------------------------------------------------------
+def test_sample_store_accumulates_across_appends():
+    store = utils.SampleStore(2, 3, initialCapacity=4)
+    for k in range(5):
+        store.append(0, np.full(3, k), np.full((3, 3), k), np.ones(3))
+
+    data_LR, data_HR, weight = store.get(0)
+    assert store.size(0) == 15
+    assert data_HR.dtype == np.float32
+    assert np.array_equal(data_LR, np.repeat(np.arange(5), 3))
+    assert np.array_equal(data_HR[:, 0], data_LR)
+    assert np.array_equal(weight, np.ones(15))
+    assert store.size(1) == 0
+    assert store.get(1)[1].shape == (0, 3)
+
+
+# ----------------------------------------------------------------------
+# High to low resolution aggregation
+# ----------------------------------------------------------------------
+@pytest.mark.parametrize("gt_LR, size_LR", [
+    ((0.0, 40.0, 0, 0.0, 0, -40.0), 10),    # integer ratio
+    ((-15.0, 37.0, 0, 15.0, 0, -37.0), 12),  # non-integer ratio and offset
+])
+def test_aggregate_high_res_matches_nan_statistics(gt_LR, size_LR):
+    rng = np.random.default_rng(0)
+    data = rng.random((40, 40, 2)).astype(np.float32)
+    data[rng.random(data.shape) < 0.2] = np.nan
+    gt_HR = (0.0, 10.0, 0, 0.0, 0, -10.0)
+
+    mean, std = utils.aggregateHighResToLowRes(data, gt_HR, gt_LR, size_LR, size_LR)
+
+    yMin, yMax, xMin, xMax = utils.footprintIndices(gt_HR, gt_LR, size_LR, size_LR)
+    for y in range(size_LR):
+        for x in range(size_LR):
+            footprint = data[yMin[y]:yMax[y], xMin[x]:xMax[x], :].reshape(-1, 2)
+            valid = ~np.all(np.isnan(footprint), axis=0)
+            assert np.array_equal(np.isnan(mean[y, x]), ~valid)
+            assert np.allclose(mean[y, x, valid], np.nanmean(footprint[:, valid], axis=0))
+            assert np.allclose(std[y, x, valid], np.nanstd(footprint[:, valid], axis=0))
+
+
+@pytest.mark.parametrize("gt_LR, size_LR", [
+    ((0.0, 40.0, 0, 0.0, 0, -40.0), 10),
+    ((-15.0, 37.0, 0, 15.0, 0, -37.0), 12),
+])
+@pytest.mark.parametrize("exponent", [1, 4])
+def test_strip_aggregation_matches_whole_raster_aggregation(gt_LR, size_LR, exponent):
+    rng = np.random.default_rng(0)
+    data = (rng.random((40, 40, 2)) + 1).astype(np.float32)
+    data[rng.random(data.shape) < 0.2] = np.nan
+    gt_HR = (0.0, 10.0, 0, 0.0, 0, -10.0)
+    scene = utils.saveImg(data, gt_HR, "EPSG:32633", "MEM")
+
+    whole = utils.aggregateRasterToLowRes(scene, gt_LR, size_LR, size_LR, exponent=exponent)
+    expected = utils.aggregateHighResToLowRes(data.astype(np.float64)**exponent, gt_HR, gt_LR,
+                                              size_LR, size_LR)
+    assert np.allclose(whole[0], expected[0], rtol=1e-6, equal_nan=True)
+    # Strips of 3 rows do not divide either low resolution grid
+    for stripRows in (1, 3):
+        strips = utils.aggregateRasterToLowRes(scene, gt_LR, size_LR, size_LR,
+                                               stripRows=stripRows, exponent=exponent)
+        assert np.allclose(strips[0], whole[0], rtol=1e-12, atol=0, equal_nan=True)
+        assert np.allclose(strips[1], whole[1], rtol=1e-12, atol=1e-12, equal_nan=True)
+
+
+# ----------------------------------------------------------------------
+# binomialSmoother
+# ----------------------------------------------------------------------
+@pytest.mark.parametrize("useNumba", [False, True])
+def test_binomial_smoother_ignores_nans(useNumba):
+    rng = np.random.default_rng(0)
+    data = rng.random((20, 30))
+    data[rng.random(data.shape) < 0.3] = np.nan
+    data[10, 10] = 0.5
+    data[9, 9] = np.nan
+
+    smoothed = utils.binomialSmoother(data, useNumba=useNumba)
+
+    assert np.array_equal(np.isnan(smoothed), np.isnan(data))
+    weights = np.outer([1, 2, 1], [1, 2, 1])
+    footprint = data[9:12, 9:12]
+    valid = ~np.isnan(footprint)
+    expected = np.sum(weights[valid] * footprint[valid]) / np.sum(weights[valid])
+    assert np.isclose(smoothed[10, 10], expected)
+
+
+# ----------------------------------------------------------------------
+# RasterWriter and saveImg
+# ----------------------------------------------------------------------
+def test_raster_writer_writes_blocks_next_to_other_files(tmp_path):
+    userFile = tmp_path / "out_tmp.tif"
+    userFile.write_bytes(b"user data")
+    data = np.arange(40 * 30, dtype=np.float32).reshape(30, 40)
+    gt = (500000.0, 30.0, 0, 4000000.0, 0, -30.0)
+
+    writer = utils.RasterWriter(str(tmp_path / "out.tif"), 40, 30, 1, gt, "EPSG:32633",
+                                noDataValue=np.nan, cog=True)
+    assert os.path.dirname(writer.tempPath) == str(tmp_path)
+    assert writer.tempPath != str(userFile)
+    writer.write(data[:16], 0, 0)
+    writer.write(data[16:], 0, 16)
+    ds = writer.close()
+
+    assert np.array_equal(ds.GetRasterBand(1).ReadAsArray(), data)
+    assert userFile.read_bytes() == b"user data"
+
+
+@pytest.mark.parametrize("computeStats", [False, True])
+def test_save_img_computes_statistics_only_when_asked(tmp_path, monkeypatch, computeStats):
+    band = type(utils.gdal.GetDriverByName("MEM").Create("MEM", 1, 1, 1).GetRasterBand(1))
+    calls = []
+    monkeypatch.setattr(band, "ComputeStatistics",
+                        lambda self, *args, **kwargs: calls.append(args), raising=False)
+    data = np.ones((20, 10, 2))
+
+    ds = utils.saveImg(data, (0.0, 1.0, 0, 20.0, 0, -1.0), "EPSG:32633",
+                       tmp_path / "out.tif", computeStats=computeStats)
+
+    assert len(calls) == (2 if computeStats else 0)
+    assert np.array_equal(ds.GetRasterBand(2).ReadAsArray(), data[:, :, 1])
+
+
+# ----------------------------------------------------------------------
+# SceneCache
+# ----------------------------------------------------------------------
+def test_scene_cache_roundtrip_and_invalidation(tmp_path):
+    source = tmp_path / "scene.tif"
+    source.write_bytes(b"scene")
+    cache = utils.SceneCache(str(tmp_path / "cache"))
+    key = cache.key([str(source), None], stage="training")
+    assert cache.load(key) is None
+
+    arrays = {"resMean": np.arange(6.0).reshape(1, 2, 3), "gt_LR": np.array([0.0, 1.0])}
+    cache.store(key, arrays)
+    loaded = cache.load(key)
+    assert set(loaded) == set(arrays)
+    assert np.array_equal(loaded["resMean"], arrays["resMean"])
+
+    # Changing the input file changes the key
+    source.write_bytes(b"modified scene")
+    assert cache.key([str(source), None], stage="training") != key
+
+    # Entries which do not fit in the cache are evicted
+    utils.SceneCache(str(tmp_path / "cache"), maxBytes=0).evict()
+    assert cache.load(key) is None
+
+
+# ----------------------------------------------------------------------
+# resampleLowResArrayToHighRes
+# ----------------------------------------------------------------------
+def test_resample_low_res_array_to_high_res():
+    yy, xx = np.mgrid[0:8, 0:10]
+    data_LR = 2.0*xx - 3.0*yy
+    gt_LR = (0.0, 40.0, 0, 0.0, 0, -40.0)
+    gt_HR = (0.0, 10.0, 0, 0.0, 0, -10.0)
+
+    full = utils.resampleLowResArrayToHighRes(data_LR, gt_LR, gt_HR, 0, 0, 40, 32)
+    block = utils.resampleLowResArrayToHighRes(data_LR, gt_LR, gt_HR, 13, 5, 11, 9)
+    assert np.array_equal(block, full[5:14, 13:24])
+
+    # Cubic convolution reproduces linear functions away from the edges
+    rows, cols = np.mgrid[0:32, 0:40]
+    expected = 2.0*((cols + 0.5)/4 - 0.5) - 3.0*((rows + 0.5)/4 - 0.5)
+    assert np.allclose(full[6:-6, 6:-6], expected[6:-6, 6:-6])
+
+    # High res pixels within NaN low res pixels are NaN, others are interpolated
+    # from the valid low res pixels
+    data_LR[3, 4] = np.nan
+    withNaN = utils.resampleLowResArrayToHighRes(data_LR, gt_LR, gt_HR, 0, 0, 40, 32)
+    nanPix = np.zeros((32, 40), dtype=bool)
+    nanPix[12:16, 16:20] = True
+    assert np.array_equal(np.isnan(withNaN), nanPix)
+
+
+# ----------------------------------------------------------------------
+# GridAlignment
+# ----------------------------------------------------------------------
+def test_grid_alignment_subsets_low_res_grid_to_high_res_extent():
+    gt_HR = (500100.0, 30.0, 0, 4000000.0, 0, -30.0)
+    gt_LR = (499800.0, 300.0, 0, 4000300.0, 0, -300.0)
+    alignment = utils.GridAlignment("EPSG:32633", gt_HR, 100, 50,
+                                    "EPSG:32633", gt_LR, 20, 20)
+
+    assert np.allclose(alignment.gt_LR, (500100.0, 300.0, 0, 4000000.0, 0, -300.0))
+    assert (alignment.xSize_LR, alignment.ySize_LR) == (10, 5)
+    yMin, yMax, xMin, xMax = alignment.footprints()
+    assert np.array_equal(xMin, np.arange(0, 100, 10))
+    assert np.array_equal(xMax, np.arange(10, 110, 10))
+    assert np.array_equal(yMin, np.arange(0, 50, 10))
+    assert np.array_equal(yMax, np.arange(10, 60, 10))
+
+    # Same projection so the array subset is a slice of the low res grid
+    data_LR = np.arange(400.0).reshape(20, 20)
+    assert np.array_equal(alignment.subsetLowResArray(data_LR), data_LR[1:6, 1:11])
+
+
+def test_grid_alignment_reuses_nearest_index_map(monkeypatch):
+    alignment = utils.alignGrids("EPSG:32633", (500100.0, 30.0, 0, 4000000.0, 0, -30.0), 100, 50,
+                                 "EPSG:4326", (14.9, 0.01, 0, 36.2, 0, -0.01), 30, 30)
+    data_LR = np.arange(900.0).reshape(30, 30)
+    expected = alignment.subsetLowResArray(data_LR)
+    assert np.any(np.isfinite(expected))
+
+    # The index map is kept with the cached alignment so no transformer is needed again
+    monkeypatch.setattr(utils, "Transformer", None)
+    again = utils.alignGrids("EPSG:32633", (500100.0, 30.0, 0, 4000000.0, 0, -30.0), 100, 50,
+                             "EPSG:4326", (14.9, 0.01, 0, 36.2, 0, -0.01), 30, 30)
+    assert again is alignment
+    assert np.array_equal(again.subsetLowResArray(data_LR + 1), expected + 1, equal_nan=True)